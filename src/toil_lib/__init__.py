@@ -1,4 +1,5 @@
 import argparse
+import itertools
 import os
 import tempfile
 
@@ -35,6 +36,43 @@ def partitions(l, partition_size):
         yield l[i:i + partition_size]
 
 
+def iflatten(x):
+    """
+    Lazy version of flatten, for nested iterables that are too large to hold in memory
+
+    >>> list(iflatten([1, [2, (3, 4)], 'ab']))
+    [1, 2, 3, 4, 'ab']
+
+    :param iterable x: The nested iterable to be flattened
+    """
+    for el in x:
+        if hasattr(el, "__iter__") and not isinstance(el, basestring):
+            for sub_el in iflatten(el):
+                yield sub_el
+        else:
+            yield el
+
+
+def ipartitions(iterable, partition_size):
+    """
+    Lazy version of partitions, for any iterable, including generators
+
+    >>> list(ipartitions(iter([1,2,3,4,5]), 2))
+    [[1, 2], [3, 4], [5]]
+    >>> list(ipartitions(xrange(0), 10))
+    []
+
+    :param iterable iterable: Iterable to be partitioned
+    :param int partition_size: Size of partitions
+    """
+    iterator = iter(iterable)
+    while True:
+        partition = list(itertools.islice(iterator, partition_size))
+        if not partition:
+            return
+        yield partition
+
+
 class UserError(Exception):
     pass
 
@@ -0,0 +1,255 @@
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import time
+from contextlib import contextmanager
+from uuid import uuid4
+
+from bd2k.util.humanize import human2bytes
+
+_log = logging.getLogger(__name__)
+
+# Size budget of a cache, unless given explicitly
+DEFAULT_MAX_SIZE = human2bytes(os.environ.get('TOIL_LIB_CACHE_SIZE', '100G'))
+
+
+def default_cache_dir():
+    """
+    :return: The node-local cache directory from the TOIL_LIB_CACHE_DIR environment variable, or None if unset
+    :rtype: str
+    """
+    return os.environ.get('TOIL_LIB_CACHE_DIR') or None
+
+
+class NodeCache(object):
+    """
+    A cache of files and directories shared by all jobs on a node. Entries are addressed by a key, such as a URL and
+    its ETag, and are created at most once: concurrent requests for the same key wait on a file lock while the first
+    one fills the entry. Entries are handed out as hard links of their read-only files, so containers see them under
+    the work directory, and the least recently used entries are evicted once the cache grows beyond its size budget.
+
+    >>> import tempfile
+    >>> cache = NodeCache(tempfile.mkdtemp())
+    >>> dest = os.path.join(tempfile.mkdtemp(), 'foo')
+    >>> cache.get('key', lambda path: open(path, 'w').write('bar'), dest) == dest
+    True
+    >>> open(dest).read()
+    'bar'
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        """
+        :param str cache_dir: Directory holding the cache, which should be on the same filesystem as the work
+               directories so entries can be hard linked
+        :param int max_size: Size budget of the cache in bytes
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = DEFAULT_MAX_SIZE if max_size is None else max_size
+        self.hits = 0
+        self.misses = 0
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def get(self, key, fill, dest):
+        """
+        Hands out the entry for a key, filling it first if it isn't cached
+
+        :param str key: Key of the entry
+        :param function fill: Called with a path, at which it must create the file or directory of the entry
+        :param str dest: Path of the file or directory to hand the entry out at
+        :return: dest
+        :rtype: str
+        """
+        digest = hashlib.sha1(key).hexdigest()
+        entry = self._path(digest)
+        with _flock(entry + '.lock'):
+            if os.path.exists(entry):
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._fill(key, digest, fill)
+            os.utime(entry + '.json', None)
+            _hand_out(entry, dest)
+        self.evict()
+        return dest
+
+    def lookup(self, key, dest):
+        """
+        Hands out the entry for a key if it is cached. Unlike get, the lock on the entry is only held for the hand-out.
+
+        :param str key: Key of the entry
+        :param str dest: Path of the file or directory to hand the entry out at
+        :return: Whether the entry was cached and handed out
+        :rtype: bool
+        """
+        entry = self._path(hashlib.sha1(key).hexdigest())
+        with _flock(entry + '.lock'):
+            if not os.path.exists(entry):
+                return False
+            self.hits += 1
+            os.utime(entry + '.json', None)
+            _hand_out(entry, dest)
+        return True
+
+    def put(self, key, path):
+        """
+        Makes a file or directory that was created outside the lock, at a path from staging_path, the entry for a key.
+        It is renamed into place, so the lock on the entry is only held briefly. If the key was put or filled by
+        someone else in the meantime, their entry is kept and path is removed.
+
+        :param str key: Key of the entry
+        :param str path: Path of the file or directory, on the same filesystem as the cache
+        :return: Whether path became the entry
+        :rtype: bool
+        """
+        digest = hashlib.sha1(key).hexdigest()
+        entry = self._path(digest)
+        with _flock(entry + '.lock'):
+            if os.path.exists(entry):
+                _remove(path)
+                return False
+            self.misses += 1
+            self._fill(key, digest, lambda tmp: os.rename(path, tmp))
+        self.evict()
+        return True
+
+    def staging_path(self):
+        """
+        :return: A unique path inside the cache directory at which an entry can be created for put
+        :rtype: str
+        """
+        return os.path.join(self.cache_dir, '.staging-{}'.format(uuid4()))
+
+    def contains(self, key):
+        """
+        :param str key: Key of the entry
+        :return: Whether the cache holds an entry for key
+        :rtype: bool
+        """
+        return os.path.exists(self._path(hashlib.sha1(key).hexdigest()))
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits its size budget. Entries that are being filled or
+        handed out are skipped.
+        """
+        with _flock(os.path.join(self.cache_dir, '.evict.lock')):
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.json'):
+                    meta_path = os.path.join(self.cache_dir, name)
+                    try:
+                        with open(meta_path) as f:
+                            entries.append((os.path.getmtime(meta_path), json.load(f)['size'], name[:-len('.json')]))
+                    except (IOError, OSError, ValueError):
+                        continue
+            total = sum(size for _, size, _ in entries)
+            for _, size, digest in sorted(entries):
+                if total <= self.max_size:
+                    break
+                entry = self._path(digest)
+                with _flock(entry + '.lock', blocking=False) as locked:
+                    if locked:
+                        _log.info('Evicting %s (%d bytes) from the cache in %s.', digest, size, self.cache_dir)
+                        os.remove(entry + '.json')
+                        _remove(entry)
+                        total -= size
+
+    def _path(self, digest):
+        return os.path.join(self.cache_dir, digest)
+
+    def _fill(self, key, digest, fill):
+        entry = self._path(digest)
+        tmp = '{}.tmp-{}'.format(entry, uuid4())
+        start = time.time()
+        try:
+            fill(tmp)
+            size = _make_read_only(tmp)
+            with open(entry + '.json', 'w') as f:
+                json.dump(dict(key=key, size=size), f)
+            os.rename(tmp, entry)
+        finally:
+            if os.path.lexists(tmp):
+                _remove(tmp)
+                if os.path.exists(entry + '.json'):
+                    os.remove(entry + '.json')
+        _log.info('Cached %s (%d bytes) in %.1f seconds.', key, size, time.time() - start)
+
+
+@contextmanager
+def _flock(path, blocking=True):
+    """
+    Holds an exclusive lock on a file, creating the file if needed. Yields whether the lock was acquired, which can
+    only be False if not blocking.
+    """
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except IOError as e:
+            if blocking or e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _make_read_only(path):
+    """
+    Removes write permissions from the files below path so jobs can't modify them through their hard links
+
+    :return: Total size of the files in bytes
+    :rtype: int
+    """
+    paths = [path] if os.path.isfile(path) else [os.path.join(root, name)
+                                                 for root, _, names in os.walk(path) for name in names]
+    size = 0
+    for file_path in paths:
+        mode = os.stat(file_path).st_mode
+        os.chmod(file_path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        size += os.path.getsize(file_path)
+    return size
+
+
+def _hand_out(entry, dest):
+    """
+    Recreates a file or directory at dest from hard links of the files in entry, falling back to copies if entry and
+    dest are on different filesystems
+    """
+    if os.path.isfile(entry):
+        _link(entry, dest)
+        return
+    for root, dirs, names in os.walk(entry):
+        dest_root = os.path.join(dest, os.path.relpath(root, entry))
+        if not os.path.isdir(dest_root):
+            os.makedirs(dest_root)
+        for name in names:
+            _link(os.path.join(root, name), os.path.join(dest_root, name))
+
+
+def _link(src, dest):
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(src, dest)
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
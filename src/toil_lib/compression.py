@@ -0,0 +1,147 @@
+import struct
+import time
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+# Amount of uncompressed data in each independently compressed block, the same as pigz
+BLOCK_SIZE = 128 * 1024
+_HEADER_SIZE = 10
+
+
+class ParallelGzipWriter(object):
+    """
+    A write-only file object producing a gzip member whose blocks are compressed concurrently, like pigz -i.
+    Each block is compressed by its own raw deflate stream and ends with a sync flush, so the concatenated blocks form
+    one valid deflate stream that any gzip reader can decompress. The CRC is computed in order as data is written. More
+    members can be started with new_member, to make points that readers can seek to.
+
+    >>> import gzip, tempfile
+    >>> path = tempfile.mktemp()
+    >>> with ParallelGzipWriter(path, threads=2, block_size=4) as f:
+    ...     f.write('hello world')
+    >>> gzip.open(path).read()
+    'hello world'
+    """
+
+    def __init__(self, fileobj, compresslevel=9, threads=1, block_size=BLOCK_SIZE):
+        """
+        :param fileobj: Path or file object to write the gzip stream to. Paths are opened and closed by the writer.
+        :param int compresslevel: Compression level from 1 to 9, or 0 to store the data without compressing it
+        :param int threads: Number of threads compressing blocks, e.g. job.cores
+        :param int block_size: Amount of uncompressed data in each block
+        """
+        self._own_fileobj = isinstance(fileobj, basestring)
+        self.fileobj = open(fileobj, 'wb') if self._own_fileobj else fileobj
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.pool = ThreadPool(threads) if threads > 1 else None
+        self.threads = threads
+        self.closed = False
+        self._buffer = []
+        self._buffered = 0
+        self._pending = deque()
+        self._crc = 0
+        self._size = 0
+        self._total_size = 0
+        self.compressed_size = 0
+        self._write_header()
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self._size += len(data)
+        self._total_size += len(data)
+        self._crc = zlib.crc32(data, self._crc)
+        if self._buffered >= self.block_size:
+            data = ''.join(self._buffer)
+            for start in xrange(0, len(data) - self.block_size + 1, self.block_size):
+                self._submit(data[start:start + self.block_size])
+            rest = data[len(data) - len(data) % self.block_size:]
+            self._buffer = [rest] if rest else []
+            self._buffered = len(rest)
+
+    def tell(self):
+        """
+        :return: Number of uncompressed bytes written
+        :rtype: int
+        """
+        return self._total_size
+
+    def flush(self):
+        """
+        Compresses the buffered data as a block and writes all compressed blocks to the underlying file object
+        """
+        if self._buffered:
+            self._submit(''.join(self._buffer))
+            self._buffer, self._buffered = [], 0
+        self._drain(0)
+        self.fileobj.flush()
+
+    def new_member(self):
+        """
+        Ends the current gzip member and starts a new one, which can be decompressed on its own. Readers of the whole
+        stream see the data of all members concatenated.
+
+        :return: Offset of the new member in the compressed stream
+        :rtype: int
+        """
+        self._end_member()
+        self._crc = 0
+        self._size = 0
+        self._write_header()
+        return self.compressed_size - _HEADER_SIZE
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._end_member()
+        finally:
+            self.closed = True
+            if self.pool:
+                self.pool.terminate()
+            if self._own_fileobj:
+                self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _write_header(self):
+        extra_flags = 2 if self.compresslevel == 9 else 4 if self.compresslevel == 1 else 0
+        # No flags, no file name, and an OS of unknown
+        self._write('\037\213\010\000' + struct.pack('<I', int(time.time())) + chr(extra_flags) + '\377')
+
+    def _end_member(self):
+        self.flush()
+        # An empty final block ends the deflate stream
+        self._write(_compressor(self.compresslevel).flush())
+        self._write(struct.pack('<II', self._crc & 0xffffffff, self._size & 0xffffffff))
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.compressed_size += len(data)
+
+    def _submit(self, block):
+        if self.pool:
+            self._pending.append(self.pool.apply_async(_compress_block, (block, self.compresslevel)))
+            # Bound the memory held by blocks waiting to be written
+            self._drain(2 * self.threads)
+        else:
+            self._write(_compress_block(block, self.compresslevel))
+
+    def _drain(self, max_pending):
+        while len(self._pending) > max_pending:
+            self._write(self._pending.popleft().get())
+
+
+def _compressor(compresslevel):
+    return zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+
+def _compress_block(block, compresslevel):
+    compressor = _compressor(compresslevel)
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
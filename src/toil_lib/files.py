@@ -1,10 +1,29 @@
-from contextlib import closing
+import ctypes
+import errno
+import fcntl
+import gzip
+import json
 import os
 import shutil
 import tarfile
+from functools import partial
 
+from toil_lib import partitions, require
+from toil_lib.compression import ParallelGzipWriter
 
-def tarball_files(tar_name, file_paths, output_dir='.', prefix=''):
+# Ways of placing a file at another path, see link_file
+LINK_STRATEGIES = ('reflink', 'hardlink', 'symlink', 'copy')
+# Strategies that give an independent copy of the file
+DEFAULT_LINK_STRATEGIES = ('reflink', 'copy')
+
+# ioctl that makes a file share the extents of another, from linux/fs.h
+_FICLONE = 0x40049409
+# Errors meaning a strategy isn't supported for a pair of paths, so the next one should be tried
+_UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EMLINK, errno.ENOSYS,
+                errno.EBADF}
+
+
+def tarball_files(tar_name, file_paths, output_dir='.', prefix='', compresslevel=9, threads=1, seekable=False):
     """
     Creates a tarball from a group of files
 
@@ -12,13 +31,168 @@ def tarball_files(tar_name, file_paths, output_dir='.', prefix=''):
     :param list[str] file_paths: Absolute file paths to include in the tarball
     :param str output_dir: Output destination for tarball
     :param str prefix: Optional prefix for files in tarball
+    :param int compresslevel: gzip compression level from 1 to 9, or 0 to store files that are already compressed
+    :param int threads: Number of threads compressing the tarball, e.g. job.cores
+    :param bool seekable: If True, each file starts a new gzip member, and the offsets of the members are written to
+           an index next to the tarball, named tar_name + '.idx', for extract_member. The tarball remains readable by
+           any tar and gzip.
+    """
+    tar_path = os.path.join(output_dir, tar_name)
+    index = _write_tarball(tar_path, file_paths, prefix=prefix, compresslevel=compresslevel, threads=threads,
+                           seekable=seekable)
+    if seekable:
+        with open(tar_path + '.idx', 'w') as f:
+            json.dump(dict(members=index), f)
+
+
+def tarball_to_filestore(job, file_paths, prefix='', remove_inputs=False, compresslevel=9):
+    """
+    Creates a tarball from a group of files, streaming it into the FileStore without a local copy
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param list[str] file_paths: Absolute file paths to include in the tarball
+    :param str prefix: Optional prefix for files in tarball
+    :param bool remove_inputs: If True, each file is deleted as soon as it has been archived. Only use this for files
+           the job created, not for paths returned by readGlobalFile, which may be shared with Toil's cache.
+    :param int compresslevel: gzip compression level from 1 to 9, or 0 to store files that are already compressed
+    :return: FileStoreID of the tarball
+    :rtype: str
+    """
+    with job.fileStore.writeGlobalFileStream() as (f_raw, tar_id):
+        _write_tarball(f_raw, file_paths, prefix=prefix, compresslevel=compresslevel, threads=job.cores,
+                       remove_inputs=remove_inputs)
+    return tar_id
+
+
+def _write_tarball(fileobj, file_paths, prefix='', compresslevel=9, threads=1, seekable=False, remove_inputs=False):
+    """
+    Writes a gzipped tarball of a group of files
+
+    :param fileobj: Path or file object to write the tarball to
+    :return: Name, compressed offset and size of each file if seekable, otherwise an empty list
+    :rtype: list[dict]
     """
-    with tarfile.open(os.path.join(output_dir, tar_name), 'w:gz') as f_out:
-        for file_path in file_paths:
-            if not file_path.startswith('/'):
-                raise ValueError('Path provided is relative not absolute.')
-            arcname = prefix + os.path.basename(file_path)
-            f_out.add(file_path, arcname=arcname)
+    index = []
+    with ParallelGzipWriter(fileobj, compresslevel=compresslevel, threads=threads) as f_gz:
+        # Unlike 'w|', 'w' mode writes each entry as it's added, so members start where new_member was called
+        with tarfile.open(fileobj=f_gz, mode='w' if seekable else 'w|') as f_out:
+            for file_path in file_paths:
+                if not file_path.startswith('/'):
+                    raise ValueError('Path provided is relative not absolute.')
+                arcname = prefix + os.path.basename(file_path)
+                if seekable:
+                    index.append(dict(name=arcname, offset=f_gz.new_member(), size=os.path.getsize(file_path)))
+                f_out.add(file_path, arcname=arcname)
+                if remove_inputs:
+                    os.remove(file_path)
+            if seekable:
+                f_gz.new_member()
+    return index
+
+
+def extract_member(tar_path, member_name, output_dir, index_path=None):
+    """
+    Extracts one file from a tarball written by tarball_files with seekable=True, decompressing only that file
+
+    :param str tar_path: Path to the tarball
+    :param str member_name: Name of the file in the tarball
+    :param str output_dir: Directory to extract the file to
+    :param str index_path: Path to the index of the tarball, if not tar_path + '.idx'
+    :return: Path to the extracted file
+    :rtype: str
+    """
+    with open(index_path or tar_path + '.idx') as f:
+        offsets = {member['name']: member['offset'] for member in json.load(f)['members']}
+    require(member_name in offsets, '{} is not in the index of {}'.format(member_name, tar_path))
+    with open(tar_path, 'rb') as f:
+        f.seek(offsets[member_name])
+        # Reading stops after the first entry, which is at the start of the member
+        with tarfile.open(fileobj=gzip.GzipFile(fileobj=f, mode='rb'), mode='r|') as f_in:
+            tarinfo = f_in.next()
+            require(tarinfo is not None and tarinfo.name == member_name,
+                    'The index of {} does not match it at {}'.format(tar_path, member_name))
+            output_path = os.path.join(output_dir, os.path.basename(member_name))
+            with open(output_path, 'wb') as f_out:
+                shutil.copyfileobj(f_in.extractfile(tarinfo), f_out)
+    return output_path
+
+
+def link_file(src, dest, strategies=DEFAULT_LINK_STRATEGIES):
+    """
+    Places a file at another path with the first strategy that works for the two paths:
+
+    reflink: A copy-on-write clone sharing the data of src, on filesystems like Btrfs and XFS
+    hardlink: The same file under another name, which must not be modified
+    symlink: A link to the absolute path of src, which must not be modified. Docker containers can't follow symlinks
+             that point outside their mounted work directory.
+    copy: A copy made by the kernel, with copy_file_range or sendfile, without passing the data through Python
+
+    :param str src: Path of the file
+    :param str dest: Path to place the file at, which is replaced if it exists
+    :param tuple(str) strategies: Strategies to try, in order
+    :return: The strategy that was used
+    :rtype: str
+    """
+    require(strategies and set(strategies) <= set(LINK_STRATEGIES),
+            'Link strategies must be among {}, not {}.'.format(LINK_STRATEGIES, strategies))
+    real_path = lambda path: os.path.join(os.path.realpath(os.path.dirname(os.path.abspath(path))),
+                                          os.path.basename(path))
+    require(real_path(src) != real_path(dest), 'Cannot link {} to itself.'.format(src))
+    for i, strategy in enumerate(strategies):
+        if os.path.lexists(dest):
+            os.remove(dest)
+        try:
+            if strategy == 'reflink':
+                _reflink(src, dest)
+            elif strategy == 'hardlink':
+                os.link(src, dest)
+            elif strategy == 'symlink':
+                os.symlink(os.path.abspath(src), dest)
+            else:
+                _kernel_copy(src, dest)
+            return strategy
+        except (IOError, OSError) as e:
+            if e.errno not in _UNSUPPORTED or i == len(strategies) - 1:
+                raise
+            if os.path.lexists(dest):
+                os.remove(dest)
+
+
+def _reflink(src, dest):
+    with open(src, 'rb') as f_in, open(dest, 'wb') as f_out:
+        fcntl.ioctl(f_out.fileno(), _FICLONE, f_in.fileno())
+    shutil.copymode(src, dest)
+
+
+def _kernel_copy(src, dest):
+    """
+    Copies a file with copy_file_range, which can copy on the server for network filesystems, falling back to sendfile
+    and then to plain reads and writes. Each fallback continues from where the previous method stopped.
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    with open(src, 'rb') as f_in, open(dest, 'wb') as f_out:
+        fd_in, fd_out = f_in.fileno(), f_out.fileno()
+        remaining = os.fstat(fd_in).st_size
+        for name, args in [('copy_file_range', lambda n: (fd_in, None, fd_out, None, n, 0)),
+                           ('sendfile', lambda n: (fd_out, fd_in, None, n))]:
+            function = getattr(libc, name, None)
+            if function is None:
+                continue
+            function.restype = ctypes.c_ssize_t
+            while remaining:
+                copied = function(*args(ctypes.c_size_t(min(remaining, 1 << 30))))
+                if copied <= 0:
+                    break
+                remaining -= copied
+            if not remaining:
+                break
+        while remaining:
+            chunk = os.read(fd_in, min(remaining, 1 << 20))
+            if not chunk:
+                break
+            os.write(fd_out, chunk)
+            remaining -= len(chunk)
+    shutil.copymode(src, dest)
 
 
 def __forall_files(file_paths, output_dir, op):
@@ -35,7 +209,7 @@ def __forall_files(file_paths, output_dir, op):
         op(file_path, dest)
 
 
-def copy_file_job(job, name, file_id, output_dir):
+def copy_file_job(job, name, file_id, output_dir, strategies=DEFAULT_LINK_STRATEGIES):
     """
     Job version of move_files for one file
 
@@ -43,10 +217,11 @@ def copy_file_job(job, name, file_id, output_dir):
     :param str name: Name of output file (including extension)
     :param str file_id: FileStoreID of file
     :param str output_dir: Location to place output file
+    :param tuple(str) strategies: Link strategies to try, see link_file
     """
     work_dir = job.fileStore.getLocalTempDir()
     fpath = job.fileStore.readGlobalFile(file_id, os.path.join(work_dir, name))
-    copy_files([fpath], output_dir)
+    copy_files([fpath], output_dir, strategies=strategies)
 
 
 def move_files(file_paths, output_dir):
@@ -66,26 +241,40 @@ def move_files(file_paths, output_dir):
     __forall_files(file_paths, output_dir, shutil.move)
 
 
-def copy_files(file_paths, output_dir):
+def copy_files(file_paths, output_dir, strategies=DEFAULT_LINK_STRATEGIES):
     """
     Moves files from the working directory to the output directory.
 
     :param str output_dir: Output directory
     :param list[str] file_paths: Absolute file paths to move
+    :param tuple(str) strategies: Link strategies to try, see link_file
     """
-    __forall_files(file_paths, output_dir, shutil.copy)
+    __forall_files(file_paths, output_dir, partial(link_file, strategies=strategies))
 
 
-def consolidate_tarballs_job(job, fname_to_id):
+def consolidate_tarballs_job(job, fname_to_id, stream=False):
     """
     Combine the contents of separate tarballs into one.
     Subdirs within the tarball will be named the keys in **fname_to_id
 
     :param JobFunctionWrappingJob job: passed automatically by Toil
     :param dict[str,str] fname_to_id: Dictionary of the form: file-name-prefix=FileStoreID
+    :param bool stream: If True, the tarballs are read from and written to FileStore streams instead of local disk,
+           and compressed with job.cores threads
     :return: The file store ID of the generated tarball
     :rtype: str
     """
+    # output_name is arbitrary as this job function returns a FileStoreId
+    output_name = 'foo.tar.gz'
+    if stream:
+        with job.fileStore.writeGlobalFileStream() as (f_raw, out_id):
+            with ParallelGzipWriter(f_raw, threads=job.cores) as f_gz:
+                with tarfile.open(fileobj=f_gz, mode='w|') as f_out:
+                    for fname, file_store_id in fname_to_id.iteritems():
+                        with job.fileStore.readGlobalFileStream(file_store_id) as f_stream:
+                            with tarfile.open(fileobj=f_stream, mode='r|*') as f_in:
+                                _copy_members(f_in, f_out, os.path.join(output_name, fname))
+        return out_id
     work_dir = job.fileStore.getLocalTempDir()
     # Retrieve output file paths to consolidate
     tar_paths = []
@@ -93,15 +282,89 @@ def consolidate_tarballs_job(job, fname_to_id):
         p = job.fileStore.readGlobalFile(file_store_id, os.path.join(work_dir, fname + '.tar.gz'))
         tar_paths.append((p, fname))
     # I/O
-    # output_name is arbitrary as this job function returns a FileStoreId
-    output_name = 'foo.tar.gz'
     out_tar = os.path.join(work_dir, output_name)
     # Consolidate separate tarballs into one
     with tarfile.open(os.path.join(work_dir, out_tar), 'w:gz') as f_out:
         for tar, fname in tar_paths:
             with tarfile.open(tar, 'r') as f_in:
-                for tarinfo in f_in:
-                    with closing(f_in.extractfile(tarinfo)) as f_in_file:
-                        tarinfo.name = os.path.join(output_name, fname, os.path.basename(tarinfo.name))
-                        f_out.addfile(tarinfo, fileobj=f_in_file)
+                _copy_members(f_in, f_out, os.path.join(output_name, fname))
     return job.fileStore.writeGlobalFile(out_tar)
+
+
+def consolidate_tarballs_tree_job(job, fname_to_id, fan_in=20):
+    """
+    Tree-merge version of consolidate_tarballs_job for many tarballs, producing the same tarball. Leaf jobs recompress
+    up to fan_in tarballs each into a fragment: a gzip member holding tar entries without the end-of-archive marker.
+    Since concatenated gzip members form a valid gzip file, and concatenated tar entries a valid tar stream, the jobs
+    above merely concatenate the fragments of their children, and the root appends the end-of-archive marker.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param dict[str,str] fname_to_id: Dictionary of the form: file-name-prefix=FileStoreID
+    :param int fan_in: Maximum number of tarballs per leaf and of fragments per concatenation
+    :return: The file store ID of the generated tarball
+    :rtype: str
+    """
+    require(fan_in > 1, 'fan_in must be greater than 1.')
+    return job.addChildJobFn(_tarball_fragment_job, sorted(fname_to_id.items()), fan_in, True).rv()
+
+
+def _tarball_fragment_job(job, items, fan_in, root=False):
+    """
+    Writes the members of a list of tarballs as a fragment, directly or by concatenating the fragments of subtrees
+
+    :param list[tuple(str,str)] items: File name prefix and FileStoreID of each tarball
+    :param bool root: Whether to end the fragment with the end-of-archive marker, making it a complete tarball
+    :return: FileStoreID of the fragment
+    :rtype: str
+    """
+    if len(items) > fan_in:
+        groups = list(partitions(items, -(-len(items) // fan_in)))
+        fragment_ids = [job.addChildJobFn(_tarball_fragment_job, group, fan_in).rv() for group in groups]
+        return job.addFollowOnJobFn(_concatenate_fragments_job, fragment_ids, root).rv()
+    output_name = 'foo.tar.gz'
+    with job.fileStore.writeGlobalFileStream() as (f_raw, out_id):
+        with ParallelGzipWriter(f_raw, threads=job.cores) as f_gz:
+            # A TarFile in 'w' mode writes entries as they are added, and writes the end-of-archive marker on close
+            f_out = tarfile.open(fileobj=f_gz, mode='w')
+            for fname, file_store_id in items:
+                with job.fileStore.readGlobalFileStream(file_store_id) as f_stream:
+                    with tarfile.open(fileobj=f_stream, mode='r|*') as f_in:
+                        _copy_members(f_in, f_out, os.path.join(output_name, fname))
+            if root:
+                f_out.close()
+    return out_id
+
+
+def _concatenate_fragments_job(job, fragment_ids, root=False):
+    """
+    Concatenates fragments without decompressing them, then deletes them
+
+    :param list[str] fragment_ids: FileStoreIDs of the fragments
+    :param bool root: Whether to append the end-of-archive marker
+    :return: FileStoreID of the concatenated fragment
+    :rtype: str
+    """
+    with job.fileStore.writeGlobalFileStream() as (f_out, out_id):
+        for fragment_id in fragment_ids:
+            with job.fileStore.readGlobalFileStream(fragment_id) as f_in:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        if root:
+            with ParallelGzipWriter(f_out) as f_gz:
+                f_gz.write(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+    for fragment_id in fragment_ids:
+        job.fileStore.deleteGlobalFile(fragment_id)
+    return out_id
+
+
+def _copy_members(f_in, f_out, dirname):
+    """
+    Adds the members of a tarball to another one, placing them directly below a directory
+
+    :param tarfile.TarFile f_in: Tarball to read, which may be a stream
+    :param tarfile.TarFile f_out: Tarball to write to
+    :param str dirname: Directory of the members in f_out
+    """
+    for tarinfo in f_in:
+        f_in_file = f_in.extractfile(tarinfo) if tarinfo.isreg() else None
+        tarinfo.name = os.path.join(dirname, os.path.basename(tarinfo.name))
+        f_out.addfile(tarinfo, fileobj=f_in_file)
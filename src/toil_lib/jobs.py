@@ -1,4 +1,7 @@
-from toil_lib import partitions
+import heapq
+import itertools
+
+from toil_lib import partitions, require
 
 
 def map_job(job, func, inputs, *args):
@@ -21,3 +24,182 @@ def map_job(job, func, inputs, *args):
     else:
         for sample in inputs:
             job.addChildJobFn(func, sample, *args)
+
+
+def balanced_map_job(job, func, inputs, args=(), branching_factor=100, weights=None, leaf_batch=1,
+                     requirements=None):
+    """
+    Spawns a balanced tree of jobs calling func for every sample. Unlike map_job, every sample is run at the same depth,
+    no job has more than branching_factor children, and small samples can be batched to save per-job overhead.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param function func: Function to spawn dynamically, passes one sample as first argument
+    :param list inputs: Array of samples to be batched
+    :param tuple args: any arguments to be passed to the function
+    :param int branching_factor: Maximum number of children of each job in the tree
+    :param list[float] weights: Cost of each sample, e.g. its file size. Samples are batched so that each batch has
+           about the same total cost.
+    :param int leaf_batch: Average number of samples each leaf job runs one after the other
+    :param function requirements: Function of a sample returning the cores, memory and disk of its job as a dict, e.g.
+           from toil_lib.tools.resources.resource_estimator. Batches get the most cores and memory of their samples and
+           the sum of their disk. It must be picklable, like a module-level function or a partial of one.
+    """
+    require(branching_factor > 1, 'branching_factor must be greater than 1.')
+    require(leaf_batch >= 1, 'leaf_batch must be at least 1.')
+    require(weights is None or len(weights) == len(inputs), 'There must be one weight per sample.')
+    if not inputs:
+        return
+    batches = _batch_by_weight(inputs, weights or [1] * len(inputs), -(-len(inputs) // leaf_batch))
+    job.addChildJobFn(_map_tree_job, func, batches, _tree_depth(len(batches), branching_factor), branching_factor,
+                      args, requirements)
+
+
+def map_manifest_job(job, func, manifest, args=(), branching_factor=100, requirements=None):
+    """
+    Spawns a tree of jobs calling func for every sample of a Manifest. Each job is only passed a byte range of the
+    manifest and reads at most branching_factor + 1 samples from it, so neither the job store nor the leader ever holds
+    the whole list of samples.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param function func: Function to spawn dynamically, passes one sample as first argument
+    :param Manifest manifest: Samples to run func on
+    :param tuple args: any arguments to be passed to the function
+    :param int branching_factor: Maximum number of children of each job in the tree
+    :param function requirements: Function of a sample returning the cores, memory and disk of its job as a dict
+    """
+    require(branching_factor > 1, 'branching_factor must be greater than 1.')
+    samples = list(itertools.islice(manifest.samples(job), branching_factor + 1))
+    if len(samples) <= branching_factor:
+        for sample in samples:
+            job.addChildJobFn(func, sample, *args, **_requirements(requirements, [sample]))
+    else:
+        for part in manifest.split(branching_factor):
+            job.addChildJobFn(map_manifest_job, func, part, args, branching_factor, requirements)
+
+
+def map_reduce_job(job, map_fn, reduce_fn, inputs, fan_in=10, args=(), requirements=None):
+    """
+    Maps a function over samples and reduces the results in a tree. Every job of the tree has at most fan_in children,
+    and each one's follow-on reduces the results of that job's children, so no job handles more than fan_in results.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param function map_fn: Job function called with a sample and args, returning a result
+    :param function reduce_fn: Job function called with a list of results, returning their combination, which is
+           passed to reduce_fn again further up the tree. It should be associative, since results are grouped by
+           subtree.
+    :param list inputs: Samples to map over
+    :param int fan_in: Maximum number of results combined by one call of reduce_fn
+    :param tuple args: Arguments passed to map_fn after each sample
+    :param function requirements: Function of a sample returning the cores, memory and disk of its map job as a dict
+    :return: The combination of the results of all samples
+    """
+    require(fan_in > 1, 'fan_in must be greater than 1.')
+    require(inputs, 'map_reduce_job needs at least one sample.')
+    return job.addChildJobFn(_map_reduce_tree_job, map_fn, reduce_fn, inputs, _tree_depth(len(inputs), fan_in),
+                             fan_in, args, requirements).rv()
+
+
+def _map_reduce_tree_job(job, map_fn, reduce_fn, inputs, depth, fan_in, args, requirements=None):
+    """
+    Maps and reduces the samples of a subtree with depth levels
+
+    :return: Promise of the reduced result of the subtree
+    """
+    if depth == 1:
+        results = [job.addChildJobFn(map_fn, sample, *args, **_requirements(requirements, [sample])).rv()
+                   for sample in inputs]
+    else:
+        num_children = -(-len(inputs) // fan_in ** (depth - 1))
+        results = [job.addChildJobFn(_map_reduce_tree_job, map_fn, reduce_fn, group, depth - 1, fan_in, args,
+                                     requirements).rv()
+                   for group in _split_evenly(inputs, num_children)]
+    return job.addFollowOnJobFn(reduce_fn, results).rv()
+
+
+def _map_tree_job(job, func, batches, depth, branching_factor, args, requirements=None):
+    """
+    Spawns the subtree for a list of batches, such that every batch is run depth levels below this job
+
+    :param list[list] batches: Batches of samples
+    :param int depth: Number of levels of the subtree
+    """
+    if depth == 1:
+        for batch in batches:
+            if len(batch) == 1:
+                job.addChildJobFn(func, batch[0], *args, **_requirements(requirements, batch))
+            else:
+                job.addChildJobFn(_run_batch_job, func, batch, args, **_requirements(requirements, batch))
+    else:
+        # Use as few children as the remaining depth allows, to avoid chains of single children
+        num_children = -(-len(batches) // branching_factor ** (depth - 1))
+        for group in _split_evenly(batches, num_children):
+            job.addChildJobFn(_map_tree_job, func, group, depth - 1, branching_factor, args, requirements)
+
+
+def _run_batch_job(job, func, batch, args):
+    """
+    Calls a job function for each sample of a batch, one after the other
+    """
+    for sample in batch:
+        func(job, sample, *args)
+
+
+def _requirements(requirements, batch):
+    """
+    Combines the requirements of the samples of a batch that runs them one after the other
+
+    >>> sorted(_requirements(lambda x: dict(cores=x, memory=x, disk=x), [1, 3]).items())
+    [('cores', 3), ('disk', 4), ('memory', 3)]
+
+    :return: Keyword arguments for addChildJobFn, empty if requirements is None
+    :rtype: dict[str,int]
+    """
+    if requirements is None:
+        return {}
+    estimates = [requirements(sample) for sample in batch]
+    return dict(cores=max(e['cores'] for e in estimates),
+                memory=max(e['memory'] for e in estimates),
+                disk=sum(e['disk'] for e in estimates))
+
+
+def _tree_depth(num_leaves, branching_factor):
+    """
+    >>> [_tree_depth(n, 10) for n in [1, 10, 11, 100, 101]]
+    [1, 1, 2, 2, 3]
+    """
+    depth = 1
+    while branching_factor ** depth < num_leaves:
+        depth += 1
+    return depth
+
+
+def _split_evenly(items, num_groups):
+    """
+    >>> _split_evenly(range(5), 2)
+    [[0, 1, 2], [3, 4]]
+    """
+    size, remainder = divmod(len(items), num_groups)
+    groups, start = [], 0
+    for i in xrange(num_groups):
+        end = start + size + (1 if i < remainder else 0)
+        groups.append(items[start:end])
+        start = end
+    return groups
+
+
+def _batch_by_weight(inputs, weights, num_batches):
+    """
+    Splits samples into batches of about equal total weight, by adding each sample, heaviest first, to the lightest
+    batch
+
+    >>> _batch_by_weight(['a', 'b', 'c', 'd'], [5, 1, 2, 2], 2)
+    [['a'], ['c', 'd', 'b']]
+    """
+    num_batches = min(num_batches, len(inputs))
+    heap = [(0, i) for i in xrange(num_batches)]
+    batches = [[] for _ in xrange(num_batches)]
+    for weight, sample in sorted(zip(weights, inputs), key=lambda x: -x[0]):
+        total, i = heapq.heappop(heap)
+        batches[i].append(sample)
+        heapq.heappush(heap, (total + weight, i))
+    return batches
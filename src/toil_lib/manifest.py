@@ -0,0 +1,105 @@
+import os
+
+
+class Manifest(object):
+    """
+    A list of samples stored once in the FileStore, one per line, such as TSV rows or URLs. A Manifest only holds the
+    FileStoreID and a byte range of the file, so passing it to child jobs costs the same for any number of samples.
+    A range owns the lines that start within it, which lets it be split without reading the file. Blank lines and lines
+    starting with '#' are skipped.
+    """
+
+    def __init__(self, file_id, start, end, sep='\t'):
+        """
+        :param str file_id: FileStoreID of the manifest file
+        :param int start: Offset of the first byte of the range
+        :param int end: Offset after the last byte of the range
+        :param str sep: Column separator, or None to read each line as a single string
+        """
+        self.file_id = file_id
+        self.start = start
+        self.end = end
+        self.sep = sep
+
+    @classmethod
+    def write(cls, job, samples, sep='\t'):
+        """
+        Writes samples to the FileStore as a manifest
+
+        :param JobFunctionWrappingJob job: passed automatically by Toil
+        :param iterable samples: Samples, each a string or a sequence of columns. May be a generator.
+        :param str sep: Column separator, or None if every sample is a single string
+        :rtype: Manifest
+        """
+        size = 0
+        with job.fileStore.writeGlobalFileStream() as (f, file_id):
+            for sample in samples:
+                line = (sample if isinstance(sample, basestring) else sep.join(map(str, sample))) + '\n'
+                f.write(line)
+                size += len(line)
+        return cls(file_id, 0, size, sep=sep)
+
+    @classmethod
+    def from_path(cls, job, path, sep='\t'):
+        """
+        Stores a local manifest file, such as a TSV or a list of URLs, in the FileStore
+
+        :param JobFunctionWrappingJob job: passed automatically by Toil
+        :param str path: Path to the manifest file
+        :param str sep: Column separator, or None to read each line as a single string
+        :rtype: Manifest
+        """
+        return cls(job.fileStore.writeGlobalFile(path), 0, os.path.getsize(path), sep=sep)
+
+    def split(self, num_parts):
+        """
+        Splits the range into parts of equal size in bytes. Parts may hold different numbers of samples, or none.
+
+        :param int num_parts: Number of parts
+        :rtype: list[Manifest]
+        """
+        num_parts = max(1, min(num_parts, self.end - self.start))
+        bounds = [self.start + (self.end - self.start) * i // num_parts for i in xrange(num_parts + 1)]
+        return [Manifest(self.file_id, start, end, sep=self.sep) for start, end in zip(bounds, bounds[1:])]
+
+    def samples(self, job):
+        """
+        Reads the samples in the range, lazily. The manifest is streamed from the FileStore, and only the range and the
+        rest of its last line are read. Streams that can't seek, such as those of some job stores, are read from the
+        start of the file but not past the range.
+
+        :param JobFunctionWrappingJob job: passed automatically by Toil
+        :return: Each sample, as a list of columns or, without a separator, a string
+        :rtype: iterator
+        """
+        with job.fileStore.readGlobalFileStream(self.file_id) as f:
+            offset = max(0, self.start - 1)
+            _seek(f, offset)
+            if self.start:
+                # Skip the line that started in the previous range, unless it ended right before this one
+                offset += len(f.readline())
+            while offset < self.end:
+                line = f.readline()
+                if not line:
+                    break
+                offset += len(line)
+                line = line.rstrip('\r\n')
+                if line and not line.startswith('#'):
+                    yield line.split(self.sep) if self.sep else line
+
+    def __repr__(self):
+        return 'Manifest({!r}, {}, {}, sep={!r})'.format(self.file_id, self.start, self.end, self.sep)
+
+
+def _seek(f, offset, chunk_size=1024 * 1024):
+    """
+    Moves to an offset from the start of a file object, reading up to it if the file object can't seek
+    """
+    try:
+        f.seek(offset)
+    except (AttributeError, IOError):
+        while offset:
+            chunk = f.read(min(offset, chunk_size))
+            if not chunk:
+                break
+            offset -= len(chunk)
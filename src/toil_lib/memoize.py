@@ -0,0 +1,249 @@
+import cPickle
+import hashlib
+import inspect
+import json
+import logging
+import os
+from functools import wraps
+
+from toil_lib.cache import NodeCache, _flock, _link, _remove
+
+_log = logging.getLogger(__name__)
+
+# Changing this invalidates every memoized result, e.g. when the layout of the entries changes
+_VERSION = 2
+_STATS = '.memoize-stats'
+
+
+def default_memo_dir():
+    """
+    :return: The directory of memoized results from the TOIL_LIB_MEMO_DIR environment variable, or None if unset
+    :rtype: str
+    """
+    return os.environ.get('TOIL_LIB_MEMO_DIR') or None
+
+
+def memoize(images=(), file_args=(), file_results=(), cache_dir=None, max_size=None):
+    """
+    Decorates a job function so its result is reused whenever it is called again with the same inputs, in this or any
+    later workflow. Results are keyed on the content of the input files, the versions of the input URLs, the image
+    tags, the executor the tools run with and the other arguments, and the files they reference are kept in a
+    NodeCache, which evicts the least recently used results beyond its size budget. The function runs without holding
+    a lock on the cache, and its result is then renamed into place, so concurrent calls with the same key may each
+    compute it, in which case the first one to finish stores it. Without a cache directory, the function is simply
+    called, and so is it if the version of an input URL can't be determined.
+
+    The result may be a FileStoreID, or any picklable value such as a tuple or dict of FileStoreIDs. Results holding
+    promises, e.g. of child jobs, are never memoized. Input files are recognized as FileIDs or as the strings passed for
+    file_args, and output files as FileIDs or as the strings that file_results points at. Nothing else is looked up in
+    the job store.
+
+    The files of a result are hard linked from Toil's cache into the memo directory, and from there into the work
+    directory of jobs that reuse it, so memoizing takes no extra disk when the memo directory, Toil's work directory
+    and, for file job stores, the job store are on one filesystem. Otherwise each file is copied once into the memo
+    directory when it is stored and once into the work directory when it is reused, which the disk requirement of the
+    decorated job must allow for.
+
+    :param list[str] images: Pinned tags of the Docker images the function runs
+    :param list[str] file_args: Names of the parameters that hold FileStoreIDs, which also apply to the attributes of
+           config objects and the keys of dicts passed to the function
+    :param list file_results: Indices of a tuple or list result, or keys of a dict result, that hold FileStoreIDs or
+           lists of them. Indices beyond the end of a shorter result are ignored. Include None if the result itself is
+           a FileStoreID.
+    :param str cache_dir: Directory of the memoized results, which should outlive the workflow. If None, the one named
+           by the TOIL_LIB_MEMO_DIR environment variable is used, if set.
+    :param int max_size: Size budget of the cache in bytes
+    :return: Decorator for job functions
+    :rtype: function
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(job, *args, **kwargs):
+            memo_dir = cache_dir or default_memo_dir()
+            if not memo_dir:
+                return func(job, *args, **kwargs)
+            cache = NodeCache(memo_dir, max_size=max_size)
+            try:
+                key = _memo_key(job, memo_dir, func, images, file_args, args, kwargs)
+            except _Uncacheable as e:
+                _log.info('Inputs of %s are not memoized: %s', func.__name__, e)
+                return func(job, *args, **kwargs)
+            dest = os.path.join(job.fileStore.getLocalTempDir(), 'memoized')
+            if cache.lookup(key, dest):
+                _count(memo_dir, hit=True)
+                job.fileStore.logToMaster('Memoized result of {} reused.'.format(func.__name__))
+                return _load(job, dest)
+            result = func(job, *args, **kwargs)
+            staging = cache.staging_path()
+            try:
+                _store(job, result, file_results, staging)
+            except _Uncacheable:
+                _log.info('Result of %s holds promises and is not memoized.', func.__name__)
+            else:
+                cache.put(key, staging)
+                job.fileStore.logToMaster('Memoized result of {} stored.'.format(func.__name__))
+            finally:
+                if os.path.lexists(staging):
+                    _remove(staging)
+            _count(memo_dir, hit=False)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def memo_stats(cache_dir=None):
+    """
+    :param str cache_dir: Directory of the memoized results, or None for the one named by TOIL_LIB_MEMO_DIR
+    :return: Number of memoized results reused (hits) and computed (misses) by all jobs using the directory
+    :rtype: dict[str,int]
+    """
+    cache_dir = cache_dir or default_memo_dir()
+    try:
+        with open(os.path.join(cache_dir, _STATS)) as f:
+            return json.load(f)
+    except (IOError, ValueError, TypeError, AttributeError):
+        return dict(hits=0, misses=0)
+
+
+class _Uncacheable(Exception):
+    pass
+
+
+class _CachedFile(object):
+    """
+    Stands in for a FileStoreID in a stored result
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+
+def _memo_key(job, cache_dir, func, images, file_args, args, kwargs):
+    from toil.fileStore import FileID
+    from toil_lib.programs import MockExecutor, default_executor, mock_mode
+
+    def value(x, name=None):
+        if isinstance(x, FileID) or name in file_args and isinstance(x, basestring):
+            return 'file:' + _content_hash(job, x, cache_dir)
+        if isinstance(x, basestring) and '://' in x:
+            return 'url:' + x + '\n' + _versioned_url(x)
+        if isinstance(x, (list, tuple)):
+            return [value(v, name) for v in x]
+        if isinstance(x, dict):
+            return sorted([value(k), value(v, k)] for k, v in x.iteritems())
+        if hasattr(x, '__dict__') and not callable(x):
+            # Config objects, such as an argparse Namespace
+            return [type(x).__name__, value(vars(x))]
+        return repr(x)
+
+    call_args = inspect.getcallargs(func, job, *args, **kwargs)
+    del call_args[inspect.getargspec(func).args[0]]
+    # Results of mock runs, or of tools run outside of Docker, must not be reused by real runs
+    executor = MockExecutor() if mock_mode() else default_executor()
+    return json.dumps([_VERSION, func.__module__, func.__name__, list(images), value(executor), value(call_args)])
+
+
+def _versioned_url(url):
+    """
+    :return: The version of the file behind a URL, such as its ETag
+    :raises _Uncacheable: If the version can't be determined
+    """
+    from toil_lib import urls
+    try:
+        version = urls._url_version(url)
+    except Exception as e:
+        raise _Uncacheable('Could not determine the version of {}: {}'.format(url, e))
+    if not version:
+        raise _Uncacheable('Could not determine the version of {}'.format(url))
+    return version
+
+
+def _content_hash(job, file_id, cache_dir):
+    """
+    Computes the SHA1 of a file in the job store. Files in the job store don't change, so the hash is remembered for
+    the rest of the workflow, which includes restarts.
+    """
+    memo_path = os.path.join(cache_dir, '.hashes',
+                             hashlib.sha1(job.fileStore.jobStore.config.workflowID + '\n' + file_id).hexdigest())
+    if os.path.exists(memo_path):
+        with open(memo_path) as f:
+            return f.read()
+    sha1 = hashlib.sha1()
+    with job.fileStore.readGlobalFileStream(file_id) as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            sha1.update(chunk)
+    if not os.path.isdir(os.path.dirname(memo_path)):
+        try:
+            os.makedirs(os.path.dirname(memo_path))
+        except OSError:
+            pass
+    tmp = '{}.tmp-{}'.format(memo_path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(sha1.hexdigest())
+    os.rename(tmp, memo_path)
+    return sha1.hexdigest()
+
+
+def _store(job, result, file_results, path):
+    """
+    Creates a directory holding the files of a result and the result itself, in which they are replaced by _CachedFiles
+    """
+    from toil.fileStore import FileID
+    from toil.job import Promise
+    os.mkdir(path)
+    files = []
+
+    def encode(x, is_file=False):
+        if isinstance(x, Promise):
+            raise _Uncacheable()
+        if type(x) in (list, tuple):
+            return type(x)(encode(v, is_file) for v in x)
+        if type(x) is dict:
+            return {k: encode(v, is_file) for k, v in x.iteritems()}
+        if isinstance(x, FileID) or is_file and isinstance(x, basestring):
+            # An immutable read is a hard link of the file in Toil's cache
+            _link(job.fileStore.readGlobalFile(x, mutable=False), os.path.join(path, str(len(files))))
+            files.append(x)
+            return _CachedFile(len(files) - 1)
+        return x
+
+    if None in file_results:
+        encoded = encode(result, is_file=True)
+    elif type(result) in (list, tuple):
+        encoded = type(result)(encode(v, i in file_results) for i, v in enumerate(result))
+    elif type(result) is dict:
+        encoded = {k: encode(v, k in file_results) for k, v in result.iteritems()}
+    else:
+        encoded = encode(result)
+    with open(os.path.join(path, 'result.pickle'), 'wb') as f:
+        cPickle.dump(encoded, f, cPickle.HIGHEST_PROTOCOL)
+
+
+def _load(job, path):
+    """
+    Writes the files of a stored result to the FileStore and returns the result with their new FileStoreIDs. The files
+    are the hard links handed out by the NodeCache, which Toil links into file job stores on the same filesystem.
+    """
+    def decode(x):
+        if isinstance(x, _CachedFile):
+            return job.fileStore.writeGlobalFile(os.path.join(path, str(x.index)))
+        if type(x) in (list, tuple):
+            return type(x)(decode(v) for v in x)
+        if type(x) is dict:
+            return {k: decode(v) for k, v in x.iteritems()}
+        return x
+
+    with open(os.path.join(path, 'result.pickle'), 'rb') as f:
+        return decode(cPickle.load(f))
+
+
+def _count(cache_dir, hit):
+    path = os.path.join(cache_dir, _STATS)
+    with _flock(path + '.lock'):
+        stats = memo_stats(cache_dir)
+        stats['hits' if hit else 'misses'] += 1
+        with open(path + '.tmp', 'w') as f:
+            json.dump(stats, f)
+        os.rename(path + '.tmp', path)
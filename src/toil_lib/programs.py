@@ -1,10 +1,58 @@
+import functools
+import json
 import os
+import re
 import subprocess
 import logging
+import shutil
+import tempfile
+import threading
+import time
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+from stat import S_ISDIR
+from uuid import uuid4
+
 from bd2k.util.exceptions import panic
 
+from toil_lib import require
+
 _log = logging.getLogger(__name__)
 
+# Strategies for handing ownership of files written by a container back to the invoking user:
+#   'user'    runs the container as the invoking UID/GID so no fix-up is needed
+#   'created' runs the container as root and chowns only the files and directories it created, found by comparing the
+#             work directory with a listing of its top level taken before the container started
+#   'chown'   runs the container as root and recursively chowns the whole work directory
+PERMISSION_STRATEGIES = ('user', 'created', 'chown')
+
+# Repositories of images that cannot run as an arbitrary UID. The 'user' strategy falls back to 'created' for these.
+# GeneTorrent writes its state under the home directory, which does not exist for an arbitrary UID.
+ROOT_REQUIRED_TOOLS = {'quay.io/ucsc_cgl/genetorrent'}
+
+# Maximum number of paths passed to a single chown invocation
+_CHOWN_BATCH_SIZE = 1000
+
+# Seconds that docker calls in this process spent blocked on pulling their image, keyed by image
+pull_waits = defaultdict(float)
+
+# Resource usage of a single docker call. Times are in seconds and sizes in bytes. The usage fields are None when the
+# container's cgroup could not be read. run_time is how long the container itself ran, as recorded by Docker, and is
+# None for calls made in a DockerSession.
+ContainerMetrics = namedtuple('ContainerMetrics', ['tool', 'wall_time', 'pull_time', 'cpu_time', 'peak_rss',
+                                                   'bytes_read', 'bytes_written', 'run_time'])
+
+_CGROUP_ROOT = '/sys/fs/cgroup'
+
+# Matches references to the /data mount point at the start of an argument or after a '=', ':' or ','
+_DATA_PATH = re.compile(r'(^|[=:,])/data(?=/|$)')
+
+# Images known to be present locally, and locks that keep concurrent calls in this process from pulling twice
+_present_images = set()
+_pull_locks = defaultdict(threading.Lock)
+
 
 def mock_mode():
     """
@@ -25,7 +73,12 @@ def docker_call(tool,
                 outputs=None,
                 docker_parameters=None,
                 check_output=False,
-                mock=None):
+                mock=None,
+                session=None,
+                permissions='created',
+                metrics=None,
+                job=None,
+                executor=None):
     """
     Calls Docker, passing along parameters and tool.
 
@@ -43,8 +96,18 @@ def docker_call(tool,
     :param bool check_output: When True, this function returns docker's output
     :param bool mock: Whether to run in mock mode. If this variable is unset, its value will be determined by
                       the environment variable.
+    :param DockerSession session: If provided, the command is run via `docker exec` in the session's running
+                                  container instead of in a fresh one. `rm` and `docker_parameters` are ignored,
+                                  and permissions are fixed once when the session is closed. A DockerSessions pool
+                                  may be passed instead, in which case its session for the tool is used. Executors
+                                  other than DockerExecutor ignore the session.
+    :param str permissions: How ownership of files written by the tool is restored. One of PERMISSION_STRATEGIES.
+                            Tools in ROOT_REQUIRED_TOOLS always run as root.
+    :param list metrics: If provided, a ContainerMetrics record of the call's resource usage is appended to it
+    :param JobFunctionWrappingJob job: If provided, the call's resource usage is logged to the leader as JSON
+    :param Executor executor: How the tool is run. Defaults to MockExecutor in mock mode and to default_executor()
+                              otherwise.
     """
-    from toil_lib.urls import download_url
 
     if mock is None:
         mock = mock_mode()
@@ -58,8 +121,190 @@ def docker_call(tool,
     for filename in inputs:
         assert(os.path.isfile(os.path.join(work_dir, filename)))
 
-    if mock:
-        for filename, url in outputs.items():
+    require(permissions in PERMISSION_STRATEGIES,
+            'Permission strategy must be one of {}, not {}.'.format(PERMISSION_STRATEGIES, permissions))
+    permissions = _resolve_permissions(tool, permissions)
+
+    if executor is None:
+        executor = MockExecutor() if mock else default_executor()
+    output = executor.call(tool, parameters, work_dir, env=env, outfile=outfile, check_output=check_output,
+                           outputs=outputs, rm=rm, docker_parameters=docker_parameters, session=session,
+                           permissions=permissions, metrics=metrics, job=job)
+
+    for filename in outputs.keys():
+        if not os.path.isabs(filename):
+            filename = os.path.join(work_dir, filename)
+        assert(os.path.isfile(filename))
+
+    return output
+
+
+class Executor(object):
+    """
+    Runs the tools called through docker_call and docker_pipeline. Tools are always named by their Docker image and
+    refer to files in the work directory as /data/..., and each executor decides how to honour that.
+    """
+
+    def call(self, tool, parameters, work_dir, env=None, outfile=None, check_output=False, outputs=None, rm=True,
+             docker_parameters=None, session=None, permissions='created', metrics=None, job=None):
+        """
+        Runs a tool once. Arguments are as for docker_call, and executors ignore those that don't apply to them.
+
+        :return: The tool's output if check_output is True
+        :rtype: str
+        """
+        raise NotImplementedError()
+
+    def pipeline(self, stages, work_dir, env=None, permissions='created'):
+        """
+        Prepares tools to be run connected stdout-to-stdin. Arguments are as for docker_pipeline.
+
+        :rtype: _Pipeline
+        """
+        raise NotImplementedError()
+
+
+class DockerExecutor(Executor):
+    """
+    Runs each tool in a fresh container, or in a DockerSession, with the work directory mounted at /data
+    """
+
+    def call(self, tool, parameters, work_dir, env=None, outfile=None, check_output=False, outputs=None, rm=True,
+             docker_parameters=None, session=None, permissions='created', metrics=None, job=None):
+        if isinstance(session, DockerSessions):
+            session = session.get(tool)
+        if session:
+            require(session.tool == tool, 'Session was started for {} not {}.'.format(session.tool, tool))
+            require(session.work_dir == os.path.abspath(work_dir),
+                    'Session was started for {} not {}.'.format(session.work_dir, os.path.abspath(work_dir)))
+            docker_call = session.exec_command(parameters, env=env)
+        else:
+            base_docker_call = ['docker', 'run',
+                                '--log-driver=none',
+                                '-v', '{}:/data'.format(os.path.abspath(work_dir))]
+            if rm:
+                base_docker_call.append('--rm')
+            if env:
+                for e, v in env.iteritems():
+                    base_docker_call.extend(['-e', '{}={}'.format(e, v)])
+            if docker_parameters:
+                base_docker_call += docker_parameters
+            docker_call = base_docker_call[:]
+            if permissions == 'user':
+                stat = os.stat(work_dir)
+                docker_call.extend(['--user', '{}:{}'.format(stat.st_uid, stat.st_gid)])
+            docker_call += [tool] + parameters
+
+        pull_time = 0.0 if session else _ensure_image(tool)
+        snapshot = None if session else _snapshot(work_dir, permissions)
+        monitor, cid_dir = None, None
+        if metrics is not None or job:
+            if session:
+                monitor = _ContainerMonitor(container_id=session.container_id)
+            else:
+                # Docker writes the ID of the new container to the cidfile, which must not exist yet
+                cid_dir = tempfile.mkdtemp()
+                monitor = _ContainerMonitor(cidfile=os.path.join(cid_dir, 'cid'), rm=rm)
+                docker_call.insert(2, '--cidfile={}'.format(monitor.cidfile))
+                # The container is kept after it exits so it can be read one last time, and removed by the monitor
+                if rm:
+                    docker_call.remove('--rm')
+            monitor.start()
+        _log.debug("Calling docker with %s." % " ".join(docker_call))
+
+        start = time.time()
+        output = None
+        try:
+            if outfile:
+                subprocess.check_call(docker_call, stdout=outfile)
+            else:
+                if check_output:
+                    output = subprocess.check_output(docker_call)
+                else:
+                    subprocess.check_call(docker_call)
+        # Fix root ownership of output files. Sessions fix permissions once, when they are closed.
+        except:
+            # Panic avoids hiding the exception raised in the try block
+            with panic():
+                if not session:
+                    _fix_permissions(base_docker_call, tool, work_dir, permissions, snapshot)
+        else:
+            if not session:
+                _fix_permissions(base_docker_call, tool, work_dir, permissions, snapshot)
+        finally:
+            if monitor:
+                record = monitor.stop(tool, wall_time=time.time() - start, pull_time=pull_time)
+                if cid_dir:
+                    shutil.rmtree(cid_dir)
+                _report_metrics(record, metrics, job)
+        return output
+
+    def pipeline(self, stages, work_dir, env=None, permissions='created'):
+        return _DockerPipeline(stages, work_dir, env, permissions)
+
+
+class LocalExecutor(Executor):
+    """
+    Runs tools that are installed natively instead of in containers, e.g. on HPC nodes. Each image is mapped to a
+    command line, by default the last component of the image's repository (quay.io/ucsc_cgl/samtools:0.1.19 runs
+    `samtools`). Tools run in the work directory and arguments that refer to /data are rewritten to point to it.
+    """
+
+    def __init__(self, commands=None):
+        """
+        :param dict[str,list[str]] commands: Command lines keyed by image, with or without its tag. Only needed for
+                                             images whose entrypoint is not named after the repository.
+        """
+        self.commands = commands or {}
+
+    def command(self, tool, parameters, work_dir):
+        """
+        :return: The command line that runs the tool with the given parameters
+        :rtype: list[str]
+        """
+        repository = tool.split(':')[0]
+        command = self.commands.get(tool) or self.commands.get(repository) or [repository.split('/')[-1]]
+        require(find_executable(command[0]), 'Executable {} for {} is not on the PATH.'.format(command[0], tool))
+        work_dir = os.path.abspath(work_dir)
+        return command + [_DATA_PATH.sub(lambda m: m.group(1) + work_dir, x) for x in parameters]
+
+    def call(self, tool, parameters, work_dir, env=None, outfile=None, check_output=False, outputs=None, rm=True,
+             docker_parameters=None, session=None, permissions='created', metrics=None, job=None):
+        command = self.command(tool, parameters, work_dir)
+        _log.debug("Calling %s." % " ".join(command))
+        start = time.time()
+        process = subprocess.Popen(command, cwd=work_dir, env=dict(os.environ, **(env or {})),
+                                   stdout=outfile or (subprocess.PIPE if check_output else None))
+        output = process.stdout.read() if check_output and not outfile else None
+        # Unlike Popen.wait, wait4 also returns the resource usage of the process
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        if metrics is not None or job:
+            # On Linux, ru_maxrss is in kilobytes and block counts are in units of 512 bytes
+            wall_time = time.time() - start
+            record = ContainerMetrics(tool=tool, wall_time=wall_time, pull_time=0.0, run_time=wall_time,
+                                      cpu_time=usage.ru_utime + usage.ru_stime, peak_rss=usage.ru_maxrss * 1024,
+                                      bytes_read=usage.ru_inblock * 512, bytes_written=usage.ru_oublock * 512)
+            _report_metrics(record, metrics, job)
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        return output
+
+    def pipeline(self, stages, work_dir, env=None, permissions='created'):
+        return _Pipeline([self.command(tool, parameters, work_dir) for tool, parameters in stages],
+                         cwd=work_dir, env=dict(os.environ, **(env or {})))
+
+
+class MockExecutor(Executor):
+    """
+    Runs nothing. Output files that don't exist are created with dummy contents, or downloaded if a URL is given.
+    """
+
+    def call(self, tool, parameters, work_dir, env=None, outfile=None, check_output=False, outputs=None, rm=True,
+             docker_parameters=None, session=None, permissions='created', metrics=None, job=None):
+        from toil_lib.urls import download_url
+
+        for filename, url in (outputs or {}).items():
             file_path = os.path.join(work_dir, filename)
             if url is None:
                 # create mock file
@@ -69,58 +314,759 @@ def docker_call(tool,
                     f.close()
 
             else:
-                file_path = os.path.join(work_dir, filename)
                 if not os.path.exists(file_path):
-                    outfile = download_url(url, work_dir=work_dir, name=filename)
+                    download_url(url, work_dir=work_dir, name=filename)
                 assert os.path.exists(file_path)
-        return
-    
-    base_docker_call = ['docker', 'run',
-                        '--log-driver=none',
-                        '-v', '{}:/data'.format(os.path.abspath(work_dir))]
-    if rm:
-        base_docker_call.append('--rm')
-    if env:
-        for e, v in env.iteritems():
-            base_docker_call.extend(['-e', '{}={}'.format(e, v)])
-    if docker_parameters:
-        base_docker_call += docker_parameters
-
-    _log.debug("Calling docker with %s." % " ".join(base_docker_call + [tool] + parameters))
-
-    docker_call = base_docker_call + [tool] + parameters
 
-    try:
-        if outfile:
-            subprocess.check_call(docker_call, stdout=outfile)
+    def pipeline(self, stages, work_dir, env=None, permissions='created'):
+        return _Pipeline([])
+
+
+def default_executor():
+    """
+    Returns the executor selected by the TOIL_LIB_EXECUTOR environment variable, either 'docker' (the default) or
+    'local'. For 'local', TOIL_LIB_LOCAL_COMMANDS may hold a JSON object of command lines keyed by image, as taken by
+    LocalExecutor.
+
+    :rtype: Executor
+    """
+    name = os.environ.get('TOIL_LIB_EXECUTOR', 'docker')
+    if name == 'docker':
+        return DockerExecutor()
+    elif name == 'local':
+        return LocalExecutor(json.loads(os.environ.get('TOIL_LIB_LOCAL_COMMANDS', '{}')))
+    else:
+        raise ValueError('Improper executor specified. TOIL_LIB_EXECUTOR must be equal to "docker" or "local".')
+
+
+def _report_metrics(record, metrics, job):
+    """
+    Hands the resource usage of a call to the caller
+
+    :param ContainerMetrics record: Resource usage
+    :param list metrics: If not None, the record is appended to it
+    :param JobFunctionWrappingJob job: If not None, the record is logged to the leader as JSON
+    """
+    if metrics is not None:
+        metrics.append(record)
+    if job:
+        job.fileStore.logToMaster('Docker call metrics: {}'.format(json.dumps(record._asdict())))
+
+
+class _ContainerMonitor(threading.Thread):
+    """
+    Samples a container's cgroup while it runs. Counters are cumulative over the container's lifetime, so for a
+    container that was already running (e.g. a DockerSession) usage is reported relative to the first sample. Peak
+    RSS is always that of the whole container.
+
+    Sampling starts every min_interval seconds and backs off to every interval seconds, so containers that only run
+    for a fraction of a second are still sampled. A container started for the call is run without `--rm`, read one
+    last time after it exits, and then removed by the monitor.
+    """
+
+    def __init__(self, container_id=None, cidfile=None, interval=1.0, min_interval=0.01, rm=False):
+        """
+        :param str container_id: ID of a running container
+        :param str cidfile: Path of the cidfile the container's ID will be written to, if it hasn't started yet
+        :param float interval: Longest time between samples, in seconds
+        :param float min_interval: Time between the first samples, in seconds
+        :param bool rm: Whether the container from the cidfile is removed when the monitor is stopped
+        """
+        super(_ContainerMonitor, self).__init__()
+        self.daemon = True
+        self.container_id = container_id
+        self.cidfile = cidfile
+        self.interval = interval
+        self.min_interval = min_interval
+        self.rm = rm
+        self.first = self.last = None
+        self.peak_rss = None
+        self._done = threading.Event()
+        if container_id:
+            self.sample()
         else:
-            if check_output:
-                return subprocess.check_output(docker_call)
-            else:
-                subprocess.check_call(docker_call)
-    # Fix root ownership of output files
-    except:
-        # Panic avoids hiding the exception raised in the try block
-        with panic():
-            _fix_permissions(base_docker_call, tool, work_dir)
+            self.first = dict(cpu_time=0.0, bytes_read=0, bytes_written=0)
+
+    def run(self):
+        wait = self.min_interval
+        while not self._done.is_set():
+            self.sample()
+            self._done.wait(wait)
+            wait = min(wait * 2, self.interval)
+
+    def sample(self):
+        if not self.container_id:
+            if not os.path.exists(self.cidfile):
+                return
+            with open(self.cidfile) as f:
+                self.container_id = f.read().strip() or None
+            if not self.container_id:
+                return
+        stats = _cgroup_stats(self.container_id)
+        if stats:
+            self.first = self.first or stats
+            self.last = stats
+            self.peak_rss = max(self.peak_rss, stats['peak_rss'] or stats['rss'])
+
+    def stop(self, tool, wall_time, pull_time):
+        """
+        Stops sampling, takes a final reading and removes the container if it was started for the call
+
+        :return: Resource usage since the monitor was created
+        :rtype: ContainerMetrics
+        """
+        self._done.set()
+        self.join()
+        self.sample()
+        run_time = None
+        if self.cidfile and self.container_id:
+            try:
+                run_time = _container_run_time(self.container_id)
+            finally:
+                if self.rm:
+                    with open(os.devnull, 'w') as devnull:
+                        subprocess.call(['docker', 'rm', '-f', self.container_id], stdout=devnull, stderr=devnull)
+        usage = {k: self.last[k] - self.first[k] if self.last else None
+                 for k in ['cpu_time', 'bytes_read', 'bytes_written']}
+        return ContainerMetrics(tool=tool, wall_time=wall_time, pull_time=pull_time, peak_rss=self.peak_rss,
+                                run_time=run_time, **usage)
+
+
+def _container_run_time(container_id):
+    """
+    Reads how long an exited container ran from its state
+
+    :param str container_id: ID of the container
+    :return: Seconds between the container's start and finish, or None if Docker doesn't report them
+    :rtype: float
+    """
+    try:
+        state = json.loads(subprocess.check_output(['docker', 'inspect', '--format', '{{json .State}}',
+                                                    container_id]))
+        started, finished = [_docker_time(state[k]) for k in ['StartedAt', 'FinishedAt']]
+    except (subprocess.CalledProcessError, OSError, ValueError, KeyError):
+        return None
+    return max(0.0, (finished - started).total_seconds())
+
+
+def _docker_time(timestamp):
+    """
+    Parses a timestamp reported by Docker, e.g. 2016-10-16T20:17:13.123456789Z
+
+    :rtype: datetime.datetime
+    """
+    seconds, _, fraction = timestamp.rstrip('Z').partition('.')
+    # Docker reports nanoseconds, which strptime can't parse
+    return datetime.strptime(seconds, '%Y-%m-%dT%H:%M:%S') + timedelta(microseconds=int((fraction + '000000')[:6]))
+
+
+def _cgroup_stats(container_id):
+    """
+    Reads the resource usage of a container from its cgroup. Supports the cgroupfs and systemd cgroup drivers on
+    both cgroup v1 and v2.
+
+    :param str container_id: Full ID of the container
+    :return: Cumulative cpu_time (seconds), rss, peak_rss, bytes_read and bytes_written (bytes), or None if the
+             cgroup can't be read. peak_rss is None if the kernel doesn't track it.
+    :rtype: dict
+    """
+    try:
+        for scope in ['docker/' + container_id, 'system.slice/docker-{}.scope'.format(container_id)]:
+            unified = os.path.join(_CGROUP_ROOT, scope)
+            if os.path.exists(os.path.join(unified, 'cgroup.controllers')):
+                return _cgroup_v2_stats(unified)
+            if os.path.isdir(os.path.join(_CGROUP_ROOT, 'memory', scope)):
+                return _cgroup_v1_stats(scope)
+    except (IOError, OSError, ValueError):
+        # The container exited while it was being sampled
+        pass
+    return None
+
+
+def _cgroup_v1_stats(scope):
+    def read(controller, name):
+        with open(os.path.join(_CGROUP_ROOT, controller, scope, name)) as f:
+            return f.read()
+    io = {'Read': 0, 'Write': 0}
+    for line in read('blkio', 'blkio.throttle.io_service_bytes').splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[1] in io:
+            io[fields[1]] += int(fields[2])
+    return dict(cpu_time=int(read('cpuacct', 'cpuacct.usage')) / 1e9,
+                rss=int(read('memory', 'memory.usage_in_bytes')),
+                peak_rss=int(read('memory', 'memory.max_usage_in_bytes')),
+                bytes_read=io['Read'],
+                bytes_written=io['Write'])
+
+
+def _cgroup_v2_stats(path):
+    def read(name):
+        with open(os.path.join(path, name)) as f:
+            return f.read()
+    cpu = dict(line.split() for line in read('cpu.stat').splitlines())
+    io = {'rbytes': 0, 'wbytes': 0}
+    for line in read('io.stat').splitlines():
+        for field in line.split()[1:]:
+            key, value = field.split('=')
+            if key in io:
+                io[key] += int(value)
+    peak_path = os.path.join(path, 'memory.peak')
+    return dict(cpu_time=int(cpu['usage_usec']) / 1e6,
+                rss=int(read('memory.current')),
+                peak_rss=int(read('memory.peak')) if os.path.exists(peak_path) else None,
+                bytes_read=io['rbytes'],
+                bytes_written=io['wbytes'])
+
+
+def docker_pipeline(stages,
+                    work_dir='.',
+                    env=None,
+                    outfile=None,
+                    mock=None,
+                    permissions='created',
+                    executor=None):
+    """
+    Runs several containerized tools connected stdout-to-stdin, like a shell pipeline, so that no intermediate
+    files are written to work_dir. For example, `samtools view | cutadapt | bwa` is expressed as:
+
+        [(samtools, ['view', '/data/sample.bam']), (cutadapt, [...]), (bwa, [...])]
+
+    :param list[tuple(str, list[str])] stages: Docker image and command line arguments of each tool, in pipe order
+    :param str work_dir: Directory to mount into every container via `-v`. Destination convention is /data
+    :param dict[str,str] env: Environment variables to be added to every container
+    :param file outfile: Pipe output of the last tool to file handle. If unset, an iterator is returned instead.
+    :param bool mock: Whether to run in mock mode. If this variable is unset, its value will be determined by
+                      the environment variable.
+    :param str permissions: How ownership of files written by the tools is restored. One of PERMISSION_STRATEGIES.
+    :param Executor executor: How the tools are run. Defaults to MockExecutor in mock mode and to default_executor()
+                              otherwise.
+    :return: If outfile is unset, an iterator over the lines written to stdout by the last tool. Closing the iterator
+             before it is exhausted stops the pipeline. A CalledProcessError is raised once the output is exhausted
+             if any of the tools failed.
+    :rtype: iter[str]
+    """
+    require(stages, 'A pipeline requires at least one stage.')
+    require(permissions in PERMISSION_STRATEGIES,
+            'Permission strategy must be one of {}, not {}.'.format(PERMISSION_STRATEGIES, permissions))
+    if mock is None:
+        mock = mock_mode()
+    if executor is None:
+        executor = MockExecutor() if mock else default_executor()
+    pipeline = executor.pipeline(stages, work_dir, env=env, permissions=permissions)
+    if outfile:
+        pipeline.run(outfile)
     else:
-        _fix_permissions(base_docker_call, tool, work_dir)
+        return pipeline.lines()
+
+
+class _Pipeline(object):
+    """
+    Processes connected stdout-to-stdin, as run by docker_pipeline
+    """
+
+    def __init__(self, commands, cwd=None, env=None):
+        self.commands = commands
+        self.cwd = cwd
+        self.env = env
+        self.processes = []
+
+    def start(self, stdout):
+        for i, command in enumerate(self.commands):
+            _log.debug("Calling %s." % " ".join(command))
+            last = i == len(self.commands) - 1
+            previous = self.processes[-1].stdout if self.processes else open(os.devnull)
+            # Closing inherited descriptors keeps pipes of concurrently started pipelines from leaking into this one
+            self.processes.append(subprocess.Popen(command, stdin=previous, cwd=self.cwd, env=self.env, close_fds=True,
+                                                   stdout=stdout if last else subprocess.PIPE))
+            # Only the downstream process should hold the read end, so upstream tools see a closed pipe
+            previous.close()
+
+    def wait(self):
+        """
+        :return: Return codes of the processes
+        :rtype: list[int]
+        """
+        return [process.wait() for process in self.processes]
+
+    def stop(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.terminate()
+
+    def check(self, return_codes):
+        for command, return_code in zip(self.commands, return_codes):
+            if return_code:
+                raise subprocess.CalledProcessError(return_code, command)
+
+    def run(self, outfile):
+        self.start(outfile)
+        self.check(self.wait())
+
+    def lines(self):
+        if not self.commands:
+            return
+        self.start(subprocess.PIPE)
+        stdout = self.processes[-1].stdout
+        finished = False
+        try:
+            for line in iter(stdout.readline, ''):
+                yield line
+            finished = True
+        finally:
+            stdout.close()
+            if not finished:
+                self.stop()
+            return_codes = self.wait()
+        self.check(return_codes)
+
+
+class _DockerPipeline(_Pipeline):
+    """
+    Containers connected stdout-to-stdin, as run by docker_pipeline with the docker executor
+    """
+
+    def __init__(self, stages, work_dir, env, permissions):
+        self.work_dir = os.path.abspath(work_dir)
+        self.base_docker_call = ['docker', 'run', '--rm', '--log-driver=none', '-v', '{}:/data'.format(self.work_dir)]
+        if env:
+            for e, v in env.iteritems():
+                self.base_docker_call.extend(['-e', '{}={}'.format(e, v)])
+        self.stages = [(tool, parameters, _resolve_permissions(tool, permissions)) for tool, parameters in stages]
+        # Containers are named so they can be stopped if the pipeline is abandoned
+        self.names = ['toil-lib-pipeline-{}'.format(uuid4()) for _ in self.stages]
+        stat = os.stat(self.work_dir)
+        commands = []
+        for i, (tool, parameters, permissions) in enumerate(self.stages):
+            command = self.base_docker_call + ['--name', self.names[i]]
+            if i > 0:
+                command.append('-i')
+            if permissions == 'user':
+                command.extend(['--user', '{}:{}'.format(stat.st_uid, stat.st_gid)])
+            commands.append(command + [tool] + parameters)
+        super(_DockerPipeline, self).__init__(commands)
+
+    def start(self, stdout):
+        for tool, _, _ in self.stages:
+            _ensure_image(tool)
+        self.snapshot = _snapshot(self.work_dir, self._permissions())
+        super(_DockerPipeline, self).start(stdout)
+
+    def _permissions(self):
+        # Every stage may write to work_dir, so the strictest strategy among them applies
+        return max((p for _, _, p in self.stages), key=PERMISSION_STRATEGIES.index)
+
+    def wait(self):
+        """
+        Waits for the pipeline to finish and restores ownership of the work directory
+
+        :return: Return codes of the processes
+        :rtype: list[int]
+        """
+        try:
+            return super(_DockerPipeline, self).wait()
+        finally:
+            _fix_permissions(self.base_docker_call, self.stages[0][0], self.work_dir, self._permissions(),
+                             self.snapshot)
+
+    def stop(self):
+        # Killing the docker client would leave the container running
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(['docker', 'kill'] + self.names, stdout=devnull, stderr=devnull)
+
+
+class ConcurrentCallError(RuntimeError):
+    """
+    Raised by run_concurrently once all calls have finished, if any of them failed
+    """
+
+    def __init__(self, errors):
+        """
+        :param list[tuple(int, Exception)] errors: Index of each failed call and the exception it raised
+        """
+        super(ConcurrentCallError, self).__init__(
+            '{} concurrent call(s) failed:\n'.format(len(errors)) +
+            '\n'.join('Call {}: {!r}'.format(i, e) for i, e in errors))
+        self.errors = errors
+
+
+def run_concurrently(functions, num_threads=1):
+    """
+    Runs independent functions concurrently. Every function is run even if some of them fail.
+
+    :param list[function] functions: Functions to call, without arguments
+    :param int num_threads: Maximum number of concurrent calls, e.g. job.cores
+    :return: Return value of each function, in order
+    :rtype: list
+    :raises ConcurrentCallError: If any of the functions raised an exception
+    """
+    if not functions:
+        return []
+    pool = ThreadPool(max(1, min(int(num_threads), len(functions))))
+    try:
+        results = [pool.apply_async(function) for function in functions]
+        values, errors = [], []
+        for i, result in enumerate(results):
+            try:
+                values.append(result.get())
+            except Exception as e:
+                values.append(None)
+                errors.append((i, e))
+    finally:
+        pool.close()
+        pool.join()
+    if errors:
+        raise ConcurrentCallError(errors)
+    return values
+
+
+def docker_call_many(calls, num_threads=1):
+    """
+    Runs independent docker calls concurrently, e.g. the same tool over several inputs, so that a job uses all of
+    the cores it reserved. Calls must not write to the same files.
+
+    :param list[dict] calls: Keyword arguments to docker_call for each call
+    :param int num_threads: Maximum number of concurrent calls, typically job.cores
+    :return: Return value of docker_call for each call, in order
+    :rtype: list
+    :raises ConcurrentCallError: If any of the calls failed
+    """
+    return run_concurrently([functools.partial(docker_call, **kwargs) for kwargs in calls], num_threads=num_threads)
+
+
+def pull_images(tools=None, num_threads=4):
+    """
+    Pulls Docker images concurrently so that later docker calls don't block on them
+
+    :param list[str] tools: Docker images to pull. Defaults to every image in toil_lib.tools.images.ALL_IMAGES
+    :param int num_threads: Maximum number of concurrent pulls
+    :return: Seconds spent pulling each image, or 0 for images that were already present
+    :rtype: dict[str,float]
+    """
+    if tools is None:
+        from toil_lib.tools.images import ALL_IMAGES
+        tools = ALL_IMAGES
+    tools = list(set(tools))
+    times = run_concurrently([functools.partial(_pull_image, tool) for tool in tools], num_threads=num_threads)
+    return dict(zip(tools, times))
+
+
+def pull_images_job(job, tools=None, num_threads=4):
+    """
+    Job version of `pull_images`. Add it as the first job of a workflow, or run it when a node boots, to take image
+    pulls off the critical path.
+    """
+    for tool, seconds in pull_images(tools, num_threads=num_threads).iteritems():
+        if seconds:
+            job.fileStore.logToMaster('Pulled {} in {:.1f} seconds.'.format(tool, seconds))
+
+
+def _pull_image(tool):
+    """
+    Pulls the image if it isn't present locally
+
+    :param str tool: Name of the Docker image
+    :return: Seconds spent waiting on a pull of the image, by this or another thread, or 0 if it was already present
+    :rtype: float
+    """
+    if tool in _present_images:
+        return 0.0
+    start = time.time()
+    with _pull_locks[tool]:
+        if tool in _present_images:
+            return time.time() - start
+        with open(os.devnull, 'w') as devnull:
+            if subprocess.call(['docker', 'inspect', '--type=image', tool], stdout=devnull, stderr=devnull) == 0:
+                _present_images.add(tool)
+                return 0.0
+            subprocess.check_call(['docker', 'pull', tool], stdout=devnull)
+        _present_images.add(tool)
+        return time.time() - start
+
+
+def _ensure_image(tool):
+    """
+    Pulls the image for a docker call and records how long the call waited on the pull
+
+    :param str tool: Name of the Docker image
+    :return: Seconds spent waiting on the pull
+    :rtype: float
+    """
+    seconds = _pull_image(tool)
+    if seconds:
+        pull_waits[tool] += seconds
+        _log.info('Docker call waited %.1f seconds on pulling %s.', seconds, tool)
+    return seconds
+
+
+def _resolve_permissions(tool, permissions):
+    """
+    Falls back from the 'user' strategy to 'created' for tools that need to run as root
+
+    :param str tool: Name of the Docker image
+    :param str permissions: Requested permission strategy
+    :return: Permission strategy to use
+    :rtype: str
+    """
+    if permissions == 'user' and tool.split(':')[0] in ROOT_REQUIRED_TOOLS:
+        _log.debug('%s must run as root, fixing permissions of created files instead.', tool)
+        return 'created'
+    return permissions
+
+
+def _snapshot(work_dir, permissions):
+    """
+    Lists the top level of a work directory before a container runs, so that the entries it creates can be found
+    afterwards without walking the whole directory
+
+    :param str work_dir: Path of work directory mounted at /data
+    :param str permissions: Permission strategy
+    :return: Modification time of each top-level entry and whether it is a directory, by name, or None if the strategy
+             doesn't need a listing
+    :rtype: dict[str,tuple(float,bool)]
+    """
+    if permissions != 'created':
+        return None
+    snapshot = {}
+    for name in os.listdir(work_dir):
+        st = os.lstat(os.path.join(work_dir, name))
+        snapshot[name] = (st.st_mtime, S_ISDIR(st.st_mode))
+    return snapshot
+
+
+def _chown_parameters(work_dir, permissions, snapshot=None):
+    """
+    Returns the chown arguments needed to restore ownership of a mounted work directory.
+    For the 'created' strategy only the paths not owned by the owner of work_dir are included. Given a snapshot, only
+    the top-level entries that are new and the top-level directories whose contents changed are looked at, so files
+    a tool writes deeper inside directories that existed before it ran aren't found. New directories created by the
+    container are chowned recursively without being walked on the host.
+
+    :param str work_dir: Path of work directory mounted at /data
+    :param str permissions: Permission strategy
+    :param dict snapshot: Listing of work_dir taken by _snapshot before the container ran, or None to walk all of it
+    :return: Lists of chown arguments, one per chown invocation. Empty if nothing needs fixing.
+    :rtype: list[list[str]]
+    """
+    stat = os.stat(work_dir)
+    owner = '{}:{}'.format(stat.st_uid, stat.st_gid)
+    if permissions == 'user':
+        return []
+    if permissions == 'chown':
+        return [['-R', owner, '/data']]
+    if snapshot is None:
+        roots = [work_dir]
+    else:
+        roots = []
+        for name in os.listdir(work_dir):
+            path = os.path.join(work_dir, name)
+            if name not in snapshot:
+                roots.append(path)
+            elif snapshot[name][1] and os.lstat(path).st_mtime != snapshot[name][0]:
+                roots.append(path)
+    paths = []
+    for root in roots:
+        paths.extend(_foreign_paths(root, stat.st_uid, is_root=root == work_dir))
+    paths = [os.path.join('/data', os.path.relpath(path, work_dir)) for path in paths]
+    return [['-R', owner] + paths[i:i + _CHOWN_BATCH_SIZE] for i in xrange(0, len(paths), _CHOWN_BATCH_SIZE)]
 
-    for filename in outputs.keys():
-        if not os.path.isabs(filename):
-            filename = os.path.join(work_dir, filename)
-        assert(os.path.isfile(filename))
 
+def _foreign_paths(path, uid, is_root=False):
+    """
+    :return: The topmost paths at or below path that aren't owned by uid. Directories among them aren't descended into.
+    :rtype: list[str]
+    """
+    if not is_root and os.lstat(path).st_uid != uid:
+        return [path]
+    if not os.path.isdir(path) or os.path.islink(path):
+        return []
+    paths = []
+    for root, dirs, files in os.walk(path):
+        for name in list(dirs):
+            if os.lstat(os.path.join(root, name)).st_uid != uid:
+                paths.append(os.path.join(root, name))
+                dirs.remove(name)
+        paths.extend(os.path.join(root, name) for name in files
+                     if os.lstat(os.path.join(root, name)).st_uid != uid)
+    return paths
 
-def _fix_permissions(base_docker_call, tool, work_dir):
+
+def _fix_permissions(base_docker_call, tool, work_dir, permissions='chown', snapshot=None):
     """
     Fix permission of a mounted Docker directory by reusing the tool
 
     :param list base_docker_call: Docker run parameters
     :param str tool: Name of tool
-    :param str work_dir: Path of work directory to recursively chown
+    :param str work_dir: Path of work directory to chown
+    :param str permissions: Permission strategy used to run the tool
+    :param dict snapshot: Listing of work_dir taken by _snapshot before the tool ran
     """
-    base_docker_call.append('--entrypoint=chown')
-    stat = os.stat(work_dir)
-    command = base_docker_call + [tool] + ['-R', '{}:{}'.format(stat.st_uid, stat.st_gid), '/data']
-    subprocess.check_call(command)
+    for parameters in _chown_parameters(work_dir, permissions, snapshot):
+        subprocess.check_call(base_docker_call + ['--entrypoint=chown', tool] + parameters)
+
+
+class DockerSession(object):
+    """
+    A long-lived container for one tool and work directory. Calls to docker_call that pass the session are run
+    with `docker exec` in the running container, so container start-up is paid once per session rather than once
+    per call. Use it as a context manager so the container is torn down, and ownership of the work directory
+    restored, when the job is done with it:
+
+        with DockerSession(tool, work_dir) as session:
+            docker_call(tool, ['faidx', '/data/ref.fasta'], work_dir, session=session)
+            docker_call(tool, ['index', '/data/sample.bam'], work_dir, session=session)
+    """
+
+    def __init__(self, tool, work_dir='.', env=None, docker_parameters=None, mock=None, permissions='created'):
+        """
+        :param str tool: Name of the Docker image to be used (e.g. quay.io/ucsc_cgl/samtools)
+        :param str work_dir: Directory to mount into the container via `-v`. Destination convention is /data
+        :param dict[str,str] env: Environment variables set for every command run in the session
+        :param list[str] docker_parameters: Parameters to pass to `docker run` when starting the container
+        :param bool mock: Whether to run in mock mode. If unset, its value is determined by the environment variable.
+        :param str permissions: How ownership of files written in the session is restored. One of
+                                PERMISSION_STRATEGIES.
+        """
+        require(permissions in PERMISSION_STRATEGIES,
+                'Permission strategy must be one of {}, not {}.'.format(PERMISSION_STRATEGIES, permissions))
+        self.tool = tool
+        self.work_dir = os.path.abspath(work_dir)
+        self.env = env or {}
+        self.docker_parameters = docker_parameters or []
+        self.mock = mock_mode() if mock is None else mock
+        self.permissions = _resolve_permissions(tool, permissions)
+        self.container_id = None
+        self.entrypoint = []
+        self.snapshot = None
+
+    def start(self):
+        """
+        Starts the container, keeping it alive with a no-op process until the session is closed.
+        """
+        if self.mock or self.container_id:
+            return
+        _ensure_image(self.tool)
+        # The image's entrypoint is replaced by the keep-alive process, so remember it for exec'd commands
+        inspect = subprocess.check_output(['docker', 'inspect', '--format', '{{json .Config.Entrypoint}}', self.tool])
+        self.entrypoint = json.loads(inspect) or []
+        command = ['docker', 'run', '-d',
+                   '--log-driver=none',
+                   '-v', '{}:/data'.format(self.work_dir),
+                   '--entrypoint=tail']
+        for e, v in self.env.iteritems():
+            command.extend(['-e', '{}={}'.format(e, v)])
+        if self.permissions == 'user':
+            stat = os.stat(self.work_dir)
+            command.extend(['--user', '{}:{}'.format(stat.st_uid, stat.st_gid)])
+        command += self.docker_parameters + [self.tool, '-f', '/dev/null']
+        self.snapshot = _snapshot(self.work_dir, self.permissions)
+        _log.debug("Starting docker session with %s." % " ".join(command))
+        self.container_id = subprocess.check_output(command).strip()
+
+    def exec_command(self, parameters, env=None):
+        """
+        Builds the `docker exec` command line that runs the tool with the given parameters in this session.
+
+        :param list[str] parameters: Command line arguments to be passed to the tool
+        :param dict[str,str] env: Environment variables to be added for this command only
+        :return: Command line
+        :rtype: list[str]
+        """
+        require(self.container_id, 'Docker session for {} has not been started.'.format(self.tool))
+        command = ['docker', 'exec']
+        if env:
+            for e, v in env.iteritems():
+                command.extend(['-e', '{}={}'.format(e, v)])
+        return command + [self.container_id] + self.entrypoint + parameters
+
+    def close(self):
+        """
+        Restores ownership of the work directory and removes the container.
+        """
+        if not self.container_id:
+            return
+        try:
+            for parameters in _chown_parameters(self.work_dir, self.permissions, self.snapshot):
+                subprocess.check_call(['docker', 'exec', self.container_id, 'chown'] + parameters)
+        finally:
+            subprocess.check_call(['docker', 'rm', '-f', self.container_id], stdout=open(os.devnull, 'w'))
+            self.container_id = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self.close()
+        except Exception:
+            # Avoid hiding the exception raised in the with block
+            if exc_type is None:
+                raise
+            _log.warn('Failed to close docker session for %s.', self.tool, exc_info=True)
+
+
+class DockerSessions(object):
+    """
+    A pool of DockerSessions sharing one work directory, for jobs that run several tools in turn. The session for a
+    tool is started the first time it is asked for and reused by every later call, and all of them are torn down
+    together when the pool is closed. The pool can be passed to docker_call as its session:
+
+        with DockerSessions(work_dir) as sessions:
+            docker_call(SAMTOOLS, ['faidx', '/data/ref.fasta'], work_dir, session=sessions)
+            docker_call(PICARDTOOLS, ['CreateSequenceDictionary', 'R=ref.fasta', 'O=ref.dict'], work_dir,
+                        session=sessions)
+    """
+
+    def __init__(self, work_dir='.', env=None, mock=None, permissions='created'):
+        """
+        :param str work_dir: Directory to mount into the containers via `-v`. Destination convention is /data
+        :param dict[str,str] env: Environment variables set for every command run in the sessions
+        :param bool mock: Whether to run in mock mode. If unset, its value is determined by the environment variable.
+        :param str permissions: How ownership of files written in the sessions is restored. One of
+                                PERMISSION_STRATEGIES.
+        """
+        self.work_dir = os.path.abspath(work_dir)
+        self.env = env
+        self.mock = mock
+        self.permissions = permissions
+        self.sessions = {}
+
+    def get(self, tool):
+        """
+        :param str tool: Name of the Docker image
+        :return: The started session for the tool
+        :rtype: DockerSession
+        """
+        if tool not in self.sessions:
+            session = DockerSession(tool, self.work_dir, env=self.env, mock=self.mock, permissions=self.permissions)
+            session.start()
+            self.sessions[tool] = session
+        return self.sessions[tool]
+
+    def close(self):
+        """
+        Closes every session in the pool, restoring ownership of the work directory and removing the containers.
+        """
+        sessions, self.sessions = self.sessions.values(), {}
+        failed = None
+        for session in sessions:
+            # One failed session must not leave the other containers running
+            try:
+                session.close()
+            except Exception as e:
+                _log.warn('Failed to close docker session for %s.', session.tool, exc_info=True)
+                failed = failed or e
+        if failed:
+            raise failed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self.close()
+        except Exception:
+            # Avoid hiding the exception raised in the with block
+            if exc_type is None:
+                raise
+            _log.warn('Failed to close docker sessions in %s.', self.work_dir, exc_info=True)
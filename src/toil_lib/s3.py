@@ -0,0 +1,375 @@
+import base64
+import hashlib
+import httplib
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from cStringIO import StringIO
+from Queue import Queue
+from urlparse import urlparse
+
+from toil_lib import require
+from toil_lib.programs import ConcurrentCallError
+
+_log = logging.getLogger(__name__)
+
+S3_ENGINES = ('s3am', 'boto')
+# Same part size as the s3am calls in toil_lib.urls
+PART_SIZE = 50 * 1024 * 1024
+_MAX_PARTS = 10000
+_MAX_ATTEMPTS = 5
+# Seconds to wait before the first retry of a failed request. The delay doubles with each retry.
+_RETRY_DELAY = 1.0
+# Directory of the files recording the MD5s of encrypted parts, whose ETags aren't their MD5s
+_RECORD_DIR = os.path.join(tempfile.gettempdir(), 'toil-lib-s3-parts')
+_record_lock = threading.Lock()
+
+# Each thread keeps its own connections, since boto connections aren't thread-safe
+_local = threading.local()
+
+
+def resolve_engine(engine=None):
+    """
+    :param str engine: Name of an S3 transfer engine, or None for the one named by the TOIL_LIB_S3_ENGINE environment
+           variable, 's3am' if unset
+    :return: The name of the engine
+    :rtype: str
+    """
+    engine = engine or os.environ.get('TOIL_LIB_S3_ENGINE', 's3am')
+    require(engine in S3_ENGINES, 'S3 engine must be one of {}, not {}.'.format(S3_ENGINES, engine))
+    return engine
+
+
+def split_s3_url(s3_url):
+    """
+    >>> split_s3_url('s3://bucket/dir/file')
+    ('bucket', 'dir/file')
+
+    :param str s3_url: URL of the form s3://bucket/key
+    :return: Bucket name and key name
+    :rtype: tuple(str, str)
+    """
+    parsed = urlparse(s3_url)
+    require(parsed.scheme == 's3' and parsed.netloc and parsed.path.strip('/'), 'Malformed S3 URL: {}'.format(s3_url))
+    return parsed.netloc, parsed.path.lstrip('/')
+
+
+def sse_headers(s3_url, s3_key_path):
+    """
+    Returns the headers for SSE-C encryption of an object. Like `s3am --sse-key-is-master`, the key of each object is
+    derived from the master key and the object's URL, so objects written by either engine can be read by the other.
+
+    :param str s3_url: URL of the object
+    :param str s3_key_path: Path to the 32-byte master key, or None for no encryption
+    :rtype: dict[str,str]
+    """
+    if not s3_key_path:
+        return {}
+    with open(s3_key_path, 'rb') as f:
+        master_key = f.read()
+    require(len(master_key) == 32, 'SSE-C key file {} must contain 32 bytes.'.format(s3_key_path))
+    key = hashlib.sha256(master_key + s3_url).digest()
+    return {'x-amz-server-side-encryption-customer-algorithm': 'AES256',
+            'x-amz-server-side-encryption-customer-key': base64.b64encode(key),
+            'x-amz-server-side-encryption-customer-key-md5': base64.b64encode(hashlib.md5(key).digest())}
+
+
+def upload_file(file_path, s3_url, s3_key_path=None, num_threads=1, part_size=None):
+    """
+    Uploads a file to S3 in-process. Large files are uploaded as concurrent multipart parts, each retried with
+    exponential backoff. A failed upload is left open on S3, and uploading the same file to the same URL again resumes
+    it, skipping the parts that are already there and match the file. Encrypted parts can only be matched by the MD5s
+    recorded on the node that uploaded them, so elsewhere they are uploaded again.
+
+    :param str file_path: Path to the file to upload
+    :param str s3_url: URL of the object. Format: s3://bucket/key
+    :param str s3_key_path: Path to the 32-byte master key for SSE-C encryption
+    :param int num_threads: Number of parts to upload concurrently
+    :param int part_size: Size of each part in bytes, PART_SIZE if None
+    """
+    with open(file_path, 'rb') as f:
+        upload_stream(f, s3_url, s3_key_path=s3_key_path, num_threads=num_threads, part_size=part_size,
+                      size=os.path.getsize(file_path))
+
+
+def upload_stream(f, s3_url, s3_key_path=None, num_threads=1, part_size=None, size=None):
+    """
+    Uploads the contents of a file object that is read sequentially, such as a FileStore stream, like upload_file. Parts
+    are read while earlier ones are uploaded, and at most about twice num_threads parts are held in memory. The MD5 of
+    each part is computed from its buffer and sent along with it.
+
+    :param file f: File object to read from
+    :param str s3_url: URL of the object. Format: s3://bucket/key
+    :param str s3_key_path: Path to the 32-byte master key for SSE-C encryption
+    :param int num_threads: Number of parts to upload concurrently
+    :param int part_size: Size of each part in bytes, PART_SIZE if None
+    :param int size: Expected number of bytes, if known. Without it, objects are limited to 10000 parts.
+    """
+    part_size = part_size or PART_SIZE
+    if size:
+        # S3 allows at most 10000 parts
+        part_size = max(part_size, -(-size // _MAX_PARTS))
+    bucket_name, key_name = split_s3_url(s3_url)
+    headers = sse_headers(s3_url, s3_key_path)
+    start = time.time()
+    data = _read_fully(f, part_size)
+    next_data = _read_fully(f, part_size) if len(data) == part_size else ''
+    total = len(data) + len(next_data)
+    if not next_data:
+        def put():
+            _bucket(bucket_name).new_key(key_name).set_contents_from_file(StringIO(data), headers=headers)
+
+        _retry(put, 'upload of ' + s3_url)
+    else:
+        upload_id, existing = _resume_upload(bucket_name, key_name, headers,
+                                             num_parts=-(-size // part_size) if size else None)
+        recorded = _recorded_parts(upload_id) if headers else None
+        queue = Queue(maxsize=num_threads)
+        errors = []
+        etags = {}
+
+        def upload_parts():
+            while True:
+                part = queue.get()
+                if part is None:
+                    return
+                try:
+                    etags[part[0]] = _upload_part(s3_url, upload_id, part[0], part[1], headers, existing, recorded)
+                except Exception as e:
+                    errors.append((part[0], e))
+
+        threads = [threading.Thread(target=upload_parts) for _ in xrange(max(1, num_threads))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            part_num = 1
+            while data and not errors:
+                queue.put((part_num, data))
+                part_num += 1
+                data, next_data = next_data, _read_fully(f, part_size) if next_data else ''
+                total += len(next_data)
+        finally:
+            for _ in threads:
+                queue.put(None)
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise ConcurrentCallError(sorted(errors))
+        _complete_upload(bucket_name, key_name, upload_id, etags)
+    elapsed = max(time.time() - start, 1e-6)
+    _log.info('Uploaded %s (%d bytes) in %.1f seconds (%.1f MB/s).',
+              s3_url, total, elapsed, total / elapsed / 1024 / 1024)
+
+
+def _upload_part(s3_url, upload_id, part_num, data, headers, existing, recorded):
+    """
+    Uploads a part unless the same part was uploaded before
+
+    :param dict[int,tuple(int,str)] existing: Size and ETag of the parts that were already uploaded, by part number
+    :param dict[int,tuple(str,str)] recorded: ETag and MD5 of the encrypted parts uploaded from this node, by part
+           number, or None if the upload isn't encrypted
+    :return: ETag of the part
+    :rtype: str
+    """
+    md5 = hashlib.md5(data)
+    if part_num in existing and existing[part_num][0] == len(data):
+        etag = existing[part_num][1]
+        # The ETag of a part is its MD5 unless it is encrypted, in which case only a recorded MD5 can verify it
+        if recorded is None:
+            verified = etag == md5.hexdigest()
+        else:
+            verified = recorded.get(part_num) == (etag, md5.hexdigest())
+        if verified:
+            return etag
+    md5 = (md5.hexdigest(), base64.b64encode(md5.digest()))
+    bucket_name, key_name = split_s3_url(s3_url)
+
+    def put():
+        return _multipart(bucket_name, key_name, upload_id).upload_part_from_file(
+            StringIO(data), part_num, headers=headers, md5=md5, size=len(data))
+
+    etag = _retry(put, 'upload of part {} of {}'.format(part_num, s3_url)).etag.strip('"')
+    if recorded is not None:
+        _record_part(upload_id, part_num, etag, md5[0])
+    return etag
+
+
+def _complete_upload(bucket_name, key_name, upload_id, etags):
+    """
+    Completes a multipart upload with exactly the given parts. Any other parts of the upload, such as those left beyond
+    the end of the object by an earlier, longer attempt, are discarded.
+
+    :param dict[int,str] etags: ETag of each part, by part number
+    """
+    require(sorted(etags) == range(1, len(etags) + 1), 'Parts of {} are missing.'.format(key_name))
+    xml = '<CompleteMultipartUpload>{}</CompleteMultipartUpload>'.format(''.join(
+        '<Part><PartNumber>{}</PartNumber><ETag>"{}"</ETag></Part>'.format(part_num, etags[part_num])
+        for part_num in sorted(etags)))
+    _retry(lambda: _bucket(bucket_name).complete_multipart_upload(key_name, upload_id, xml),
+           'completion of upload to ' + key_name)
+    record_path = _record_path(upload_id)
+    if os.path.exists(record_path):
+        os.remove(record_path)
+
+
+def _record_path(upload_id):
+    return os.path.join(_RECORD_DIR, hashlib.sha1(upload_id).hexdigest())
+
+
+def _record_part(upload_id, part_num, etag, md5):
+    """
+    Records the ETag and MD5 of an uploaded part, so that a resumed upload can verify it
+    """
+    with _record_lock:
+        if not os.path.isdir(_RECORD_DIR):
+            os.makedirs(_RECORD_DIR)
+        with open(_record_path(upload_id), 'a') as f:
+            f.write('{}\t{}\t{}\n'.format(part_num, etag, md5))
+
+
+def _recorded_parts(upload_id):
+    """
+    :return: ETag and MD5 of the parts recorded for an upload, by part number
+    :rtype: dict[int,tuple(str,str)]
+    """
+    recorded = {}
+    if os.path.exists(_record_path(upload_id)):
+        with open(_record_path(upload_id)) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                # Lines cut short by a crash are ignored
+                if len(fields) == 3:
+                    recorded[int(fields[0])] = (fields[1], fields[2])
+    return recorded
+
+
+def _read_fully(f, size):
+    """
+    Reads size bytes from a file object, or fewer at the end of the file, even if f returns short reads
+    """
+    chunks = []
+    while size:
+        chunk = f.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def object_info(s3_url, s3_key_path=None):
+    """
+    :param str s3_url: URL of the object. Format: s3://bucket/key
+    :param str s3_key_path: Path to the 32-byte master key for SSE-C encryption
+    :return: Size and ETag of the object
+    :rtype: tuple(int, str)
+    """
+    bucket_name, key_name = split_s3_url(s3_url)
+    headers = sse_headers(s3_url, s3_key_path)
+    key = _retry(lambda: _bucket(bucket_name).get_key(key_name, headers=headers), 'lookup of ' + s3_url)
+    require(key is not None, 'S3 object does not exist: {}'.format(s3_url))
+    return key.size, key.etag
+
+
+def download_part(s3_url, file_path, part, s3_key_path=None):
+    """
+    Writes a byte range of an object to the same range of a file, retrying with exponential backoff
+
+    :param str s3_url: URL of the object. Format: s3://bucket/key
+    :param str file_path: Path of the file, which must already have the size of the object
+    :param tuple(int, int) part: First and last byte of the range
+    :param str s3_key_path: Path to the 32-byte master key for SSE-C encryption
+    """
+    bucket_name, key_name = split_s3_url(s3_url)
+    headers = dict(sse_headers(s3_url, s3_key_path), Range='bytes={}-{}'.format(*part))
+
+    def get():
+        with open(file_path, 'r+b') as f:
+            f.seek(part[0])
+            _bucket(bucket_name).new_key(key_name).get_contents_to_file(f, headers=headers)
+            if f.tell() != part[1] + 1:
+                raise IOError('Received a truncated range of {}'.format(s3_url))
+
+    _retry(get, 'download of bytes {}-{} of {}'.format(part[0], part[1], s3_url))
+
+
+def _resume_upload(bucket_name, key_name, headers, num_parts=None):
+    """
+    Finds the most recent multipart upload of a key, or starts one. An upload with more parts than the object will
+    have is aborted, since its extra parts can't be accounted for.
+
+    :param int num_parts: Number of parts of the object, if known
+    :return: The upload ID, and the size and ETag of each part already uploaded, by part number
+    :rtype: tuple(str, dict[int,tuple(int,str)])
+    """
+    bucket = _bucket(bucket_name)
+    uploads = [u for u in _retry(lambda: bucket.get_all_multipart_uploads(prefix=key_name),
+                                 'listing of uploads to ' + key_name)
+               if u.key_name == key_name]
+    if uploads:
+        upload = max(uploads, key=lambda u: u.initiated)
+        existing = {part.part_number: (part.size, part.etag.strip('"')) for part in upload}
+        if num_parts is None or max(existing or [0]) <= num_parts:
+            _log.info('Resuming upload %s to %s with %d parts already uploaded.', upload.id, key_name, len(existing))
+            return upload.id, existing
+        _log.warn('Aborting upload %s to %s, which has parts beyond the %d of the object.',
+                  upload.id, key_name, num_parts)
+        _retry(lambda: bucket.cancel_multipart_upload(key_name, upload.id), 'abort of upload to ' + key_name)
+    upload = _retry(lambda: bucket.initiate_multipart_upload(key_name, headers=headers),
+                    'start of upload to ' + key_name)
+    return upload.id, {}
+
+
+def _connection():
+    from boto.s3.connection import OrdinaryCallingFormat, S3Connection
+    if not hasattr(_local, 'connection'):
+        # An S3-compatible endpoint, such as a local stand-in for testing, can be given as http(s)://host:port
+        endpoint = os.environ.get('TOIL_LIB_S3_ENDPOINT')
+        if endpoint:
+            parsed = urlparse(endpoint)
+            _local.connection = S3Connection(host=parsed.hostname, port=parsed.port,
+                                             is_secure=parsed.scheme == 'https',
+                                             calling_format=OrdinaryCallingFormat())
+        else:
+            _local.connection = S3Connection()
+    return _local.connection
+
+
+def _bucket(bucket_name):
+    return _connection().get_bucket(bucket_name, validate=False)
+
+
+def _multipart(bucket_name, key_name, upload_id):
+    from boto.s3.multipart import MultiPartUpload
+    upload = MultiPartUpload(_bucket(bucket_name))
+    upload.key_name = key_name
+    upload.id = upload_id
+    return upload
+
+
+def _retry(function, description):
+    """
+    Calls a function, retrying with exponential backoff on network errors and server errors
+
+    :param function function: Function without arguments
+    :param str description: Description of what function does, for logging
+    :return: The return value of function
+    """
+    from boto.exception import BotoServerError
+    for attempt in xrange(_MAX_ATTEMPTS):
+        last = attempt == _MAX_ATTEMPTS - 1
+        try:
+            return function()
+        except BotoServerError as e:
+            # Client errors won't go away by retrying
+            if e.status < 500 or last:
+                raise
+        except (socket.error, httplib.HTTPException, IOError):
+            if last:
+                raise
+        _log.warn('Retrying %s after attempt %d failed.', description, attempt + 1, exc_info=True)
+        time.sleep(_RETRY_DELAY * 2 ** attempt)
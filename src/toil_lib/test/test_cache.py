@@ -0,0 +1,110 @@
+import os
+import stat
+from multiprocessing.pool import ThreadPool
+
+
+def test_node_cache(tmpdir):
+    from toil_lib.cache import NodeCache
+    cache_dir = os.path.join(str(tmpdir), 'cache')
+    work_dir = str(tmpdir)
+    fills = []
+
+    def fill(content, path):
+        fills.append(path)
+        with open(path, 'w') as f:
+            f.write(content)
+
+    # Concurrent requests for one key share a single fill
+    cache = NodeCache(cache_dir, max_size=10)
+    dests = [os.path.join(work_dir, 'a{}'.format(i)) for i in range(8)]
+    pool = ThreadPool(8)
+    pool.map(lambda dest: cache.get('a', lambda path: fill('aaaa', path), dest), dests)
+    pool.close()
+    assert len(fills) == 1
+    assert (cache.hits, cache.misses) == (7, 1)
+    for dest in dests:
+        with open(dest) as f:
+            assert f.read() == 'aaaa'
+        assert not os.stat(dest).st_mode & stat.S_IWUSR
+    assert os.stat(dests[0]).st_ino == os.stat(dests[1]).st_ino
+    # Directories are handed out file by file
+    def fill_dir(path):
+        os.makedirs(os.path.join(path, 'sub'))
+        fill('bbbb', os.path.join(path, 'sub', 'b'))
+    cache.get('b', fill_dir, os.path.join(work_dir, 'b'))
+    with open(os.path.join(work_dir, 'b', 'sub', 'b')) as f:
+        assert f.read() == 'bbbb'
+    # Going over the budget evicts the least recently used entry, but not what was handed out
+    cache.get('a', lambda path: fill('aaaa', path), os.path.join(work_dir, 'a'))
+    cache.get('c', lambda path: fill('cccc', path), os.path.join(work_dir, 'c'))
+    assert cache.contains('a') and cache.contains('c') and not cache.contains('b')
+    assert os.path.exists(os.path.join(work_dir, 'b', 'sub', 'b'))
+    # Failed fills leave nothing behind
+    def fail(path):
+        fill('dddd', path)
+        raise RuntimeError()
+    try:
+        cache.get('d', fail, os.path.join(work_dir, 'd'))
+    except RuntimeError:
+        pass
+    assert not cache.contains('d')
+    assert not [name for name in os.listdir(cache_dir) if '.tmp-' in name]
+
+
+def test_node_cache_put(tmpdir):
+    from toil_lib.cache import NodeCache
+    cache = NodeCache(os.path.join(str(tmpdir), 'cache'))
+    dest = os.path.join(str(tmpdir), 'dest')
+    assert not cache.lookup('a', dest)
+    assert not os.path.exists(dest)
+    # Entries are created outside the lock and renamed into place, and only the first one put is kept
+    paths = [cache.staging_path() for _ in range(2)]
+    for content, path in zip(['first', 'second'], paths):
+        with open(path, 'w') as f:
+            f.write(content)
+    assert cache.put('a', paths[0])
+    assert not cache.put('a', paths[1])
+    assert not any(os.path.exists(path) for path in paths)
+    assert cache.lookup('a', dest)
+    with open(dest) as f:
+        assert f.read() == 'first'
+    assert not os.stat(dest).st_mode & stat.S_IWUSR
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_download_url_cache(tmpdir):
+    from toil_lib.urls import download_url
+    work_dir = str(tmpdir)
+    cache_dir = os.path.join(work_dir, 'cache')
+    src = os.path.join(work_dir, 'src')
+    with open(src, 'w') as f:
+        f.write('foo')
+    paths = [download_url('file://' + src, work_dir=work_dir, name=name, cache_dir=cache_dir) for name in 'ab']
+    assert os.stat(paths[0]).st_ino == os.stat(paths[1]).st_ino
+    # Changing the file changes its version, so it's downloaded again
+    with open(src, 'w') as f:
+        f.write('foobar')
+    with open(download_url('file://' + src, work_dir=work_dir, name='c', cache_dir=cache_dir)) as f:
+        assert f.read() == 'foobar'
+
+
+def test_download_url_cache_versions(tmpdir, monkeypatch):
+    import hashlib
+    from toil_lib import s3, urls
+    from toil_lib.urls import download_url
+    work_dir = str(tmpdir)
+    cache_dir = os.path.join(work_dir, 'cache')
+    src = os.path.join(work_dir, 'src')
+    with open(src, 'w') as f:
+        f.write('foo')
+    # S3 objects are versioned by their ETag
+    monkeypatch.setattr(s3, 'object_info', lambda url, s3_key_path=None: (3, '"etag"'))
+    assert urls._url_version('s3://bucket/key') == '"etag"'
+    # URLs without a version are only cached with an MD5
+    monkeypatch.setattr(urls, '_url_version', lambda url, s3_key_path=None: None)
+    paths = [download_url('file://' + src, work_dir=work_dir, name=name, cache_dir=cache_dir) for name in 'ab']
+    assert os.stat(paths[0]).st_ino != os.stat(paths[1]).st_ino
+    assert not os.path.exists(cache_dir)
+    md5 = hashlib.md5('foo').hexdigest()
+    paths = [download_url('file://' + src, work_dir=work_dir, name=name, cache_dir=cache_dir, md5=md5) for name in 'cd']
+    assert os.stat(paths[0]).st_ino == os.stat(paths[1]).st_ino
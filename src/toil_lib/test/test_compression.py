@@ -0,0 +1,36 @@
+import gzip
+import os
+import subprocess
+
+
+def test_parallel_gzip_writer(tmpdir):
+    from toil_lib.compression import ParallelGzipWriter
+    work_dir = str(tmpdir)
+    data = os.urandom(100000) + 'a' * 300000
+    for compresslevel in [0, 1, 6, 9]:
+        for threads in [1, 4]:
+            path = os.path.join(work_dir, 'test.gz')
+            with ParallelGzipWriter(path, compresslevel=compresslevel, threads=threads, block_size=10000) as f:
+                for start in xrange(0, len(data), 7777):
+                    f.write(data[start:start + 7777])
+                assert f.tell() == len(data)
+            assert gzip.open(path).read() == data
+            assert subprocess.check_output(['gzip', '-dc', path]) == data
+            if compresslevel:
+                assert os.path.getsize(path) < 200000
+
+
+def test_tarball_files_threads(tmpdir):
+    import tarfile
+    from toil_lib.files import tarball_files
+    work_dir = str(tmpdir)
+    fpaths = []
+    for name in ['a', 'b']:
+        fpaths.append(os.path.join(work_dir, name))
+        with open(fpaths[-1], 'wb') as fout:
+            fout.write(os.urandom(300000))
+    for compresslevel in [0, 9]:
+        tarball_files('test.tar.gz', fpaths, output_dir=work_dir, compresslevel=compresslevel, threads=3)
+        with tarfile.open(os.path.join(work_dir, 'test.tar.gz')) as f_in:
+            assert f_in.getnames() == ['a', 'b']
+            assert f_in.extractfile('b').read() == open(fpaths[1], 'rb').read()
@@ -46,3 +46,102 @@ def _consolidate_tarball_job_setup(job):
     id1 = job.fileStore.writeGlobalFile(fpath1)
     id2 = job.fileStore.writeGlobalFile(fpath2)
     job.addChildJobFn(consolidate_tarballs_job, dict(test1=id1, test2=id2))
+
+
+def test_link_file(tmpdir):
+    import pytest
+    from toil_lib import UserError
+    from toil_lib.files import link_file
+    work_dir = str(tmpdir)
+    src = os.path.join(work_dir, 'src')
+    data = os.urandom(3 * 1024 * 1024 + 7)
+    with open(src, 'wb') as fout:
+        fout.write(data)
+    for strategy in ['hardlink', 'symlink', 'copy']:
+        dest = os.path.join(work_dir, strategy)
+        assert link_file(src, dest, strategies=[strategy]) == strategy
+        with open(dest, 'rb') as fin:
+            assert fin.read() == data
+    assert os.stat(os.path.join(work_dir, 'hardlink')).st_ino == os.stat(src).st_ino
+    assert os.readlink(os.path.join(work_dir, 'symlink')) == src
+    assert os.stat(os.path.join(work_dir, 'copy')).st_ino != os.stat(src).st_ino
+    # Replaces the destination and falls back to copying where reflinks aren't supported
+    assert link_file(src, os.path.join(work_dir, 'hardlink')) in ('reflink', 'copy')
+    assert os.stat(os.path.join(work_dir, 'hardlink')).st_ino != os.stat(src).st_ino
+    with pytest.raises(UserError):
+        link_file(src, src)
+    with pytest.raises(UserError):
+        link_file(src, os.path.join(work_dir, 'foo'), strategies=['move'])
+
+
+def test_consolidate_tarballs_streaming(tmpdir):
+    options = Job.Runner.getDefaultOptions(os.path.join(str(tmpdir), 'test_store'))
+    Job.Runner.startToil(Job.wrapJobFn(_consolidate_tarballs_streaming_setup), options)
+
+
+def _consolidate_tarballs_streaming_setup(job):
+    from toil_lib.files import consolidate_tarballs_job, consolidate_tarballs_tree_job
+    work_dir = job.fileStore.getLocalTempDir()
+    fname_to_id = {}
+    for i in range(5):
+        fpath = os.path.join(work_dir, 'output_file')
+        with open(fpath, 'wb') as fout:
+            fout.write(str(i) * 1024)
+        tar_path = os.path.join(work_dir, 'test{}.tar.gz'.format(i))
+        with tarfile.open(tar_path, 'w:gz') as f_out:
+            f_out.add(fpath, arcname='output_file')
+        fname_to_id['test{}'.format(i)] = job.fileStore.writeGlobalFile(tar_path)
+    streamed = job.addChildJobFn(consolidate_tarballs_job, fname_to_id, stream=True).rv()
+    merged = job.addChildJobFn(consolidate_tarballs_tree_job, fname_to_id, fan_in=2).rv()
+    job.addFollowOnJobFn(_check_consolidated_tarballs, [streamed, merged], len(fname_to_id))
+
+
+def _check_consolidated_tarballs(job, tar_ids, num_tarballs):
+    for tar_id in tar_ids:
+        with tarfile.open(job.fileStore.readGlobalFile(tar_id), 'r:gz') as f_in:
+            names = sorted(f_in.getnames())
+            assert names == ['foo.tar.gz/test{}/output_file'.format(i) for i in range(num_tarballs)]
+            for i in range(num_tarballs):
+                assert f_in.extractfile(names[i]).read() == str(i) * 1024
+
+
+def test_extract_member(tmpdir):
+    import json
+    from toil_lib.files import extract_member, tarball_files
+    work_dir = str(tmpdir)
+    fpaths = []
+    for name in ['abundance.tsv', 'run_info.json', 'a' * 150]:
+        fpaths.append(os.path.join(work_dir, name))
+        with open(fpaths[-1], 'wb') as fout:
+            fout.write(name * 1000)
+    tarball_files('kallisto.tar.gz', fpaths, output_dir=work_dir, threads=2, seekable=True)
+    tar_path = os.path.join(work_dir, 'kallisto.tar.gz')
+    with open(tar_path + '.idx') as f:
+        assert [m['name'] for m in json.load(f)['members']] == [os.path.basename(p) for p in fpaths]
+    # Still an ordinary tarball
+    with tarfile.open(tar_path) as f_in:
+        assert f_in.getnames() == [os.path.basename(p) for p in fpaths]
+    os.mkdir(os.path.join(work_dir, 'out'))
+    for name in ['run_info.json', 'a' * 150]:
+        path = extract_member(tar_path, name, os.path.join(work_dir, 'out'))
+        with open(path) as f:
+            assert f.read() == name * 1000
+
+
+def test_tarball_to_filestore(tmpdir):
+    options = Job.Runner.getDefaultOptions(os.path.join(str(tmpdir), 'test_store'))
+    Job.Runner.startToil(Job.wrapJobFn(_tarball_to_filestore_job), options)
+
+
+def _tarball_to_filestore_job(job):
+    from toil_lib.files import tarball_to_filestore
+    work_dir = job.fileStore.getLocalTempDir()
+    fpaths = [os.path.join(work_dir, name) for name in ['a', 'b']]
+    for fpath in fpaths:
+        with open(fpath, 'wb') as fout:
+            fout.write(fpath)
+    tar_id = tarball_to_filestore(job, fpaths, prefix='out_', remove_inputs=True)
+    assert not any(os.path.exists(fpath) for fpath in fpaths)
+    with tarfile.open(job.fileStore.readGlobalFile(tar_id), 'r:gz') as f_in:
+        assert f_in.getnames() == ['out_a', 'out_b']
+        assert f_in.extractfile('out_b').read() == fpaths[1]
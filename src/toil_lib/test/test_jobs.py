@@ -19,3 +19,159 @@ def _test_batch(job, sample, a, b, c):
     assert a == 'a'
     assert b == 'b'
     assert c == 'c'
+
+
+def test_balanced_map_job():
+    from toil_lib.jobs import balanced_map_job
+    work_dir = tempfile.mkdtemp()
+    options = Job.Runner.getDefaultOptions(os.path.join(work_dir, 'test_store'))
+    options.workDir = work_dir
+    out_dir = os.path.join(work_dir, 'out')
+    os.mkdir(out_dir)
+    samples = range(25)
+    j = Job.wrapJobFn(balanced_map_job, _touch_sample, samples, args=(out_dir,), branching_factor=3,
+                      weights=[x % 5 + 1 for x in samples], leaf_batch=2, disk='1K')
+    Job.Runner.startToil(j, options)
+    assert sorted(int(x) for x in os.listdir(out_dir)) == samples
+
+
+def _touch_sample(job, sample, out_dir):
+    open(os.path.join(out_dir, str(sample)), 'w').close()
+
+
+def test_map_reduce_job():
+    work_dir = tempfile.mkdtemp()
+    options = Job.Runner.getDefaultOptions(os.path.join(work_dir, 'test_store'))
+    options.workDir = work_dir
+    Job.Runner.startToil(Job.wrapJobFn(_map_reduce_setup), options)
+
+
+def _map_reduce_setup(job):
+    from toil_lib.jobs import map_reduce_job
+    total = job.addChildJobFn(map_reduce_job, _square, _sum, range(20), fan_in=3, args=(2,)).rv()
+    job.addFollowOnJobFn(_check_total, total, sum(x ** 2 + 2 for x in range(20)))
+
+
+def _square(job, x, c):
+    return x ** 2 + c
+
+
+def _sum(job, results):
+    assert len(results) <= 3
+    return sum(results)
+
+
+def _check_total(job, total, expected):
+    assert total == expected
+
+
+def test_manifest():
+    work_dir = tempfile.mkdtemp()
+    options = Job.Runner.getDefaultOptions(os.path.join(work_dir, 'test_store'))
+    options.workDir = work_dir
+    out_dir = os.path.join(work_dir, 'out')
+    os.mkdir(out_dir)
+    Job.Runner.startToil(Job.wrapJobFn(_manifest_setup, out_dir), options)
+    assert sorted(int(x) for x in os.listdir(out_dir)) == range(50)
+
+
+def _manifest_setup(job, out_dir):
+    from toil_lib import ipartitions
+    from toil_lib.jobs import map_manifest_job
+    from toil_lib.manifest import Manifest
+    manifest = Manifest.write(job, ((x, 's3://bucket/{}.bam'.format(x)) for x in xrange(50)))
+    samples = list(manifest.samples(job))
+    assert samples[7] == ['7', 's3://bucket/7.bam']
+    # Every line is in exactly one part, however the bytes are split
+    for num_parts in [2, 7, 1000]:
+        parts = manifest.split(num_parts)
+        assert [s for part in parts for s in part.samples(job)] == samples
+    assert [len(p) for p in ipartitions(manifest.samples(job), 20)] == [20, 20, 10]
+    job.addChildJobFn(map_manifest_job, _touch_manifest_sample, manifest, args=(out_dir,), branching_factor=4)
+
+
+def _touch_manifest_sample(job, sample, out_dir):
+    open(os.path.join(out_dir, sample[0]), 'w').close()
+
+
+def test_manifest_streams_range():
+    from argparse import Namespace
+    from contextlib import contextmanager
+    from StringIO import StringIO
+    from toil_lib.manifest import Manifest
+    data = ''.join('{}\tsample\n'.format(x) for x in xrange(1000))
+    reads = []
+
+    class Stream(StringIO):
+        """Can't seek, like the streams of some job stores"""
+
+        def seek(self, *args):
+            raise IOError('Illegal seek')
+
+        def read(self, n=-1):
+            reads.append(n)
+            return StringIO.read(self, n)
+
+        def readline(self, n=-1):
+            line = StringIO.readline(self, n)
+            reads.append(len(line))
+            return line
+
+    class FileStore(object):
+        @contextmanager
+        def readGlobalFileStream(self, file_id):
+            yield Stream(data) if file_id == 'seekless' else StringIO(data)
+
+    job = Namespace(fileStore=FileStore())
+    parts = Manifest('id', 0, len(data)).split(10)
+    assert [int(s[0]) for part in parts for s in part.samples(job)] == range(1000)
+    part = Manifest('seekless', 0, len(data)).split(10)[1]
+    assert list(part.samples(job)) == list(parts[1].samples(job))
+    # Nothing after the range and its last line is read
+    assert sum(reads) <= part.end + len('999\tsample\n')
+
+
+def test_resource_requirements():
+    from toil_lib.jobs import balanced_map_job
+    work_dir = tempfile.mkdtemp()
+    options = Job.Runner.getDefaultOptions(os.path.join(work_dir, 'test_store'))
+    options.workDir = work_dir
+    out_dir = os.path.join(work_dir, 'out')
+    os.mkdir(out_dir)
+    j = Job.wrapJobFn(balanced_map_job, _record_memory, range(6), args=(out_dir,), branching_factor=4,
+                      requirements=_sample_requirements, disk='1K')
+    Job.Runner.startToil(j, options)
+    for sample in range(6):
+        with open(os.path.join(out_dir, str(sample))) as f:
+            assert int(f.read()) == _sample_requirements(sample)['memory']
+
+
+def _sample_requirements(sample):
+    return dict(cores=1, memory=(sample + 1) * 1024 ** 2, disk=1024)
+
+
+def _record_memory(job, sample, out_dir):
+    with open(os.path.join(out_dir, str(sample)), 'w') as f:
+        f.write(str(job.memory))
+
+
+def test_resource_estimator():
+    import pickle
+    from argparse import Namespace
+    from toil.fileStore import FileID
+    from toil_lib.tools.resources import estimate_requirements, resource_estimator
+    g = 1024 ** 3
+    reference = tempfile.mktemp()
+    with open(reference, 'w') as f:
+        f.truncate(3 * g)
+    # Reference files are recognized among the attributes of a config, and its other strings are ignored
+    estimator = pickle.loads(pickle.dumps(resource_estimator('run_bwakit', ['file://' + reference], cores=8)))
+    config = Namespace(r1=FileID('r1', 10 * g), r2=FileID('r2', 10 * g), ref='file://' + reference, uuid='sample')
+    assert estimator(config) == dict(cores=8, memory=6 * g, disk=63 * g)
+    # Requirements grow with deeper samples, up to a cap
+    small, large = [estimate_requirements('run_indel_realignment', [size * g], [4 * g])
+                    for size in 8, 1000]
+    assert small['memory'] < large['memory'] == 32 * g
+    assert small['disk'] < large['disk']
+    assert estimate_requirements('run_star', [])['memory'] == 4 * g
+    os.remove(reference)
@@ -0,0 +1,118 @@
+import os
+from uuid import uuid4
+
+import pytest
+from toil.job import Job
+
+from toil_lib.memoize import memoize
+
+
+def test_memoize(tmpdir, monkeypatch):
+    from toil_lib.memoize import memo_stats
+    work_dir = str(tmpdir)
+    memo_dir = os.path.join(work_dir, 'memo')
+    calls_dir = os.path.join(work_dir, 'calls')
+    os.mkdir(calls_dir)
+    monkeypatch.setenv('TOIL_LIB_MEMO_DIR', memo_dir)
+    # Two separate workflows, each counting the same lines twice and different lines once
+    for run in range(2):
+        options = Job.Runner.getDefaultOptions(os.path.join(work_dir, 'store{}'.format(run)))
+        options.workDir = work_dir
+        Job.Runner.startToil(Job.wrapJobFn(_memoize_setup, calls_dir), options)
+    # Only the first workflow's first call of each distinct input computed anything
+    assert len(os.listdir(calls_dir)) == 2
+    assert memo_stats(memo_dir) == dict(hits=4, misses=2)
+
+
+def _memoize_setup(job, calls_dir):
+    with job.fileStore.writeGlobalFileStream() as (f, file_id):
+        f.write('a\nb\n')
+    with job.fileStore.writeGlobalFileStream() as (f, other_id):
+        f.write('a\nb\nc\n')
+    first = job.addChildJobFn(_count_lines, file_id, calls_dir)
+    second = first.addChildJobFn(_count_lines, file_id, calls_dir)
+    third = second.addChildJobFn(_count_lines, other_id, calls_dir)
+    job.addFollowOnJobFn(_check_counts, [first.rv(), second.rv(), third.rv()])
+
+
+@memoize(images=['quay.io/ucsc_cgl/wc:1.0'], file_args=['file_id'], file_results=[0])
+def _count_lines(job, file_id, calls_dir):
+    open(os.path.join(calls_dir, str(uuid4())), 'w').close()
+    with job.fileStore.readGlobalFileStream(file_id) as f:
+        count = len(f.readlines())
+    with job.fileStore.writeGlobalFileStream() as (f, count_id):
+        f.write(str(count))
+    return count_id, dict(count=count)
+
+
+def _check_counts(job, results):
+    assert [x[1]['count'] for x in results] == [2, 2, 3]
+    for count_id, info in results:
+        with job.fileStore.readGlobalFileStream(count_id) as f:
+            assert int(f.read()) == info['count']
+
+
+def test_memo_key(tmpdir, monkeypatch):
+    from argparse import Namespace
+    from toil_lib.memoize import _Uncacheable, _memo_key
+    monkeypatch.delenv('TOIL_SCRIPTS_MOCK_MODE', raising=False)
+    monkeypatch.delenv('TOIL_LIB_EXECUTOR', raising=False)
+    probes = []
+    job = Namespace(fileStore=Namespace(jobStore=Namespace(fileExists=lambda x: probes.append(x) or True)))
+
+    def func(job, sample, ref_url, config=None):
+        pass
+
+    def key(*args, **kwargs):
+        return _memo_key(job, str(tmpdir), func, [], [], args, kwargs)
+
+    ref = os.path.join(str(tmpdir), 'ref')
+    with open(ref, 'w') as f:
+        f.write('a')
+    first = key('sample', 'file://' + ref, config=Namespace(rg_line='@RG'))
+    assert key('sample', ref_url='file://' + ref, config=Namespace(rg_line='@RG')) == first
+    # Strings that aren't declared as files aren't looked up in the job store
+    assert not probes
+    # Mock runs and runs outside of Docker are keyed separately
+    monkeypatch.setenv('TOIL_SCRIPTS_MOCK_MODE', '1')
+    assert key('sample', 'file://' + ref, config=Namespace(rg_line='@RG')) != first
+    monkeypatch.setenv('TOIL_SCRIPTS_MOCK_MODE', '0')
+    monkeypatch.setenv('TOIL_LIB_EXECUTOR', 'local')
+    assert key('sample', 'file://' + ref, config=Namespace(rg_line='@RG')) != first
+    monkeypatch.delenv('TOIL_LIB_EXECUTOR')
+    # Changing the file behind a URL changes the key, and URLs without a version aren't memoized
+    with open(ref, 'w') as f:
+        f.write('ab')
+    assert key('sample', 'file://' + ref, config=Namespace(rg_line='@RG')) != first
+    with pytest.raises(_Uncacheable):
+        key('sample', 'ftp://host/ref')
+
+
+def test_store(tmpdir):
+    from argparse import Namespace
+    from toil_lib.memoize import _load, _store
+    reads, probes = [], []
+
+    def read(file_id, mutable=None):
+        reads.append((file_id, mutable))
+        path = os.path.join(str(tmpdir), file_id)
+        with open(path, 'w') as f:
+            f.write(file_id)
+        return path
+
+    job = Namespace(fileStore=Namespace(readGlobalFile=read, writeGlobalFile=lambda path: 'new-' + open(path).read(),
+                                        jobStore=Namespace(fileExists=lambda x: probes.append(x) or True)))
+    # Only the declared parts of the result are files, and the job store isn't asked about the others
+    result = ('bam', ['bai', 'tbi'], 'sample', 3)
+    for i, file_results in enumerate([[0, 1, 5], [None]]):
+        path = os.path.join(str(tmpdir), 'entry{}'.format(i))
+        _store(job, result, file_results, path)
+        assert not probes
+        assert all(mutable is False for _, mutable in reads)
+        if i == 0:
+            assert _load(job, path) == ('new-bam', ['new-bai', 'new-tbi'], 'sample', 3)
+    assert [file_id for file_id, _ in reads] == ['bam', 'bai', 'tbi', 'bam', 'bai', 'tbi', 'sample']
+    path = os.path.join(str(tmpdir), 'dict')
+    _store(job, dict(vcf='vcf', name='sample'), ['vcf'], path)
+    assert _load(job, path) == dict(vcf='new-vcf', name='sample')
+
@@ -1,4 +1,6 @@
 import os
+import subprocess
+import time
 
 
 def test_docker_call(tmpdir):
@@ -12,3 +14,204 @@ def test_docker_call(tmpdir):
     with open(fpath, 'w') as f:
         docker_call(tool='ubuntu', env=dict(foo='bar'), parameters=['printenv', 'foo'], outfile=f)
     assert open(fpath).read() == 'bar\n'
+
+
+def test_docker_session(tmpdir):
+    from toil_lib.programs import docker_call, DockerSession
+    work_dir = str(tmpdir)
+    tool = 'quay.io/ucsc_cgl/samtools'
+    with DockerSession(tool, work_dir) as session:
+        docker_call(tool=tool, work_dir=work_dir, parameters=['--help'], session=session)
+        docker_call(tool=tool, work_dir=work_dir, parameters=['--help'], session=session)
+    assert session.container_id is None
+
+
+def test_docker_sessions(tmpdir):
+    from toil_lib.programs import docker_call, DockerSessions
+    work_dir = str(tmpdir)
+    tools = ['quay.io/ucsc_cgl/samtools', 'ubuntu']
+    with DockerSessions(work_dir) as sessions:
+        docker_call(tool=tools[0], work_dir=work_dir, parameters=['--help'], session=sessions)
+        docker_call(tool=tools[1], work_dir=work_dir, parameters=['touch', '/data/test'], session=sessions)
+        docker_call(tool=tools[1], work_dir=work_dir, parameters=['true'], session=sessions)
+        assert sorted(sessions.sessions) == tools
+        containers = [session.container_id for session in sessions.sessions.values()]
+    assert sessions.sessions == {}
+    assert os.stat(os.path.join(work_dir, 'test')).st_uid == os.stat(work_dir).st_uid
+    assert all(subprocess.call(['docker', 'inspect', cid], stdout=open(os.devnull, 'w'),
+                               stderr=subprocess.STDOUT) for cid in containers)
+
+
+def test_chown_parameters(tmpdir):
+    from toil_lib.programs import _chown_parameters
+    work_dir = str(tmpdir)
+    stat = os.stat(work_dir)
+    owner = '{}:{}'.format(stat.st_uid, stat.st_gid)
+    os.mkdir(os.path.join(work_dir, 'subdir'))
+    os.mkdir(os.path.join(work_dir, 'created_dir'))
+    for name in ['existing', os.path.join('subdir', 'created'), os.path.join('created_dir', 'output')]:
+        open(os.path.join(work_dir, name), 'w').close()
+    assert _chown_parameters(work_dir, 'chown') == [['-R', owner, '/data']]
+    assert _chown_parameters(work_dir, 'user') == []
+    assert _chown_parameters(work_dir, 'created') == []
+    if os.getuid() == 0:
+        # Simulate files created by a container running as a different user
+        os.chown(os.path.join(work_dir, 'subdir', 'created'), stat.st_uid + 1, stat.st_gid)
+        os.chown(os.path.join(work_dir, 'created_dir'), stat.st_uid + 1, stat.st_gid)
+        assert sorted(_chown_parameters(work_dir, 'created')[0]) == sorted(
+            ['-R', owner, '/data/subdir/created', '/data/created_dir'])
+
+
+def test_chown_parameters_snapshot(tmpdir):
+    from toil_lib.programs import _chown_parameters, _snapshot
+    work_dir = str(tmpdir)
+    stat = os.stat(work_dir)
+    owner = '{}:{}'.format(stat.st_uid, stat.st_gid)
+    for name in ['unchanged', 'changed']:
+        os.mkdir(os.path.join(work_dir, name))
+        open(os.path.join(work_dir, name, 'existing'), 'w').close()
+    assert _snapshot(work_dir, 'chown') is None
+    snapshot = _snapshot(work_dir, 'created')
+    assert sorted(snapshot) == ['changed', 'unchanged']
+    # Pretend the container wrote to the changed directory after the snapshot was taken
+    snapshot['changed'] = (snapshot['changed'][0] - 10, True)
+    os.mkdir(os.path.join(work_dir, 'created_dir'))
+    open(os.path.join(work_dir, 'created_dir', 'output'), 'w').close()
+    assert _chown_parameters(work_dir, 'created', snapshot) == []
+    if os.getuid() == 0:
+        for name in ['unchanged/existing', 'changed/existing', 'created_dir']:
+            os.chown(os.path.join(work_dir, name), stat.st_uid + 1, stat.st_gid)
+        # Files in directories whose listing didn't change aren't looked at
+        assert sorted(_chown_parameters(work_dir, 'created', snapshot)[0]) == sorted(
+            ['-R', owner, '/data/changed/existing', '/data/created_dir'])
+
+
+def test_docker_call_as_user(tmpdir):
+    from toil_lib.programs import docker_call
+    work_dir = str(tmpdir)
+    docker_call(tool='ubuntu', work_dir=work_dir, parameters=['touch', '/data/test'], permissions='user')
+    assert os.stat(os.path.join(work_dir, 'test')).st_uid == os.stat(work_dir).st_uid
+
+
+def test_docker_pipeline(tmpdir):
+    from toil_lib.programs import docker_pipeline
+    work_dir = str(tmpdir)
+    stages = [('ubuntu', ['printf', 'foo\\nbar\\n']), ('ubuntu', ['tr', 'a-z', 'A-Z'])]
+    assert list(docker_pipeline(stages, work_dir=work_dir)) == ['FOO\n', 'BAR\n']
+    # Test outfile
+    fpath = os.path.join(work_dir, 'test')
+    with open(fpath, 'w') as f:
+        docker_pipeline(stages, work_dir=work_dir, outfile=f)
+    assert open(fpath).read() == 'FOO\nBAR\n'
+
+
+def test_pull_images():
+    from toil_lib.programs import pull_images, docker_call, pull_waits
+    tool = 'quay.io/ucsc_cgl/samtools'
+    assert set(pull_images([tool, 'ubuntu'])) == {tool, 'ubuntu'}
+    # Pulled images are not waited on again
+    waited = pull_waits[tool]
+    docker_call(tool=tool, parameters=['--help'])
+    assert pull_waits[tool] == waited
+
+
+def test_docker_call_metrics(tmpdir):
+    from toil_lib.programs import docker_call
+    metrics = []
+    docker_call(tool='ubuntu', work_dir=str(tmpdir), parameters=['sleep', '2'], metrics=metrics)
+    assert len(metrics) == 1
+    assert metrics[0].tool == 'ubuntu'
+    assert metrics[0].wall_time >= 2
+
+
+def test_docker_call_metrics_short(tmpdir):
+    from toil_lib.programs import docker_call
+    metrics = []
+    docker_call(tool='ubuntu', work_dir=str(tmpdir), parameters=['true'], metrics=metrics)
+    assert metrics[0].wall_time < 1
+    for field in ['cpu_time', 'peak_rss', 'bytes_read', 'bytes_written', 'run_time']:
+        assert getattr(metrics[0], field) is not None
+
+
+def test_container_monitor_short(tmpdir, monkeypatch):
+    from toil_lib import programs
+    cidfile = tmpdir.join('cid')
+    cidfile.write('foo')
+    # A container whose cgroup only exists between 20 and 70 milliseconds after the monitor started
+    stats = dict(cpu_time=0.01, rss=1024, peak_rss=2048, bytes_read=10, bytes_written=20)
+    monkeypatch.setattr(programs, '_cgroup_stats', lambda cid: stats if 0.02 < time.time() - start < 0.07 else None)
+    monkeypatch.setattr(programs, '_container_run_time', lambda cid: 0.05)
+    start = time.time()
+    monitor = programs._ContainerMonitor(cidfile=str(cidfile))
+    monitor.start()
+    time.sleep(0.2)
+    record = monitor.stop('ubuntu', wall_time=0.2, pull_time=0.0)
+    assert record.cpu_time == 0.01
+    assert record.peak_rss == 2048
+    assert record.run_time == 0.05
+
+
+def test_cgroup_stats(tmpdir, monkeypatch):
+    from toil_lib import programs
+    monkeypatch.setattr(programs, '_CGROUP_ROOT', str(tmpdir))
+    assert programs._cgroup_stats('foo') is None
+    # cgroup v2 with the systemd driver
+    scope = tmpdir.mkdir('system.slice').mkdir('docker-foo.scope')
+    scope.join('cgroup.controllers').write('cpu io memory')
+    scope.join('cpu.stat').write('usage_usec 2500000\nuser_usec 2000000\nsystem_usec 500000\n')
+    scope.join('memory.current').write('1024\n')
+    scope.join('memory.peak').write('4096\n')
+    scope.join('io.stat').write('8:0 rbytes=100 wbytes=200 rios=1 wios=2\n8:16 rbytes=10 wbytes=20 rios=1 wios=2\n')
+    assert programs._cgroup_stats('foo') == dict(cpu_time=2.5, rss=1024, peak_rss=4096,
+                                                 bytes_read=110, bytes_written=220)
+    # cgroup v1 with the cgroupfs driver
+    for controller, name, value in [('cpuacct', 'cpuacct.usage', '3000000000'),
+                                    ('memory', 'memory.usage_in_bytes', '1024'),
+                                    ('memory', 'memory.max_usage_in_bytes', '2048'),
+                                    ('blkio', 'blkio.throttle.io_service_bytes',
+                                     '8:0 Read 100\n8:0 Write 200\n8:0 Total 300\nTotal 300\n')]:
+        tmpdir.ensure(controller, 'docker', 'bar', name).write(value)
+    assert programs._cgroup_stats('bar') == dict(cpu_time=3.0, rss=1024, peak_rss=2048,
+                                                 bytes_read=100, bytes_written=200)
+
+
+def test_local_executor(tmpdir, monkeypatch):
+    from toil_lib.programs import docker_call, docker_pipeline, default_executor, LocalExecutor
+    work_dir = str(tmpdir)
+    with open(os.path.join(work_dir, 'input'), 'w') as f:
+        f.write('foo\n')
+    # Images map to the executable named after the repository, and /data is rewritten to the work directory
+    executor = LocalExecutor()
+    metrics = []
+    output = docker_call(tool='quay.io/ucsc_cgl/cat:1.0', parameters=['/data/input'], work_dir=work_dir,
+                         check_output=True, executor=executor, metrics=metrics)
+    assert output == 'foo\n'
+    assert metrics[0].cpu_time is not None
+    lines = docker_pipeline([('cat', ['/data/input']), ('quay.io/ucsc_cgl/upper', ['a-z', 'A-Z'])],
+                            work_dir=work_dir, executor=LocalExecutor(commands={'quay.io/ucsc_cgl/upper': ['tr']}))
+    assert list(lines) == ['FOO\n']
+    monkeypatch.setenv('TOIL_LIB_EXECUTOR', 'local')
+    monkeypatch.setenv('TOIL_LIB_LOCAL_COMMANDS', '{"ubuntu": ["env"]}')
+    assert 'foo=bar' in docker_call(tool='ubuntu', env=dict(foo='bar'), work_dir=work_dir,
+                                    check_output=True, executor=default_executor())
+
+
+def test_run_concurrently():
+    from toil_lib.programs import run_concurrently, ConcurrentCallError
+    assert run_concurrently([lambda: 1, lambda: 2, lambda: 3], num_threads=2) == [1, 2, 3]
+    calls = []
+    try:
+        run_concurrently([lambda: 1 / 0, lambda: calls.append(1), lambda: int('a')], num_threads=2)
+    except ConcurrentCallError as e:
+        assert [i for i, _ in e.errors] == [0, 2]
+    else:
+        assert False
+    # Calls after a failure still run
+    assert calls == [1]
+
+
+def test_docker_call_many(tmpdir):
+    from toil_lib.programs import docker_call_many
+    work_dir = str(tmpdir)
+    calls = [dict(tool='ubuntu', work_dir=work_dir, parameters=['echo', str(i)], check_output=True) for i in range(4)]
+    assert docker_call_many(calls, num_threads=2) == ['0\n', '1\n', '2\n', '3\n']
@@ -0,0 +1,150 @@
+import base64
+import hashlib
+import os
+import shutil
+from StringIO import StringIO
+
+import pytest
+
+
+def test_sse_headers(tmpdir):
+    from toil_lib.s3 import sse_headers
+    key_path = os.path.join(str(tmpdir), 'foo.key')
+    master_key = os.urandom(32)
+    with open(key_path, 'wb') as f:
+        f.write(master_key)
+    assert sse_headers('s3://bucket/key', None) == {}
+    headers = sse_headers('s3://bucket/key', key_path)
+    # Same derivation as s3am --sse-key-is-master
+    key = base64.b64decode(headers['x-amz-server-side-encryption-customer-key'])
+    assert key == hashlib.sha256(master_key + 's3://bucket/key').digest()
+    assert headers != sse_headers('s3://bucket/other', key_path)
+
+
+def test_resolve_engine(monkeypatch):
+    from toil_lib import UserError
+    from toil_lib.s3 import resolve_engine
+    monkeypatch.delenv('TOIL_LIB_S3_ENGINE', raising=False)
+    assert resolve_engine() == 's3am'
+    monkeypatch.setenv('TOIL_LIB_S3_ENGINE', 'boto')
+    assert resolve_engine() == 'boto'
+    assert resolve_engine('s3am') == 's3am'
+    with pytest.raises(UserError):
+        resolve_engine('curl')
+
+
+def test_boto_engine(tmpdir, monkeypatch):
+    pytest.importorskip('boto')
+    moto = pytest.importorskip('moto')
+    from boto.s3.connection import S3Connection
+    from boto.s3.multipart import MultiPartUpload
+    from toil_lib import s3
+    from toil_lib.programs import ConcurrentCallError
+    from toil_lib.urls import download_url, s3am_upload
+    monkeypatch.setattr(s3, '_RETRY_DELAY', 0)
+    work_dir = str(tmpdir)
+    monkeypatch.setattr(s3, '_RECORD_DIR', os.path.join(work_dir, 'records'))
+    part_size = 5 * 1024 * 1024
+    monkeypatch.setattr(s3, 'PART_SIZE', part_size)
+    data = os.urandom(2 * part_size + 1000)
+    fpath = os.path.join(work_dir, 'upload_file')
+    with open(fpath, 'wb') as f:
+        f.write(data)
+    # Parts are uploaded by one thread, since moto's mock isn't thread-safe
+    with getattr(moto, 'mock_s3_deprecated', moto.mock_s3)():
+        S3Connection().create_bucket('bucket')
+        # Fail the second part once, which leaves the upload open with only the other parts
+        upload_part = MultiPartUpload.upload_part_from_file
+        uploaded = []
+        failures = [2]
+
+        def flaky_upload_part(self, fp, part_num, **kwargs):
+            uploaded.append(part_num)
+            if part_num in failures:
+                failures.remove(part_num)
+                raise ValueError('Injected failure')
+            return upload_part(self, fp, part_num, **kwargs)
+
+        monkeypatch.setattr(MultiPartUpload, 'upload_part_from_file', flaky_upload_part)
+        with pytest.raises(ConcurrentCallError):
+            s3.upload_file(fpath, 's3://bucket/dir/upload_file')
+        # Resuming skips the parts that were uploaded. Reading stops after a failure, so the last part may be missing.
+        del uploaded[:]
+        s3am_upload(fpath, 's3://bucket/dir', s3_engine='boto')
+        assert 2 in uploaded and 1 not in uploaded
+        download_url('s3://bucket/dir/upload_file', work_dir=work_dir, name='download_file', s3_engine='boto',
+                     num_connections=1, cache_dir=False, md5=hashlib.md5(data).hexdigest())
+        with open(os.path.join(work_dir, 'download_file'), 'rb') as f:
+            assert f.read() == data
+
+        def check(url, expected):
+            bucket_name, key_name = s3.split_s3_url(url)
+            assert S3Connection().get_bucket(bucket_name).get_key(key_name).get_contents_as_string() == expected
+
+        # An earlier, longer attempt leaves parts beyond the end of a shorter object, which are left out of it
+        longer = os.urandom(4 * part_size + 1000)
+        failures.append(5)
+        with pytest.raises(ConcurrentCallError):
+            s3.upload_stream(StringIO(longer), 's3://bucket/stream')
+        s3.upload_stream(StringIO(data), 's3://bucket/stream')
+        check('s3://bucket/stream', data)
+        # When the size is known, such an upload is aborted
+        failures.append(5)
+        with pytest.raises(ConcurrentCallError):
+            s3.upload_stream(StringIO(longer), 's3://bucket/sized')
+        del uploaded[:]
+        s3.upload_file(fpath, 's3://bucket/sized')
+        assert uploaded == [1, 2, 3]
+        check('s3://bucket/sized', data)
+        assert not S3Connection().get_bucket('bucket').get_all_multipart_uploads()
+        # Encrypted parts are only skipped if their MD5 was recorded when they were uploaded
+        key_path = os.path.join(work_dir, 'foo.key')
+        with open(key_path, 'wb') as f:
+            f.write(os.urandom(32))
+        for url, records in [('s3://bucket/encrypted', True), ('s3://bucket/moved', False)]:
+            failures.append(3)
+            with pytest.raises(ConcurrentCallError):
+                s3.upload_file(fpath, url, s3_key_path=key_path)
+            if not records:
+                shutil.rmtree(s3._RECORD_DIR)
+            del uploaded[:]
+            s3.upload_file(fpath, url, s3_key_path=key_path)
+            assert uploaded == ([3] if records else [1, 2, 3])
+        assert not os.listdir(s3._RECORD_DIR)
+
+
+def test_upload_stream(monkeypatch):
+    from argparse import Namespace
+    from toil_lib import s3
+    uploaded = {}
+    reads = []
+
+    class FakeUpload(object):
+        def upload_part_from_file(self, fp, part_num, headers=None, md5=None, size=None):
+            data = fp.read()
+            assert len(data) == size and md5[0] == hashlib.md5(data).hexdigest()
+            uploaded[part_num] = data
+            return Namespace(etag='"{}"'.format(md5[0]))
+
+    class FakeBucket(object):
+        def complete_multipart_upload(self, key_name, upload_id, xml_body):
+            uploaded['complete'] = xml_body
+
+    class Stream(StringIO):
+        def read(self, n=-1):
+            # Short reads, like a pipe
+            data = StringIO.read(self, min(n, 3))
+            reads.append(len(data))
+            return data
+
+    monkeypatch.setattr(s3, '_retry', lambda function, description: function())
+    monkeypatch.setattr(s3, '_multipart', lambda bucket_name, key_name, upload_id: FakeUpload())
+    monkeypatch.setattr(s3, '_bucket', lambda bucket_name: FakeBucket())
+    monkeypatch.setattr(s3, '_resume_upload', lambda bucket_name, key_name, headers, num_parts: (
+        'id', {1: (10, hashlib.md5('a' * 10).hexdigest()), 4: (10, 'stale')}))
+    data = 'a' * 10 + 'b' * 10 + 'c' * 5
+    s3.upload_stream(Stream(data), 's3://bucket/key', num_threads=2, part_size=10)
+    # The first part was already uploaded, and the object is completed with exactly its own parts
+    assert uploaded.pop('complete').count('<PartNumber>') == 3
+    assert uploaded == {2: 'b' * 10, 3: 'c' * 5}
+    assert sum(reads) == len(data)
@@ -0,0 +1,49 @@
+import os
+import stat
+import sys
+
+import pytest
+
+
+def test_estimate_insert_size(tmpdir):
+    pytest.importorskip('numpy')
+    _check_estimate_insert_size(tmpdir)
+
+
+def test_estimate_insert_size_without_numpy(tmpdir, monkeypatch):
+    # Importing a module that is None in sys.modules raises ImportError
+    monkeypatch.setitem(sys.modules, 'numpy', None)
+    _check_estimate_insert_size(tmpdir)
+
+
+def _check_estimate_insert_size(tmpdir):
+    from toil_lib.programs import LocalExecutor
+    from toil_lib.tools import estimate_insert_size, get_mean_insert_size
+    from toil_lib.tools.images import SAMTOOLS
+    work_dir = str(tmpdir)
+    args_path = os.path.join(work_dir, 'args')
+    # Stands in for samtools, with two indexed chromosomes and an endless stream of reads, every 100th an outlier
+    script = os.path.join(work_dir, 'samtools')
+    with open(script, 'w') as f:
+        f.write('#!{}\n'.format(sys.executable) +
+                'import itertools, sys\n'
+                'if sys.argv[1] == "idxstats":\n'
+                '    sys.stdout.write("1\\t1000000\\t400000\\t0\\n2\\t1000000\\t400000\\t0\\n*\\t0\\t0\\t10\\n")\n'
+                '    sys.exit(0)\n'
+                'open({!r}, "w").write(" ".join(sys.argv[1:]))\n'.format(args_path) +
+                'for i in itertools.count():\n'
+                '    tlen = (290 + i % 21) * (1 if i % 2 else -1) if i % 100 else 9000\n'
+                '    sys.stdout.write("r%d\\t99\\t1\\t1\\t60\\t100M\\t=\\t1\\t%d\\tA\\t!\\n" % (i, tlen))\n')
+    os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR)
+    executor = LocalExecutor({SAMTOOLS: [script]})
+    stats = estimate_insert_size(work_dir, 'sample.bam', max_reads=1000, num_regions=4, executor=executor)
+    # Outliers are trimmed, and reading stopped after max_reads
+    assert stats['count'] == 990
+    assert stats['median'] == 300
+    assert abs(stats['mean'] - 300) < 1
+    assert 0 < stats['mad'] < stats['std'] < 10
+    with open(args_path) as f:
+        args = f.read().split()
+    assert args[:5] == ['view', '-f', '66', '-F', '0xF0C']
+    assert [x.split(':')[0] for x in args[6:]] == ['1', '1', '2', '2']
+    assert get_mean_insert_size(work_dir, 'sample.bam', max_reads=1000, executor=executor) == int(stats['mean'])
@@ -1,3 +1,4 @@
+import json
 import os
 import subprocess
 import filecmp
@@ -52,3 +53,243 @@ def test_upload_and_download_with_encryption(tmpdir):
             k = Key(b)
             k.key = random_key
             k.delete()
+
+
+class _RangeServer(object):
+    """
+    Serves a single blob over HTTP on localhost, optionally with byte range support, and records the ranges asked for
+    """
+
+    def __init__(self, data, ranges=True, failures=0, failure_code=503):
+        import BaseHTTPServer
+        import threading
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                header = self.headers.getheader('Range')
+                server.requests.append(header)
+                if server.failures:
+                    server.failures -= 1
+                    self.send_error(server.failure_code)
+                    return
+                if header and server.ranges and not server.data:
+                    self.send_error(416)
+                    return
+                if header and server.ranges:
+                    start, end = map(int, header[len('bytes='):].split('-'))
+                    body = server.data[start:end + 1]
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(server.data)))
+                    self.send_header('ETag', '"abc"')
+                else:
+                    body = server.data
+                    self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(server.data)))
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.data = data
+        self.ranges = ranges
+        self.failures = failures
+        self.failure_code = failure_code
+        self.requests = []
+        self.httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/blob'.format(self.httpd.server_port)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def test_http_download(tmpdir, monkeypatch):
+    import hashlib
+    import urllib2
+    import pytest
+    from toil_lib import UserError
+    from toil_lib import urls
+    import tempfile
+    from toil_lib.urls import download_url, url_size, _http_download, _partial_path
+    monkeypatch.setattr(urls, '_RETRY_DELAY', 0)
+    # Partial downloads are assembled outside the work directory
+    monkeypatch.delenv('TOIL_LIB_CACHE_DIR', raising=False)
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir.mkdir('tmp')))
+    work_dir = str(tmpdir.mkdir('work'))
+    data = os.urandom(10000)
+    md5 = hashlib.md5(data).hexdigest()
+    path = os.path.join(work_dir, 'blob')
+    # Parallel byte ranges, one of which fails once
+    with _RangeServer(data, failures=1) as server:
+        assert _http_download(server.url, path, num_connections=3, part_size=1000) == md5
+        # The failed probe is retried, then each of the 10 parts is fetched once
+        assert len(server.requests) == 12
+        partial_path = _partial_path(server.url)
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert not os.path.exists(partial_path) and not os.path.exists(partial_path + '.parts')
+    assert os.listdir(work_dir) == ['blob']
+    # A retry with a different destination resumes after the first half was downloaded
+    with _RangeServer(data) as server:
+        partial_path = _partial_path(server.url)
+        with open(partial_path + '.parts', 'w') as f:
+            json.dump(dict(size=len(data), etag='"abc"', part_size=1000, done=range(5)), f)
+        with open(partial_path, 'wb') as f:
+            f.write(data[:5000] + '\0' * 5000)
+        assert _http_download(server.url, path + '.retry', part_size=1000) == md5
+        assert sorted(server.requests)[1:] == ['bytes={}-{}'.format(i, i + 999) for i in range(5000, 10000, 1000)]
+    with open(path + '.retry', 'rb') as f:
+        assert f.read() == data
+    assert not os.path.exists(partial_path + '.parts')
+    # Servers without range support are read in one stream
+    with _RangeServer(data, ranges=False) as server:
+        assert download_url(server.url, work_dir=work_dir, name='single', md5=md5) == os.path.join(work_dir, 'single')
+        assert len(server.requests) == 1
+        with pytest.raises(UserError):
+            download_url(server.url, work_dir=work_dir, name='single', md5='0' * 32)
+    # Empty files have no byte ranges
+    with _RangeServer('') as server:
+        assert _http_download(server.url, path + '.empty') == hashlib.md5().hexdigest()
+    assert os.path.getsize(path + '.empty') == 0
+    # Client errors aren't retried
+    with _RangeServer(data, failures=5, failure_code=404) as server:
+        with pytest.raises(urllib2.HTTPError):
+            _http_download(server.url, path + '.missing')
+        assert len(server.requests) == 1
+    # Sizes are found without downloading
+    with _RangeServer(data) as server:
+        assert url_size(server.url) == len(data)
+        assert not server.requests
+    assert url_size('file://' + path) == url_size(path) == len(data)
+
+
+def test_download_and_extract(tmpdir):
+    import tarfile
+    from StringIO import StringIO
+    from toil_lib.urls import download_and_extract
+    work_dir = str(tmpdir)
+    index = os.path.join(work_dir, 'index')
+    os.makedirs(index)
+    with open(os.path.join(index, 'SA'), 'w') as f:
+        f.write('foo')
+    tar_path = os.path.join(work_dir, 'index.tar.gz')
+    with tarfile.open(tar_path, 'w:gz') as f:
+        f.add(index, arcname='index')
+    out_dir = os.path.join(work_dir, 'out')
+    os.makedirs(out_dir)
+    # The only top-level directory is the root
+    root = download_and_extract('file://' + tar_path, work_dir=out_dir, cache_dir=False)
+    assert root == os.path.join(out_dir, 'index', 'index')
+    with open(os.path.join(root, 'SA')) as f:
+        assert f.read() == 'foo'
+    # Over HTTP, with files at the top level of the tarball
+    buf = StringIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as f:
+        f.add(os.path.join(index, 'SA'), arcname='SA')
+    with _RangeServer(buf.getvalue(), ranges=False) as server:
+        root = download_and_extract(server.url + '.tar.gz', work_dir=out_dir, name='ref', cache_dir=False)
+    assert root == os.path.join(out_dir, 'ref')
+    assert os.listdir(root) == ['SA']
+
+
+def test_download_urls_job(tmpdir):
+    work_dir = str(tmpdir)
+    name_to_url = {}
+    for name in ['ref.fa', 'ref.fa.fai', 'ref.dict']:
+        path = os.path.join(work_dir, 'src-' + name)
+        with open(path, 'w') as f:
+            f.write(name)
+        name_to_url[name] = 'file://' + path
+    options = Job.Runner.getDefaultOptions(os.path.join(work_dir, 'test_store'))
+    Job.Runner.startToil(Job.wrapJobFn(_download_urls_setup, name_to_url), options)
+
+
+def _download_urls_setup(job, name_to_url):
+    from toil_lib.urls import download_urls_job
+    ids = job.addChildJobFn(download_urls_job, name_to_url, num_threads=2).rv()
+    job.addFollowOnJobFn(_check_downloaded_urls, ids, sorted(name_to_url))
+
+
+def _check_downloaded_urls(job, ids, names):
+    assert sorted(ids) == names
+    for name, file_id in ids.items():
+        with open(job.fileStore.readGlobalFile(file_id)) as f:
+            assert f.read() == name
+
+
+def test_url_registry(tmpdir):
+    work_dir = str(tmpdir)
+    options = Job.Runner.getDefaultOptions(os.path.join(work_dir, 'test_store'))
+    options.workDir = work_dir
+    data = os.urandom(1000)
+    with _RangeServer(data, ranges=False) as server:
+        Job.Runner.startToil(Job.wrapJobFn(_url_registry_setup, server.url, data), options)
+        # Every job got the file of the first import
+        assert len(server.requests) == 1
+
+
+def _url_registry_setup(job, url, data):
+    from toil_lib.urls import download_url_job, download_urls_job
+    ids = [job.addChildJobFn(download_url_job, url, name='blob', deduplicate=True).rv() for _ in range(4)]
+    # Threads of one job importing the same URL under different names
+    ids.append(job.addChildJobFn(download_urls_job, {'a': url, 'b': url}, num_threads=2, deduplicate=True).rv())
+    job.addFollowOnJobFn(_check_url_registry, ids, data)
+
+
+def _check_url_registry(job, ids, data):
+    ids.extend(ids.pop().values())
+    assert len(set(ids)) == 1
+    with job.fileStore.readGlobalFileStream(ids[0]) as f:
+        assert f.read() == data
+
+
+def test_url_registry_delete(tmpdir):
+    work_dir = str(tmpdir)
+    options = Job.Runner.getDefaultOptions(os.path.join(work_dir, 'test_store'))
+    options.workDir = work_dir
+    data = os.urandom(1000)
+    with _RangeServer(data, ranges=False) as server:
+        Job.Runner.startToil(Job.wrapJobFn(_url_registry_delete_setup, server.url, data), options)
+        # The deleted file was imported again, and the undeduplicated download was never registered
+        assert len(server.requests) == 3
+
+
+def _url_registry_delete_setup(job, url, data):
+    from toil_lib.urls import download_url_job
+    first = job.addChildJobFn(download_url_job, url, deduplicate=True)
+    # A FileStoreID of an undeduplicated download is owned by its caller, and deleting it leaves the registry alone
+    own = first.addChildJobFn(download_url_job, url)
+    own.addChildJobFn(_delete_file, own.rv(), first.rv())
+    job.addFollowOnJobFn(_check_deleted_shared_file, url, first.rv(), data)
+
+
+def _delete_file(job, file_id, shared_id):
+    assert file_id != shared_id
+    job.fileStore.deleteGlobalFile(file_id)
+    assert job.fileStore.jobStore.fileExists(shared_id)
+
+
+def _check_deleted_shared_file(job, url, shared_id, data):
+    from toil_lib.urls import download_url_job
+    # Deleting a shared FileStoreID deletes it for every job holding it. This is what deleteGlobalFile does once the
+    # deleting job completes.
+    job.fileStore.jobStore.deleteFile(shared_id)
+    # Later calls don't get the deleted file, but import the URL again
+    file_id = download_url_job(job, url, deduplicate=True)
+    assert file_id != shared_id
+    assert download_url_job(job, url, deduplicate=True) == file_id
+    with job.fileStore.readGlobalFileStream(file_id) as f:
+        assert f.read() == data
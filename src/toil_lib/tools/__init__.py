@@ -1,26 +1,210 @@
+import logging
+import math
 import os
 import subprocess
+from itertools import islice
 
+from toil_lib.programs import docker_pipeline
+from toil_lib.tools.images import SAMTOOLS
 
-def get_mean_insert_size(work_dir, bam_name):
-    """Function taken from MC3 Pipeline"""
-    cmd = "docker run --log-driver=none --rm -v {}:/data quay.io/ucsc_cgl/samtools " \
-          "view -f66 {}".format(work_dir, os.path.join(work_dir, bam_name))
-    process = subprocess.Popen(args=cmd, shell=True, stdout=subprocess.PIPE)
-    b_sum = 0.0
-    b_count = 0.0
-    while True:
-        line = process.stdout.readline()
-        if not line:
-            break
-        tmp = line.split("\t")
-        if abs(long(tmp[8])) < 10000:
-            b_sum += abs(long(tmp[8]))
-            b_count += 1
-    process.wait()
-    try:
-        mean = b_sum / b_count
-    except ZeroDivisionError:
-        mean = 150
-    print "Using insert size: %d" % mean
+_log = logging.getLogger(__name__)
+
+# Insert size used when a BAM has no properly paired reads
+_DEFAULT_INSERT_SIZE = 150
+# Number of SAM lines parsed at once
+_CHUNK_LINES = 10000
+
+
+def get_mean_insert_size(work_dir, bam_name, max_reads=100000, num_regions=50, executor=None):
+    """
+    Estimates the mean insert size of a BAM from a sample of its properly paired reads. Function taken from MC3
+    Pipeline, see estimate_insert_size.
+
+    :param str work_dir: Directory holding the BAM and its index
+    :param str bam_name: Name of the BAM in work_dir
+    :param int max_reads: Number of properly paired reads to sample
+    :param int num_regions: Number of regions of the genome the reads are sampled from
+    :param Executor executor: How samtools is run, see docker_pipeline
+    :return: Mean insert size, or 150 if the BAM has no properly paired reads
+    :rtype: int
+    """
+    stats = estimate_insert_size(work_dir, bam_name, max_reads=max_reads, num_regions=num_regions, executor=executor)
+    mean = stats['mean'] if stats['count'] else _DEFAULT_INSERT_SIZE
+    _log.info("Using insert size: %d", mean)
     return int(mean)
+
+
+def estimate_insert_size(work_dir, bam_name, max_reads=100000, num_regions=50, max_insert=10000, num_mads=10,
+                         executor=None):
+    """
+    Estimates the insert size distribution of a BAM without reading all of it. Using the counts of mapped reads in the
+    BAM index, num_regions windows are spread over the genome so that each holds about max_reads / num_regions
+    reads, and the first reads of proper pairs in them are read until max_reads were seen. Without an index, or for
+    BAMs with few reads, reads are taken from the start of the BAM. The TLEN fields are parsed in chunks, with NumPy if
+    it is installed and otherwise in Python.
+
+    Insert sizes of max_insert or more are ignored, like in the MC3 pipeline, and so are those more than num_mads
+    median absolute deviations from the median, like Picard's CollectInsertSizeMetrics.
+
+    :param str work_dir: Directory holding the BAM and its index
+    :param str bam_name: Name of the BAM in work_dir
+    :param int max_reads: Number of properly paired reads to sample
+    :param int num_regions: Number of regions of the genome the reads are sampled from
+    :param int max_insert: Insert sizes of at least this many bases are ignored
+    :param float num_mads: Number of median absolute deviations from the median beyond which insert sizes are trimmed
+    :param Executor executor: How samtools is run, see docker_pipeline
+    :return: Number of insert sizes used, and their mean, median, median absolute deviation and standard deviation. The
+             statistics are None if the BAM has no properly paired reads.
+    :rtype: dict
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    bam = os.path.join('/data', bam_name)
+    regions = _sample_regions(_idxstats(work_dir, bam, executor), max_reads, num_regions)
+    # Paired reads mapped in a proper pair (66), first of pair, that are mapped and neither secondary, QC failures,
+    # duplicates nor supplementary (0xF0C)
+    lines = docker_pipeline([(SAMTOOLS, ['view', '-f', '66', '-F', '0xF0C', bam] + regions)], work_dir=work_dir,
+                            executor=executor)
+    chunks, count = [], 0
+    try:
+        while count < max_reads:
+            chunk = ''.join(islice(lines, min(_CHUNK_LINES, max_reads - count)))
+            if not chunk:
+                break
+            if np:
+                sizes = np.abs(_parse_tlens(chunk))
+                sizes = sizes[(sizes > 0) & (sizes < max_insert)]
+            else:
+                sizes = [size for size in (abs(int(line.split('\t', 9)[8])) for line in chunk.splitlines())
+                         if 0 < size < max_insert]
+            chunks.append(sizes)
+            count += len(sizes)
+    finally:
+        # Stops samtools if it has more reads
+        lines.close()
+    _log.info('Sampled %d insert sizes of %s from %s.', count, bam_name,
+              '{} regions'.format(len(regions)) if regions else 'its start')
+    if np:
+        return _summarize(np.concatenate(chunks) if chunks else np.array([], dtype=np.int64), num_mads)
+    return _summarize_list([size for sizes in chunks for size in sizes], num_mads)
+
+
+def _idxstats(work_dir, bam, executor):
+    """
+    :return: Name, length and number of mapped reads of each reference sequence, or None if the BAM has no index
+    :rtype: list[tuple(str, int, int)]
+    """
+    try:
+        rows = [line.rstrip('\n').split('\t')
+                for line in docker_pipeline([(SAMTOOLS, ['idxstats', bam])], work_dir=work_dir, executor=executor)]
+        return [(name, int(length), int(mapped)) for name, length, mapped, _ in rows if name != '*']
+    except (subprocess.CalledProcessError, ValueError):
+        _log.warn('Could not read the index of %s. Reads are sampled from its start.', bam, exc_info=True)
+        return None
+
+
+def _sample_regions(stats, max_reads, num_regions):
+    """
+    Places num_regions windows evenly along the mapped reads, each holding about max_reads / num_regions first reads
+    of pairs
+
+    >>> _sample_regions([('1', 1000000, 400000), ('2', 500000, 0), ('3', 1000000, 400000)], 1000, 4)
+    ['1:249376-250625', '1:749376-750625', '3:249376-250625', '3:749376-750625']
+
+    :param list[tuple(str, int, int)] stats: Name, length and number of mapped reads of each reference sequence
+    :return: Regions in samtools' format, or an empty list if all reads should be read
+    :rtype: list[str]
+    """
+    # Names with colons can't be given as regions
+    stats = [(name, length, mapped) for name, length, mapped in stats or [] if mapped and ':' not in name]
+    total = sum(mapped for _, _, mapped in stats)
+    # About half the mapped reads are first of pair, so smaller BAMs are read entirely
+    if total <= 2 * max_reads:
+        return []
+    regions = []
+    points = iter((k + 0.5) * total / num_regions for k in xrange(num_regions))
+    point = next(points)
+    offset = 0
+    for name, length, mapped in stats:
+        window = min(length, max(1, int(2.0 * max_reads / num_regions * length / mapped)))
+        while point is not None and point < offset + mapped:
+            center = int((point - offset) / mapped * length)
+            start = min(max(1, center - window // 2 + 1), length - window + 1)
+            regions.append('{}:{}-{}'.format(name, start, start + window - 1))
+            point = next(points, None)
+        offset += mapped
+    return regions
+
+
+def _parse_tlens(chunk):
+    """
+    Parses the TLEN fields of SAM lines without splitting them in Python: the field is located between the eighth
+    and ninth tab of each line, and its digits are read as a matrix padded to the widest field
+
+    >>> lines = ['r', '99', '1', '7', '60', '4M', '=', '9', '-120', 'ACGT', '!!!!\\n'
+    ...          'r', '147', '1', '9', '60', '4M', '=', '7', '8', 'ACGT', '!!!!']
+    >>> list(_parse_tlens('\\t'.join(lines)))
+    [-120, 8]
+
+    :param str chunk: SAM lines
+    :rtype: numpy.ndarray
+    """
+    import numpy as np
+    if not chunk.endswith('\n'):
+        chunk += '\n'
+    data = np.frombuffer(chunk, dtype=np.uint8)
+    line_ends = np.flatnonzero(data == ord('\n'))
+    line_starts = np.concatenate(([0], line_ends[:-1] + 1))
+    tabs = np.flatnonzero(data == ord('\t'))
+    first_tabs = np.searchsorted(tabs, line_starts)
+    starts, ends = tabs[first_tabs + 7] + 1, tabs[first_tabs + 8]
+    negative = data[starts] == ord('-')
+    starts = starts + negative
+    positions = starts[:, np.newaxis] + np.arange((ends - starts).max())
+    in_field = positions < ends[:, np.newaxis]
+    digits = (data[np.where(in_field, positions, 0)].astype(np.int64) - ord('0')) * in_field
+    powers = 10 ** np.maximum(ends[:, np.newaxis] - 1 - positions, 0)
+    values = (digits * powers).sum(axis=1)
+    return np.where(negative, -values, values)
+
+
+def _summarize(sizes, num_mads):
+    """
+    >>> s = _summarize(__import__('numpy').array([100, 110, 120, 130, 140, 5000]), 10)
+    >>> s['count'], s['mean'], s['median'], s['mad']
+    (5, 120.0, 125.0, 15.0)
+    """
+    import numpy as np
+    if not len(sizes):
+        return dict(count=0, mean=None, median=None, mad=None, std=None)
+    median = np.median(sizes)
+    mad = np.median(np.abs(sizes - median))
+    sizes = sizes[np.abs(sizes - median) <= num_mads * mad] if mad else sizes
+    return dict(count=len(sizes), mean=float(sizes.mean()), median=float(median), mad=float(mad),
+                std=float(sizes.std()))
+
+
+def _summarize_list(sizes, num_mads):
+    """
+    Like _summarize, without NumPy
+
+    >>> s = _summarize_list([100, 110, 120, 130, 140, 5000], 10)
+    >>> s['count'], s['mean'], s['median'], s['mad']
+    (5, 120.0, 125.0, 15.0)
+    """
+    if not sizes:
+        return dict(count=0, mean=None, median=None, mad=None, std=None)
+    median = _median(sizes)
+    mad = _median([abs(size - median) for size in sizes])
+    sizes = [size for size in sizes if abs(size - median) <= num_mads * mad] if mad else sizes
+    mean = float(sum(sizes)) / len(sizes)
+    std = math.sqrt(sum((size - mean) ** 2 for size in sizes) / len(sizes))
+    return dict(count=len(sizes), mean=mean, median=float(median), mad=float(mad), std=std)
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
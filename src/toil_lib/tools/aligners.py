@@ -1,11 +1,12 @@
 import os
 
-import subprocess
-
+from toil_lib.memoize import memoize
 from toil_lib.programs import docker_call
-from toil_lib.urls import download_url
+from toil_lib.tools.images import BWAKIT, STAR
+from toil_lib.urls import download_and_extract
 
 
+@memoize(images=[STAR], file_args=['r1_id', 'r2_id'], file_results=[0, 1, 2])
 def run_star(job, r1_id, r2_id, star_index_url, wiggle=False):
     """
     Performs alignment of fastqs to bam via STAR
@@ -19,11 +20,9 @@ def run_star(job, r1_id, r2_id, star_index_url, wiggle=False):
     :rtype: str
     """
     work_dir = job.fileStore.getLocalTempDir()
-    download_url(url=star_index_url, name='starIndex.tar.gz', work_dir=work_dir)
-    subprocess.check_call(['tar', '-xvf', os.path.join(work_dir, 'starIndex.tar.gz'), '-C', work_dir])
-    os.remove(os.path.join(work_dir, 'starIndex.tar.gz'))
-    # Determine tarball structure - star index contains are either in a subdir or in the tarball itself
-    star_index = os.path.join('/data', os.listdir(work_dir)[0]) if len(os.listdir(work_dir)) == 1 else '/data'
+    # The star index contents are either in a subdir or in the tarball itself
+    star_index = download_and_extract(url=star_index_url, name='starIndex', work_dir=work_dir)
+    star_index = os.path.join('/data', os.path.relpath(star_index, work_dir))
     # Parameter handling for paired / single-end data
     parameters = ['--runThreadN', str(job.cores),
                   '--genomeDir', star_index,
@@ -54,7 +53,7 @@ def run_star(job, r1_id, r2_id, star_index_url, wiggle=False):
         job.fileStore.readGlobalFile(r1_id, os.path.join(work_dir, 'R1.fastq'))
         parameters.extend(['--readFilesIn', '/data/R1.fastq'])
     # Call: STAR Mapping
-    docker_call(tool='quay.io/ucsc_cgl/star:2.4.2a--bcbd5122b69ff6ac4ef61958e47bde94001cfe80',
+    docker_call(tool=STAR,
                 work_dir=work_dir, parameters=parameters)
     # Write to fileStore
     transcriptome_id = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'rnaAligned.toTranscriptome.out.bam'))
@@ -66,6 +65,8 @@ def run_star(job, r1_id, r2_id, star_index_url, wiggle=False):
         return transcriptome_id, sorted_id
 
 
+@memoize(images=[BWAKIT], file_args=['r1', 'r2', 'ref', 'fai', 'amb', 'ann', 'bwt', 'pac', 'sa', 'alt'],
+         file_results=[None])
 def run_bwakit(job, config, sort=True, trim=False):
     """
     Runs BWA-Kit to align a fastq file or fastq pair into a BAM file.
@@ -142,7 +143,7 @@ def run_bwakit(job, config, sort=True, trim=False):
         parameters.append('/data/r2.fq.gz')
     mock_bam = config.uuid + '.bam'
     outputs = {'aligned.aln.bam': mock_bam}
-    docker_call(tool='quay.io/ucsc_cgl/bwakit:0.7.12--528bb9bf73099a31e74a7f5e6e3f2e0a41da486e',
+    docker_call(tool=BWAKIT,
                 parameters=parameters, inputs=file_names, outputs=outputs, work_dir=work_dir)
 
     # Either write file to local output directory or upload to S3 cloud storage
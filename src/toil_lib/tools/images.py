@@ -0,0 +1,26 @@
+"""
+Registry of the Docker images used by toil-lib. Wrappers refer to images through these names so that every image
+can be pulled ahead of time, e.g. with toil_lib.programs.pull_images_job at workflow start.
+"""
+
+ADAM = 'quay.io/ucsc_cgl/adam:962-ehf--6e7085f8cac4b9a927dc9fb06b48007957256b80'
+BWA = 'quay.io/ucsc_cgl/bwa:0.7.12--256539928ea162949d8a65ca5c79a72ef557ce7c'
+BWAKIT = 'quay.io/ucsc_cgl/bwakit:0.7.12--528bb9bf73099a31e74a7f5e6e3f2e0a41da486e'
+CONDUCTOR = 'quay.io/ucsc_cgl/conductor'
+CUTADAPT = 'quay.io/ucsc_cgl/cutadapt:1.9--6bd44edd2b8f8f17e25c5a268fedaab65fa851d2'
+FASTQC = 'quay.io/ucsc_cgl/fastqc:0.11.5--be13567d00cd4c586edf8ae47d991815c8c72a49'
+GATK = 'quay.io/ucsc_cgl/gatk:3.5--dba6dae49156168a909c43330350c6161dc7ecc2'
+GENCODE_HUGO_MAPPING = 'jvivian/gencode_hugo_mapping'
+GENETORRENT = 'quay.io/ucsc_cgl/genetorrent:3.8.7--9911761265b6f08bc3ef09f53af05f56848d805b'
+KALLISTO = 'quay.io/ucsc_cgl/kallisto:0.42.4--35ac87df5b21a8e8e8d159f26864ac1e1db8cf86'
+MUSE = 'quay.io/ucsc_cgl/muse:1.0--6add9b0a1662d44fd13bbc1f32eac49326e48562'
+MUTECT = 'quay.io/ucsc_cgl/mutect:1.1.7--e8bf09459cf0aecb9f55ee689c2b2d194754cbd3'
+PICARDTOOLS = 'quay.io/ucsc_cgl/picardtools:1.95--dd5ac549b95eb3e5d166a5e310417ef13651994e'
+PINDEL = 'quay.io/ucsc_cgl/pindel:0.2.5b6--4e8d1b31d4028f464b3409c6558fb9dfcad73f88'
+RSEM = 'quay.io/ucsc_cgl/rsem:1.2.25--d4275175cc8df36967db460b06337a14f40d2f21'
+RSEM_POSTPROCESS = 'jvivian/rsem_postprocess'
+SAMTOOLS = 'quay.io/ucsc_cgl/samtools:0.1.19--dd5ac549b95eb3e5d166a5e310417ef13651994e'
+STAR = 'quay.io/ucsc_cgl/star:2.4.2a--bcbd5122b69ff6ac4ef61958e47bde94001cfe80'
+
+ALL_IMAGES = [ADAM, BWA, BWAKIT, CONDUCTOR, CUTADAPT, FASTQC, GATK, GENCODE_HUGO_MAPPING, GENETORRENT, KALLISTO,
+              MUSE, MUTECT, PICARDTOOLS, PINDEL, RSEM, RSEM_POSTPROCESS, SAMTOOLS, STAR]
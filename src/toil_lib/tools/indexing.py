@@ -1,6 +1,7 @@
 import os
 
-from toil_lib.programs import docker_call
+from toil_lib.programs import DockerSessions, docker_call
+from toil_lib.tools.images import BWA, PICARDTOOLS, SAMTOOLS
 
 
 def run_bwa_index(job, ref_id):
@@ -17,7 +18,7 @@ def run_bwa_index(job, ref_id):
     job.fileStore.readGlobalFile(ref_id, os.path.join(work_dir, 'ref.fa'))
     command = ['index', '/data/ref.fa']
     docker_call(work_dir=work_dir, parameters=command,
-                tool='quay.io/ucsc_cgl/bwa:0.7.12--256539928ea162949d8a65ca5c79a72ef557ce7c')
+                tool=BWA)
     ids = {}
     for output in ['ref.fa.amb', 'ref.fa.ann', 'ref.fa.bwt', 'ref.fa.pac', 'ref.fa.sa']:
         ids[output.split('.')[-1]] = (job.fileStore.writeGlobalFile(os.path.join(work_dir, output)))
@@ -38,5 +39,36 @@ def run_samtools_faidx(job, ref_id):
     job.fileStore.readGlobalFile(ref_id, os.path.join(work_dir, 'ref.fasta'))
     command = ['faidx', '/data/ref.fasta']
     docker_call(work_dir=work_dir, parameters=command,
-                tool='quay.io/ucsc_cgl/samtools:0.1.19--dd5ac549b95eb3e5d166a5e310417ef13651994e')
+                tool=SAMTOOLS)
     return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'ref.fasta.fai'))
+
+
+def run_reference_indexing(job, ref_id, bwa_index=True):
+    """
+    Creates the reference index, the reference dictionary and, optionally, the BWA index files in one job. The
+    reference is read once and each tool runs in a DockerSession shared by the whole job, instead of each index being
+    built by a separate job in its own container.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str ref_id: FileStoreID for the reference genome
+    :param bool bwa_index: If True, BWA index files are created too
+    :return: FileStoreIDs for the reference index, the reference dictionary and the BWA index files, the latter in
+             the order returned by run_bwa_index or None if bwa_index is False
+    :rtype: tuple(str, str, tuple(str, str, str, str, str))
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    job.fileStore.readGlobalFile(ref_id, os.path.join(work_dir, 'ref.fa'))
+    with DockerSessions(work_dir) as sessions:
+        docker_call(work_dir=work_dir, parameters=['faidx', '/data/ref.fa'], tool=SAMTOOLS, session=sessions)
+        docker_call(work_dir=work_dir, parameters=['CreateSequenceDictionary', 'R=/data/ref.fa', 'O=/data/ref.dict'],
+                    tool=PICARDTOOLS, session=sessions)
+        if bwa_index:
+            docker_call(work_dir=work_dir, parameters=['index', '/data/ref.fa'], tool=BWA, session=sessions)
+    job.fileStore.logToMaster('Created reference index files')
+    fai_id = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'ref.fa.fai'))
+    dict_id = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'ref.dict'))
+    bwa_ids = None
+    if bwa_index:
+        bwa_ids = tuple(job.fileStore.writeGlobalFile(os.path.join(work_dir, 'ref.fa.' + ext))
+                        for ext in ['amb', 'ann', 'bwt', 'pac', 'sa'])
+    return fai_id, dict_id, bwa_ids
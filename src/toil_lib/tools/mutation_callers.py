@@ -1,11 +1,16 @@
 import os
+from functools import partial
 from glob import glob
 
-from toil_scripts.tools import get_mean_insert_size
-from toil_lib.files import tarball_files
-from toil_lib.programs import docker_call
+from toil_lib.tools import get_mean_insert_size
+from toil_lib.files import tarball_to_filestore
+from toil_lib.memoize import memoize
+from toil_lib.programs import docker_call, run_concurrently
+from toil_lib.tools.images import MUSE, MUTECT, PINDEL, SAMTOOLS
 
 
+@memoize(images=[MUTECT], file_args=['normal_bam', 'normal_bai', 'tumor_bam', 'tumor_bai', 'ref', 'ref_dict',
+                                     'fai', 'cosmic', 'dbsnp'], file_results=[None])
 def run_mutect(job, normal_bam, normal_bai, tumor_bam, tumor_bai, ref, ref_dict, fai, cosmic, dbsnp):
     """
     Calls MuTect to perform variant analysis
@@ -42,14 +47,15 @@ def run_mutect(job, normal_bam, normal_bai, tumor_bam, tumor_bai, ref, ref_dict,
                   '--coverage_file', 'mutect.cov',
                   '--vcf', 'mutect.vcf']
     docker_call(work_dir=work_dir, parameters=parameters,
-                tool='quay.io/ucsc_cgl/mutect:1.1.7--e8bf09459cf0aecb9f55ee689c2b2d194754cbd3')
+                tool=MUTECT)
     # Write output to file store
     output_file_names = ['mutect.vcf', 'mutect.cov', 'mutect.out']
     output_file_paths = [os.path.join(work_dir, x) for x in output_file_names]
-    tarball_files('mutect.tar.gz', file_paths=output_file_paths, output_dir=work_dir)
-    return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'mutect.tar.gz'))
+    return tarball_to_filestore(job, output_file_paths, remove_inputs=True)
 
 
+@memoize(images=[MUSE], file_args=['normal_bam', 'normal_bai', 'tumor_bam', 'tumor_bai', 'ref', 'ref_dict', 'fai',
+                                   'dbsnp'], file_results=[None])
 def run_muse(job, normal_bam, normal_bai, tumor_bam, tumor_bai, ref, ref_dict, fai, dbsnp):
     """
     Calls MuSe to find variants
@@ -83,13 +89,14 @@ def run_muse(job, normal_bam, normal_bai, tumor_bam, tumor_bai, ref, ref_dict, f
                   '--normal-bam-index', '/data/normal.bai',
                   '--outfile', '/data/muse.vcf',
                   '--cpus', str(job.cores)]
-    docker_call(tool='quay.io/ucsc_cgl/muse:1.0--6add9b0a1662d44fd13bbc1f32eac49326e48562',
+    docker_call(tool=MUSE,
                 work_dir=work_dir, parameters=parameters)
     # Return fileStore ID
-    tarball_files('muse.tar.gz', file_paths=[os.path.join(work_dir, 'muse.vcf')], output_dir=work_dir)
-    return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'muse.tar.gz'))
+    return tarball_to_filestore(job, [os.path.join(work_dir, 'muse.vcf')], remove_inputs=True)
 
 
+@memoize(images=[PINDEL, SAMTOOLS], file_args=['normal_bam', 'normal_bai', 'tumor_bam', 'tumor_bai', 'ref', 'fai'],
+         file_results=[None])
 def run_pindel(job, normal_bam, normal_bai, tumor_bam, tumor_bai, ref, fai):
     """
     Calls Pindel to compute indels / deletions
@@ -110,9 +117,12 @@ def run_pindel(job, normal_bam, normal_bai, tumor_bam, tumor_bai, ref, fai):
     for file_store_id, name in zip(file_ids, file_names):
         job.fileStore.readGlobalFile(file_store_id, os.path.join(work_dir, name))
     # Create Pindel config
+    bams = ['normal', 'tumor']
+    insert_sizes = run_concurrently([partial(get_mean_insert_size, work_dir, bam + '.bam') for bam in bams],
+                                    num_threads=job.cores)
     with open(os.path.join(work_dir, 'pindel-config.txt'), 'w') as f:
-        for bam in ['normal', 'tumor']:
-            f.write('/data/{} {} {}\n'.format(bam + '.bam', get_mean_insert_size(work_dir, bam + '.bam'), bam))
+        for bam, insert_size in zip(bams, insert_sizes):
+            f.write('/data/{} {} {}\n'.format(bam + '.bam', insert_size, bam))
     # Call: Pindel
     parameters = ['-f', '/data/ref.fasta',
                   '-i', '/data/pindel-config.txt',
@@ -121,9 +131,8 @@ def run_pindel(job, normal_bam, normal_bai, tumor_bam, tumor_bai, ref, fai):
                   '--report_long_insertions', 'true',
                   '--report_breakpoints', 'true',
                   '-o', 'pindel']
-    docker_call(tool='quay.io/ucsc_cgl/pindel:0.2.5b6--4e8d1b31d4028f464b3409c6558fb9dfcad73f88',
+    docker_call(tool=PINDEL,
                 work_dir=work_dir, parameters=parameters)
     # Collect output files and write to file store
     output_files = glob(os.path.join(work_dir, 'pindel*'))
-    tarball_files('pindel.tar.gz', file_paths=output_files, output_dir=work_dir)
-    return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'pindel.tar.gz'))
+    return tarball_to_filestore(job, output_files, remove_inputs=True)
@@ -1,7 +1,13 @@
 import os
 
 from toil_lib import require
+from toil_lib.memoize import memoize
 from toil_lib.programs import docker_call
+from toil_lib.tools.images import CUTADAPT, GATK, PICARDTOOLS, SAMTOOLS
+from toil_lib.tools.resources import estimate_requirements, input_size, java_heap
+
+# Java heap of the GATK steps if it is to be estimated but can't be
+_DEFAULT_GATK_HEAP = '10G'
 
 
 def run_cutadapt(job, r1_id, r2_id, fwd_3pr_adapter, rev_3pr_adapter):
@@ -33,7 +39,7 @@ def run_cutadapt(job, r1_id, r2_id, fwd_3pr_adapter, rev_3pr_adapter):
         job.fileStore.readGlobalFile(r1_id, os.path.join(work_dir, 'R1.fastq'))
         parameters.extend(['-o', '/data/R1_cutadapt.fastq', '/data/R1.fastq'])
     # Call: CutAdapt
-    docker_call(tool='quay.io/ucsc_cgl/cutadapt:1.9--6bd44edd2b8f8f17e25c5a268fedaab65fa851d2',
+    docker_call(tool=CUTADAPT,
                 work_dir=work_dir, parameters=parameters)
     # Write to fileStore
     if r1_id and r2_id:
@@ -59,7 +65,7 @@ def run_samtools_faidx(job, ref_id):
     job.fileStore.readGlobalFile(ref_id, os.path.join(work_dir, 'ref.fasta'))
     command = ['faidx', 'ref.fasta']
     docker_call(work_dir=work_dir, parameters=command,
-                tool='quay.io/ucsc_cgl/samtools:0.1.19--dd5ac549b95eb3e5d166a5e310417ef13651994e')
+                tool=SAMTOOLS)
     return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'ref.fasta.fai'))
 
 
@@ -77,7 +83,7 @@ def run_samtools_index(job, bam_id):
     # Call: index the bam
     parameters = ['index', '/data/sample.bam']
     docker_call(work_dir=work_dir, parameters=parameters,
-                tool='quay.io/ucsc_cgl/samtools:0.1.19--dd5ac549b95eb3e5d166a5e310417ef13651994e')
+                tool=SAMTOOLS)
     # Write to fileStore
     return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'sample.bam.bai'))
 
@@ -96,7 +102,7 @@ def run_picard_create_sequence_dictionary(job, ref_id):
     job.fileStore.readGlobalFile(ref_id, os.path.join(work_dir, 'ref.fasta'))
     command = ['CreateSequenceDictionary', 'R=ref.fasta', 'O=ref.dict']
     docker_call(work_dir=work_dir, parameters=command,
-                tool='quay.io/ucsc_cgl/picardtools:1.95--dd5ac549b95eb3e5d166a5e310417ef13651994e')
+                tool=PICARDTOOLS)
     return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'ref.dict'))
 
 
@@ -113,19 +119,26 @@ def run_gatk_preprocessing(job, bam, bai, ref, ref_dict, fai, phase, mills, dbsn
     :param str phase: Phase VCF FileStoreID
     :param str mills: Mills VCF FileStoreID
     :param str dbsnp: DBSNP VCF FileStoreID
-    :param str mem: Memory value to be passed to children. Needed for CI tests
+    :param str mem: Java heap size of every step, e.g. '10G'. If 'auto', the memory and disk of each step are
+           estimated from the sizes of the BAM and the reference files, and its heap is derived from its memory.
     :param bool unsafe: If True, runs gatk UNSAFE mode: "-U ALLOW_SEQ_DICT_INCOMPATIBILITY"
     :return: BAM and BAI FileStoreIDs from Print Reads
     :rtype: tuple(str, str)
     """
+    # The BAMs of later steps don't exist yet, but are about as large as the input BAM
+    heap, requirements = _gatk_requirements(job, run_realigner_target_creator, mem, bam, [ref, ref_dict, fai,
+                                                                                          phase, mills])
     rtc = job.wrapJobFn(run_realigner_target_creator, bam, bai, ref, ref_dict,
-                        fai, phase, mills, mem, unsafe, cores=job.cores)
+                        fai, phase, mills, heap, unsafe, **requirements)
+    heap, requirements = _gatk_requirements(job, run_indel_realignment, mem, bam, [ref, ref_dict, fai, phase, mills])
     ir = job.wrapJobFn(run_indel_realignment, rtc.rv(), bam, bai, ref, ref_dict,
-                       fai, phase, mills, mem, unsafe, cores=job.cores)
+                       fai, phase, mills, heap, unsafe, **requirements)
+    heap, requirements = _gatk_requirements(job, run_base_recalibration, mem, bam, [ref, ref_dict, fai, dbsnp])
     br = job.wrapJobFn(run_base_recalibration, ir.rv(0), ir.rv(1), ref, ref_dict,
-                       fai, dbsnp, mem, unsafe, cores=job.cores)
+                       fai, dbsnp, heap, unsafe, **requirements)
+    heap, requirements = _gatk_requirements(job, run_print_reads, mem, bam, [ref, ref_dict, fai])
     pr = job.wrapJobFn(run_print_reads, br.rv(), ir.rv(0), ir.rv(1), ref, ref_dict,
-                       fai, mem, unsafe, cores=job.cores)
+                       fai, heap, unsafe, **requirements)
     # Wiring
     job.addChild(rtc)
     rtc.addChild(ir)
@@ -134,6 +147,20 @@ def run_gatk_preprocessing(job, bam, bai, ref, ref_dict, fai, phase, mills, dbsn
     return pr.rv(0), pr.rv(1)
 
 
+def _gatk_requirements(job, func, mem, bam, references):
+    """
+    :return: Java heap size and the keyword arguments with the requirements of a GATK step
+    :rtype: tuple(str, dict)
+    """
+    if mem == 'auto' and input_size(bam) is None:
+        mem = _DEFAULT_GATK_HEAP
+    if mem != 'auto':
+        return mem, dict(cores=job.cores)
+    requirements = estimate_requirements(func.__name__, [bam], references, cores=job.cores)
+    return java_heap(requirements['memory']), requirements
+
+
+@memoize(images=[GATK], file_args=['bam', 'bai', 'ref', 'ref_dict', 'fai', 'phase', 'mills'], file_results=[None])
 def run_realigner_target_creator(job, bam, bai, ref, ref_dict, fai, phase, mills, mem, unsafe=False):
     """
     Creates intervals file needed for indel realignment
@@ -167,7 +194,7 @@ def run_realigner_target_creator(job, bam, bai, ref, ref_dict, fai, phase, mills
                   '-o', '/data/sample.intervals']
     if unsafe:
         parameters.extend(['-U', 'ALLOW_SEQ_DICT_INCOMPATIBILITY'])
-    docker_call(tool='quay.io/ucsc_cgl/gatk:3.5--dba6dae49156168a909c43330350c6161dc7ecc2',
+    docker_call(tool=GATK,
                 inputs=inputs,
                 outputs={'sample.intervals': None},
                 work_dir=work_dir, parameters=parameters, env=dict(JAVA_OPTS='-Xmx{}'.format(mem)))
@@ -175,6 +202,8 @@ def run_realigner_target_creator(job, bam, bai, ref, ref_dict, fai, phase, mills
     return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'sample.intervals'))
 
 
+@memoize(images=[GATK], file_args=['intervals', 'bam', 'bai', 'ref', 'ref_dict', 'fai', 'phase', 'mills'],
+         file_results=[0, 1])
 def run_indel_realignment(job, intervals, bam, bai, ref, ref_dict, fai, phase, mills, mem, unsafe=False):
     """
     Creates realigned bams using the intervals file from previous step
@@ -212,7 +241,7 @@ def run_indel_realignment(job, intervals, bam, bai, ref, ref_dict, fai, phase, m
                   '-o', '/data/sample.indel.bam']
     if unsafe:
         parameters.extend(['-U', 'ALLOW_SEQ_DICT_INCOMPATIBILITY'])
-    docker_call(tool='quay.io/ucsc_cgl/gatk:3.5--dba6dae49156168a909c43330350c6161dc7ecc2',
+    docker_call(tool=GATK,
                 inputs=inputs,
                 outputs={'sample.indel.bam': None, 'sample.indel.bai': None},
                 work_dir=work_dir, parameters=parameters, env=dict(JAVA_OPTS='-Xmx{}'.format(mem)))
@@ -222,6 +251,7 @@ def run_indel_realignment(job, intervals, bam, bai, ref, ref_dict, fai, phase, m
     return indel_bam, indel_bai
 
 
+@memoize(images=[GATK], file_args=['indel_bam', 'indel_bai', 'ref', 'ref_dict', 'fai', 'dbsnp'], file_results=[None])
 def run_base_recalibration(job, indel_bam, indel_bai, ref, ref_dict, fai, dbsnp, mem, unsafe=False):
     """
     Creates recal table used in Base Quality Score Recalibration
@@ -252,7 +282,7 @@ def run_base_recalibration(job, indel_bam, indel_bai, ref, ref_dict, fai, dbsnp,
                   '-o', '/data/sample.recal.table']
     if unsafe:
         parameters.extend(['-U', 'ALLOW_SEQ_DICT_INCOMPATIBILITY'])
-    docker_call(tool='quay.io/ucsc_cgl/gatk:3.5--dba6dae49156168a909c43330350c6161dc7ecc2',
+    docker_call(tool=GATK,
                 inputs=inputs,
                 outputs={'sample.recal.table': None},
                 work_dir=work_dir, parameters=parameters, env=dict(JAVA_OPTS='-Xmx{}'.format(mem)))
@@ -260,6 +290,7 @@ def run_base_recalibration(job, indel_bam, indel_bai, ref, ref_dict, fai, dbsnp,
     return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'sample.recal.table'))
 
 
+@memoize(images=[GATK], file_args=['table', 'indel_bam', 'indel_bai', 'ref', 'ref_dict', 'fai'], file_results=[0, 1])
 def run_print_reads(job, table, indel_bam, indel_bai, ref, ref_dict, fai, mem, unsafe=False):
     """
     Creates BAM that has had the base quality scores recalibrated
@@ -292,7 +323,7 @@ def run_print_reads(job, table, indel_bam, indel_bai, ref, ref_dict, fai, mem, u
                   '-o', '/data/sample.bqsr.bam']
     if unsafe:
         parameters.extend(['-U', 'ALLOW_SEQ_DICT_INCOMPATIBILITY'])
-    docker_call(tool='quay.io/ucsc_cgl/gatk:3.5--dba6dae49156168a909c43330350c6161dc7ecc2',
+    docker_call(tool=GATK,
                 inputs=inputs,
                 outputs={'sample.bqsr.bam': None, 'sample.bqsr.bai': None},
                 work_dir=work_dir, parameters=parameters, env=dict(JAVA_OPTS='-Xmx{}'.format(mem)))
@@ -1,12 +1,13 @@
 import os
 
-import subprocess
-
-from toil_lib.files import tarball_files
-from toil_lib.programs import docker_call
-from toil_lib.urls import download_url
+from toil_lib.files import tarball_to_filestore
+from toil_lib.memoize import memoize
+from toil_lib.programs import DockerSessions, docker_call
+from toil_lib.tools.images import GENCODE_HUGO_MAPPING, KALLISTO, RSEM, RSEM_POSTPROCESS
+from toil_lib.urls import download_and_extract, download_url
 
 
+@memoize(images=[KALLISTO], file_args=['r1_id', 'r2_id'], file_results=[None])
 def run_kallisto(job, r1_id, r2_id, kallisto_index_url):
     """
     RNA quantification via Kallisto
@@ -35,14 +36,14 @@ def run_kallisto(job, r1_id, r2_id, kallisto_index_url):
         parameters.extend(['--single', '-l', '200', '-s', '15', '/data/R1_cutadapt.fastq'])
 
     # Call: Kallisto
-    docker_call(tool='quay.io/ucsc_cgl/kallisto:0.42.4--35ac87df5b21a8e8e8d159f26864ac1e1db8cf86',
+    docker_call(tool=KALLISTO,
                 work_dir=work_dir, parameters=parameters)
     # Tar output files together and store in fileStore
     output_files = [os.path.join(work_dir, x) for x in ['run_info.json', 'abundance.tsv', 'abundance.h5']]
-    tarball_files(tar_name='kallisto.tar.gz', file_paths=output_files, output_dir=work_dir)
-    return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'kallisto.tar.gz'))
+    return tarball_to_filestore(job, output_files, remove_inputs=True)
 
 
+@memoize(images=[RSEM], file_args=['bam_id'], file_results=[0, 1])
 def run_rsem(job, bam_id, rsem_ref_url, paired=True):
     """
     RNA quantification with RSEM
@@ -55,16 +56,15 @@ def run_rsem(job, bam_id, rsem_ref_url, paired=True):
     :rtype: str
     """
     work_dir = job.fileStore.getLocalTempDir()
-    download_url(url=rsem_ref_url, name='rsem_ref.tar.gz', work_dir=work_dir)
-    subprocess.check_call(['tar', '-xvf', os.path.join(work_dir, 'rsem_ref.tar.gz'), '-C', work_dir])
-    os.remove(os.path.join(work_dir, 'rsem_ref.tar.gz'))
+    ref_root = download_and_extract(url=rsem_ref_url, name='rsem_ref', work_dir=work_dir)
     # Determine tarball structure - based on it, ascertain folder name and rsem reference prefix
     rsem_files = []
-    for root, directories, files in os.walk(work_dir):
+    for root, directories, files in os.walk(ref_root):
         rsem_files.extend([os.path.join(root, x) for x in files])
     # "grp" is a required RSEM extension that should exist in the RSEM reference
-    ref_prefix = [os.path.basename(os.path.splitext(x)[0]) for x in rsem_files if 'grp' in x][0]
-    ref_folder = os.path.join('/data', os.listdir(work_dir)[0]) if len(os.listdir(work_dir)) == 1 else '/data'
+    grp_file = [x for x in rsem_files if 'grp' in x][0]
+    ref_prefix = os.path.basename(os.path.splitext(grp_file)[0])
+    ref_folder = os.path.join('/data', os.path.relpath(os.path.dirname(grp_file), work_dir))
     # I/O
     job.fileStore.readGlobalFile(bam_id, os.path.join(work_dir, 'transcriptome.bam'))
     output_prefix = 'rsem'
@@ -80,7 +80,7 @@ def run_rsem(job, bam_id, rsem_ref_url, paired=True):
                   output_prefix]
     if paired:
         parameters = ['--paired-end'] + parameters
-    docker_call(tool='quay.io/ucsc_cgl/rsem:1.2.25--d4275175cc8df36967db460b06337a14f40d2f21',
+    docker_call(tool=RSEM,
                 parameters=parameters, work_dir=work_dir)
     os.rename(os.path.join(work_dir, output_prefix + '.genes.results'), os.path.join(work_dir, 'rsem_gene.tab'))
     os.rename(os.path.join(work_dir, output_prefix + '.isoforms.results'), os.path.join(work_dir, 'rsem_isoform.tab'))
@@ -107,21 +107,21 @@ def run_rsem_postprocess(job, uuid, rsem_gene_id, rsem_isoform_id):
     # I/O
     job.fileStore.readGlobalFile(rsem_gene_id, os.path.join(work_dir, 'rsem_gene.tab'), mutable=True)
     job.fileStore.readGlobalFile(rsem_isoform_id, os.path.join(work_dir, 'rsem_isoform.tab'), mutable=True)
-    # Convert RSEM files into individual .tab files.
-    docker_call(tool='jvivian/rsem_postprocess', parameters=[uuid], work_dir=work_dir)
-    os.rename(os.path.join(work_dir, 'rsem_gene.tab'), os.path.join(work_dir, 'rsem_genes.results'))
-    os.rename(os.path.join(work_dir, 'rsem_isoform.tab'), os.path.join(work_dir, 'rsem_isoforms.results'))
     output_files = ['rsem.genes.norm_counts.tab', 'rsem.genes.raw_counts.tab', 'rsem.isoform.norm_counts.tab',
                     'rsem.isoform.raw_counts.tab', 'rsem_genes.results', 'rsem_isoforms.results']
-    # Perform HUGO gene / isoform name mapping
     genes = [x for x in output_files if 'rsem.genes' in x]
     isoforms = [x for x in output_files if 'rsem.isoform' in x]
-    command = ['-g'] + genes + ['-i'] + isoforms
-    docker_call(tool='jvivian/gencode_hugo_mapping', parameters=command, work_dir=work_dir)
+    # Both tools run in long-lived containers whose ownership fix-up is done once, when the sessions are closed
+    with DockerSessions(work_dir) as sessions:
+        # Convert RSEM files into individual .tab files.
+        docker_call(tool=RSEM_POSTPROCESS, parameters=[uuid], work_dir=work_dir, session=sessions)
+        os.rename(os.path.join(work_dir, 'rsem_gene.tab'), os.path.join(work_dir, 'rsem_genes.results'))
+        os.rename(os.path.join(work_dir, 'rsem_isoform.tab'), os.path.join(work_dir, 'rsem_isoforms.results'))
+        # Perform HUGO gene / isoform name mapping
+        command = ['-g'] + genes + ['-i'] + isoforms
+        docker_call(tool=GENCODE_HUGO_MAPPING, parameters=command, work_dir=work_dir, session=sessions)
     hugo_files = [os.path.splitext(x)[0] + '.hugo' + os.path.splitext(x)[1] for x in genes + isoforms]
     # Create tarballs for outputs
-    tarball_files('rsem.tar.gz', file_paths=[os.path.join(work_dir, x) for x in output_files], output_dir=work_dir)
-    tarball_files('rsem_hugo.tar.gz', [os.path.join(work_dir, x) for x in hugo_files], output_dir=work_dir)
-    rsem_id = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'rsem.tar.gz'))
-    hugo_id = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'rsem_hugo.tar.gz'))
+    rsem_id = tarball_to_filestore(job, [os.path.join(work_dir, x) for x in output_files], remove_inputs=True)
+    hugo_id = tarball_to_filestore(job, [os.path.join(work_dir, x) for x in hugo_files], remove_inputs=True)
     return rsem_id, hugo_id
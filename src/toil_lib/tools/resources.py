@@ -0,0 +1,174 @@
+import logging
+import math
+from functools import partial
+
+from bd2k.util.humanize import human2bytes
+
+from toil_lib import require
+
+_log = logging.getLogger(__name__)
+
+_G = 1024 ** 3
+# Smallest memory and disk requirements handed out, so tiny test inputs still get a usable JVM and work directory
+_MIN_MEMORY = human2bytes('2G')
+_MIN_DISK = human2bytes('2G')
+# Share of a job's memory given to the Java heap of GATK tools, leaving room for the JVM itself
+_HEAP_FRACTION = 0.8
+
+
+def _bwakit(sample_size, reference_size):
+    # BWA holds the index in memory, and sorting buffers the alignments. The local fastqs, the BAM and the sort's
+    # temporary files are each about as large as the input.
+    return 2 * _G + 1.2 * reference_size, reference_size + 3 * sample_size
+
+
+def _star(sample_size, reference_size):
+    # STAR loads the whole genome index, which is about the size of its tarball, and sorts the BAM in memory.
+    # The extracted index and both output BAMs are written to disk next to the fastqs.
+    return 4 * _G + 1.2 * reference_size, 1.2 * reference_size + 3 * sample_size
+
+
+def _mutect(sample_size, reference_size):
+    return min(4 * _G + sample_size / 20.0, 16 * _G), reference_size + 1.2 * sample_size
+
+
+def _gatk(sample_size, reference_size, writes_bam):
+    # The heap needed for realignment and recalibration grows slowly with depth. Steps that write a new BAM need about
+    # twice the size of the input on disk.
+    return min(4 * _G + sample_size / 16.0, 32 * _G), reference_size + (2.2 if writes_bam else 1.1) * sample_size
+
+
+# Memory and disk in bytes as functions of the total size of the per-sample inputs (reads, BAMs) and of the shared
+# reference inputs (genome, indices, VCFs), by job function name
+MODELS = {'run_bwakit': _bwakit,
+          'run_star': _star,
+          'run_mutect': _mutect,
+          'run_realigner_target_creator': partial(_gatk, writes_bam=False),
+          'run_indel_realignment': partial(_gatk, writes_bam=True),
+          'run_base_recalibration': partial(_gatk, writes_bam=False),
+          'run_print_reads': partial(_gatk, writes_bam=True)}
+
+
+def input_size(file_id, s3_key_path=None):
+    """
+    Determines the size of an input without downloading it
+
+    :param file_id: FileStoreID returned by Toil, URL, or size in bytes
+    :param str s3_key_path: Path to the 32-byte master key for SSE-C encryption of S3 objects
+    :return: Size in bytes, or None if it can't be determined, e.g. for a bare FileStoreID string
+    :rtype: int
+    """
+    if isinstance(file_id, (int, long)):
+        return file_id
+    size = getattr(file_id, 'size', None)
+    if size is not None:
+        return size
+    if isinstance(file_id, basestring) and '://' in file_id:
+        # Imported here, since toil_lib.urls imports the tool images
+        from toil_lib.urls import url_size
+        return url_size(file_id, s3_key_path=s3_key_path)
+    return None
+
+
+def estimate_requirements(tool, sample_inputs, reference_inputs=(), cores=1, s3_key_path=None):
+    """
+    Estimates the resources a tool's job function needs from the sizes of its inputs
+
+    >>> r = estimate_requirements('run_print_reads', [human2bytes('32G')], [human2bytes('4G')], cores=4)
+    >>> r['cores'], r['memory'] / 1024 ** 3, r['disk'] / 1024 ** 3
+    (4, 6, 75)
+
+    :param str tool: Name of the job function, one of MODELS
+    :param list sample_inputs: Per-sample inputs, such as fastqs or BAMs, as FileStoreIDs, URLs or sizes in bytes
+    :param list reference_inputs: Inputs shared by all samples, such as the genome and its indices
+    :param int cores: Number of cores to request
+    :param str s3_key_path: Path to the 32-byte master key for SSE-C encryption of S3 objects
+    :return: The cores, memory and disk to pass to addChildJobFn or wrapJobFn, in bytes
+    :rtype: dict[str,int]
+    """
+    require(tool in MODELS, 'No resource model for {}. Known tools: {}'.format(tool, sorted(MODELS)))
+    sample_size, reference_size = [_total_size(tool, inputs, s3_key_path) for inputs in (sample_inputs,
+                                                                                           reference_inputs)]
+    memory, disk = MODELS[tool](sample_size, reference_size)
+    return dict(cores=cores,
+                memory=max(_MIN_MEMORY, _round_up(memory)),
+                disk=max(_MIN_DISK, _round_up(disk)))
+
+
+def java_heap(memory):
+    """
+    >>> java_heap(human2bytes('10G'))
+    '8192m'
+
+    :param int memory: Memory requirement of the job in bytes
+    :return: Java heap size for a job with that much memory, for use in -Xmx
+    :rtype: str
+    """
+    return '{}m'.format(int(memory * _HEAP_FRACTION) // 1024 ** 2)
+
+
+def resource_estimator(tool, reference_inputs=(), cores=1, s3_key_path=None):
+    """
+    Returns a function estimating the requirements of a tool for one sample, for the requirements argument of
+    toil_lib.jobs.balanced_map_job. The sizes of the reference inputs are looked up once, here. Every FileStoreID or URL
+    found in a sample, including in lists, dicts and the attributes of config objects, is counted as a per-sample input
+    unless it is one of the reference inputs.
+
+    :param str tool: Name of the job function, one of MODELS
+    :param list reference_inputs: Inputs shared by all samples, such as the genome and its indices
+    :param int cores: Number of cores to request
+    :param str s3_key_path: Path to the 32-byte master key for SSE-C encryption of S3 objects
+    :return: Function of a sample returning a dict of cores, memory and disk
+    :rtype: function
+    """
+    require(tool in MODELS, 'No resource model for {}. Known tools: {}'.format(tool, sorted(MODELS)))
+    reference_sizes = {str(x): input_size(x, s3_key_path=s3_key_path) or 0 for x in reference_inputs}
+    # A partial of a module-level function can be pickled into the job store, unlike a closure
+    return partial(_estimate_sample, tool, reference_sizes, cores, s3_key_path)
+
+
+def _estimate_sample(tool, reference_sizes, cores, s3_key_path, sample):
+    sample_inputs = [x for x in _find_inputs(sample) if str(x) not in reference_sizes]
+    return estimate_requirements(tool, sample_inputs, reference_sizes.values(), cores=cores, s3_key_path=s3_key_path)
+
+
+def _find_inputs(sample):
+    """
+    >>> list(_find_inputs(['a', ('b', None), {'c': 3}]))
+    ['a', 'b']
+    """
+    if isinstance(sample, basestring):
+        yield sample
+    elif isinstance(sample, dict):
+        for value in sample.itervalues():
+            for x in _find_inputs(value):
+                yield x
+    elif isinstance(sample, (list, tuple)):
+        for value in sample:
+            for x in _find_inputs(value):
+                yield x
+    elif hasattr(sample, '__dict__'):
+        for x in _find_inputs(vars(sample)):
+            yield x
+
+
+def _total_size(tool, inputs, s3_key_path):
+    total = 0
+    for x in inputs:
+        size = input_size(x, s3_key_path=s3_key_path)
+        if size is None:
+            # Also the case for strings of a config that aren't files, such as read group attributes
+            _log.debug('Size of %s is unknown and not counted in the requirements of %s.', x, tool)
+        else:
+            total += size
+    return total
+
+
+def _round_up(size):
+    """
+    Rounds a size in bytes up to a whole number of gigabytes, so requirements are easy to read in Toil's logs
+
+    >>> _round_up(1) == 1024 ** 3
+    True
+    """
+    return int(math.ceil(size / float(_G))) * _G
@@ -10,6 +10,7 @@ import os.path
 
 from toil_lib import require
 from toil_lib.programs import docker_call
+from toil_lib.tools.images import ADAM, CONDUCTOR
 
 
 SPARK_MASTER_PORT = "7077"
@@ -115,7 +116,7 @@ def call_conductor(master_ip, src, dst, memory=None, override_parameters=None):
     arguments = ["-C", src, dst]
 
     docker_call(rm=False,
-                tool="quay.io/ucsc_cgl/conductor",
+                tool=CONDUCTOR,
                 docker_parameters=master_ip.docker_parameters(["--net=host"]),
                 parameters=_make_parameters(master_ip,
                                             [], # no conductor specific spark configuration
@@ -175,7 +176,7 @@ def call_adam(master_ip, arguments,
     # are we running adam via docker, or do we have a native path?
     if native_adam_path is None:
         docker_call(rm=False,
-                    tool="quay.io/ucsc_cgl/adam:962-ehf--6e7085f8cac4b9a927dc9fb06b48007957256b80",
+                    tool=ADAM,
                     docker_parameters=master_ip.docker_parameters(["--net=host"]),
                     parameters=_make_parameters(master_ip,
                                                 default_params,
@@ -1,45 +1,616 @@
 import glob
+import hashlib
+import httplib
+import json
+import logging
 import os
+import re
 import shutil
+import socket
 import subprocess
+import tempfile
+import threading
+import time
+import urllib2
+from distutils.spawn import find_executable
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from urlparse import urlparse
 
-from toil_lib import require
-from toil_lib.programs import docker_call
+from toil_lib import require, s3
+from toil_lib.cache import NodeCache, _flock, default_cache_dir
+from toil_lib.files import DEFAULT_LINK_STRATEGIES, link_file
+from toil_lib.programs import docker_call, run_concurrently
+from toil_lib.tools.images import GENETORRENT
 
+_log = logging.getLogger(__name__)
 
-def download_url(url, work_dir='.', name=None, s3_key_path=None, cghub_key_path=None):
+# Size of the byte ranges fetched by each connection of an HTTP download, and the unit of resumption
+_PART_SIZE = 16 * 1024 * 1024
+# Size of reads and writes when streaming
+_CHUNK_SIZE = 1024 * 1024
+# Seconds to wait before the first retry of a failed request. The delay doubles with each retry.
+_RETRY_DELAY = 1.0
+# HTTP errors are IOErrors too, but client errors among them are never retried, see _is_client_error
+_RETRYABLE_ERRORS = (urllib2.URLError, httplib.HTTPException, socket.error, IOError)
+# Prefix of the job store's shared files that map URLs to the FileStoreIDs they were imported as
+_REGISTRY_PREFIX = 'toil_lib.url.'
+# Name of the directory, inside the node cache or else the system's temporary directory, that ranged downloads are
+# assembled in so that a retried job can resume them
+_PARTIAL_DIR = 'toil-lib-partial'
+
+
+def download_url(url, work_dir='.', name=None, s3_key_path=None, cghub_key_path=None, num_connections=4,
+                 md5=None, cache_dir=None, s3_engine=None, link_strategies=DEFAULT_LINK_STRATEGIES):
     """
     Downloads URL, can pass in file://, http://, s3://, or ftp://, gnos://cghub/analysisID, or gnos:///analysisID
-    If downloading S3 URLs, the S3AM binary must be on the PATH
+    If downloading S3 URLs with the s3am engine, the S3AM binary must be on the PATH
 
     :param str url: URL to download from
     :param str work_dir: Directory to download file to
     :param str name: Name of output file, if None, basename of URL is used
     :param str s3_key_path: Path to 32-byte encryption key if url points to S3 file that uses SSE-C
     :param str cghub_key_path: Path to cghub key used to download from CGHub.
+    :param int num_connections: Number of concurrent connections used for HTTP(S) downloads
+    :param str md5: Expected MD5 hex digest of the file. For HTTP(S) and FTP it's computed while downloading.
+    :param str cache_dir: Node-local cache directory that downloads are shared through, keyed by URL and its ETag or
+           MD5. Defaults to the TOIL_LIB_CACHE_DIR environment variable. Cached files are hard linked into work_dir
+           and are read-only. Pass False to bypass the cache. URLs whose version can't be determined, such as FTP
+           URLs, are only cached if md5 is given.
+    :param str s3_engine: 's3am' to download S3 URLs with S3AM, or 'boto' to download them in-process as concurrent
+           byte ranges. Defaults to the TOIL_LIB_S3_ENGINE environment variable, or 's3am'.
+    :param tuple(str) link_strategies: How file:// URLs are placed in work_dir, see toil_lib.files.link_file
     :return: Path to the downloaded file
     :rtype: str
     """
     file_path = os.path.join(work_dir, name) if name else os.path.join(work_dir, os.path.basename(url))
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    version = md5 or _url_version(url, s3_key_path=s3_key_path) if cache_dir and not cghub_key_path else None
+    if version:
+        fill = partial(_download_to, url=url, s3_key_path=s3_key_path, num_connections=num_connections, md5=md5,
+                       s3_engine=s3_engine)
+        return NodeCache(cache_dir).get('\n'.join([url, version]), fill, file_path)
+    digest = None
     if cghub_key_path:
         _download_with_genetorrent(url, file_path, cghub_key_path)
+    elif urlparse(url).scheme == 's3' and s3.resolve_engine(s3_engine) == 'boto':
+        size, etag = s3.object_info(url, s3_key_path=s3_key_path)
+        fetch_part = partial(s3.download_part, url, s3_key_path=s3_key_path)
+        digest = _ranged_download(url, file_path, size, etag, num_connections, s3.PART_SIZE, fetch_part)
     elif urlparse(url).scheme == 's3':
         _s3am_with_retry(num_cores=1, file_path=file_path, s3_url=url, mode='download', s3_key_path=s3_key_path)
     elif urlparse(url).scheme == 'file':
-        shutil.copy(urlparse(url).path, file_path)
+        link_file(urlparse(url).path, file_path, strategies=link_strategies)
     else:
-        subprocess.check_call(['curl', '-fs', '--retry', '5', '--create-dir', url, '-o', file_path])
+        digest = _http_download(url, file_path, num_connections=num_connections)
     assert os.path.exists(file_path)
+    if md5:
+        digest = digest or _file_md5(file_path)
+        require(digest == md5, 'MD5 of {} is {} but {} was expected.'.format(url, digest, md5))
     return file_path
 
 
-def download_url_job(job, url, name=None, s3_key_path=None, cghub_key_path=None):
-    """Job version of `download_url`"""
+def download_and_extract(url, work_dir='.', name=None, s3_key_path=None, cache_dir=None, retries=3):
+    """
+    Downloads a tarball and extracts it as it arrives, without storing the archive. Gzipped tarballs are decompressed
+    with pigz if it's on the PATH. S3 tarballs are downloaded to disk first.
+
+    :param str url: URL of a tarball, which may be compressed with gzip or bzip2
+    :param str work_dir: Directory to extract into
+    :param str name: Name of the directory the tarball is extracted to, if None, the basename of the URL without its
+           extensions is used
+    :param str s3_key_path: Path to 32-byte encryption key if url points to S3 file that uses SSE-C
+    :param str cache_dir: Node-local cache directory that extracted tarballs are shared through, keyed by URL and its
+           ETag. Defaults to the TOIL_LIB_CACHE_DIR environment variable. Pass False to bypass the cache. URLs whose
+           version can't be determined, such as FTP URLs, aren't cached.
+    :param int retries: Number of attempts
+    :return: Path of the extracted tree's root, which is its only top-level directory if it has one
+    :rtype: str
+    """
+    name = name or re.sub(r'(\.tar)?(\.gz|\.tgz|\.bz2)?$', '', os.path.basename(url))
+    extract_dir = os.path.join(work_dir, name)
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    version = _url_version(url, s3_key_path=s3_key_path) if cache_dir else None
+    if version:
+        NodeCache(cache_dir).get('\n'.join(['extract', url, version]),
+                                 partial(_extract_url, url, s3_key_path=s3_key_path, retries=retries), extract_dir)
+    else:
+        _extract_url(url, extract_dir, s3_key_path=s3_key_path, retries=retries)
+    entries = os.listdir(extract_dir)
+    if len(entries) == 1 and os.path.isdir(os.path.join(extract_dir, entries[0])):
+        return os.path.join(extract_dir, entries[0])
+    return extract_dir
+
+
+def _extract_url(url, extract_dir, s3_key_path=None, retries=3):
+    """
+    Streams a tarball into tar, starting over if the download fails
+
+    :param str url: URL of the tarball
+    :param str extract_dir: Directory to extract into, which is created
+    """
+    if urlparse(url).path.endswith(('.gz', '.tgz')):
+        compression = ['--use-compress-program=pigz'] if find_executable('pigz') else ['-z']
+    elif urlparse(url).path.endswith('.bz2'):
+        compression = ['-j']
+    else:
+        compression = []
+    if urlparse(url).scheme == 's3':
+        archive_dir = extract_dir + '.download'
+        os.makedirs(archive_dir)
+        try:
+            archive = download_url(url, work_dir=archive_dir, s3_key_path=s3_key_path, cache_dir=False)
+            os.makedirs(extract_dir)
+            subprocess.check_call(['tar', '-x', '-C', extract_dir, '-f', archive] + compression)
+        finally:
+            shutil.rmtree(archive_dir)
+        return
+    if not urlparse(url).scheme:
+        url = 'http://' + url
+    for attempt in xrange(retries):
+        if os.path.exists(extract_dir):
+            shutil.rmtree(extract_dir)
+        os.makedirs(extract_dir)
+        start = time.time()
+        try:
+            response = urllib2.urlopen(url)
+            tar = subprocess.Popen(['tar', '-x', '-C', extract_dir, '-f', '-'] + compression, stdin=subprocess.PIPE)
+            try:
+                for chunk in iter(partial(response.read, _CHUNK_SIZE), ''):
+                    tar.stdin.write(chunk)
+            finally:
+                response.close()
+                tar.stdin.close()
+                if tar.wait():
+                    raise IOError('tar failed to extract {} with exit code {}'.format(url, tar.returncode))
+            _log.info('Downloaded and extracted %s in %.1f seconds.', url, time.time() - start)
+            return
+        except _RETRYABLE_ERRORS as e:
+            if attempt == retries - 1 or _is_client_error(e):
+                raise
+            _log.warn('Retrying download of %s.', url, exc_info=True)
+            time.sleep(_RETRY_DELAY * 2 ** attempt)
+
+
+def download_url_job(job, url, name=None, s3_key_path=None, cghub_key_path=None, deduplicate=False):
+    """
+    Job version of `download_url`
+
+    By default every call writes its own file to the FileStore, and the caller owns the returned FileStoreID. With
+    deduplicate, the URL is imported once per workflow: the FileStoreID is registered in the job store, and later
+    calls for the same URL that also pass deduplicate return it without downloading anything. The FileStoreID is then
+    shared by every job that asked for the URL, so it must not be deleted with job.fileStore.deleteGlobalFile: that
+    would delete the file for all of them, including jobs that already hold its FileStoreID. Calls after a deletion
+    import the URL again.
+
+    :param bool deduplicate: If True, reuses the file of an earlier deduplicated import of the same URL in this
+           workflow. The returned FileStoreID must not be deleted.
+    """
     work_dir = job.fileStore.getLocalTempDir()
-    fpath = download_url(url, work_dir=work_dir, name=name,
-                         s3_key_path=s3_key_path, cghub_key_path=cghub_key_path)
-    return job.fileStore.writeGlobalFile(fpath)
+
+    def download():
+        return download_url(url, work_dir=work_dir, name=name, s3_key_path=s3_key_path,
+                            cghub_key_path=cghub_key_path)
+
+    if deduplicate:
+        return _import_once(job, url, download)
+    return job.fileStore.writeGlobalFile(download())
+
+
+def download_urls_job(job, name_to_url, s3_key_path=None, cghub_key_path=None, num_threads=4, deduplicate=False):
+    """
+    Downloads several URLs concurrently within one job, writing each file to the FileStore as soon as it completes
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param dict[str,str] name_to_url: Maps the name of each file to its URL
+    :param str s3_key_path: Path to 32-byte encryption key if the URLs point to S3 files that use SSE-C
+    :param str cghub_key_path: Path to cghub key used to download from CGHub.
+    :param int num_threads: Maximum number of concurrent downloads
+    :param bool deduplicate: If True, reuses the files of earlier deduplicated imports of the same URLs in this
+           workflow, like download_url_job. The returned FileStoreIDs are shared with other jobs and must not be
+           deleted.
+    :return: Maps the name of each file to its FileStoreID
+    :rtype: dict[str,str]
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    # The FileStore is only used by one thread at a time
+    lock = threading.Lock()
+
+    def download(item):
+        name, url = item
+        fetch = partial(download_url, url, work_dir=work_dir, name=name, s3_key_path=s3_key_path,
+                        cghub_key_path=cghub_key_path)
+        if deduplicate:
+            return name, _import_once(job, url, fetch, lock=lock)
+        path = fetch()
+        with lock:
+            return name, job.fileStore.writeGlobalFile(path)
+
+    pool = ThreadPool(max(1, min(num_threads, len(name_to_url))))
+    try:
+        return dict(pool.imap_unordered(download, name_to_url.items()))
+    finally:
+        pool.terminate()
+
+
+def _import_once(job, url, download, lock=None):
+    """
+    Returns the FileStoreID registered for a URL in the workflow's job store, or downloads the URL, writes it to the
+    FileStore and registers it. Jobs on the same node wait on a file lock while the first one imports a URL. Jobs on
+    different nodes may import it concurrently, in which case all but the first to register their file delete it and
+    use the registered one. The registered file is shared by all callers, and must not be deleted by them. If it was
+    deleted anyway, the URL is imported and registered again.
+
+    :param function download: Downloads the URL and returns the path of the file
+    :param threading.Lock lock: Held while using the FileStore, if several threads share it
+    :return: FileStoreID of the file
+    :rtype: FileID
+    """
+    lock = lock or threading.Lock()
+    name = _REGISTRY_PREFIX + hashlib.sha1(url).hexdigest()
+    file_id = _registered_file(job, name)
+    if file_id:
+        return file_id
+    config = job.fileStore.jobStore.config
+    lock_path = os.path.join(getattr(config, 'workDir', None) or tempfile.gettempdir(),
+                             '{}-{}.lock'.format(config.workflowID, name))
+    with _flock(lock_path):
+        file_id = _registered_file(job, name)
+        if file_id:
+            return file_id
+        path = download()
+        with lock:
+            file_id = job.fileStore.writeGlobalFile(path)
+            registered = _registered_file(job, name)
+            if registered:
+                job.fileStore.deleteGlobalFile(file_id)
+                return registered
+            with job.fileStore.jobStore.writeSharedFileStream(name) as f:
+                json.dump(dict(url=url, file_id=str(file_id), size=os.path.getsize(path)), f)
+    job.fileStore.logToMaster('Imported {} as {}.'.format(url, file_id))
+    return file_id
+
+
+def _registered_file(job, name):
+    """
+    :return: The file registered under a shared file name, or None if there is none or it was deleted
+    :rtype: FileID
+    """
+    from toil.fileStore import FileID
+    from toil.jobStores.abstractJobStore import NoSuchFileException
+    try:
+        with job.fileStore.jobStore.readSharedFileStream(name) as f:
+            entry = json.load(f)
+    except NoSuchFileException:
+        return None
+    except ValueError:
+        # Still being written
+        return None
+    if not job.fileStore.jobStore.fileExists(entry['file_id']):
+        return None
+    return FileID(str(entry['file_id']), entry['size'])
+
+
+def _download_to(file_path, url, **kwargs):
+    download_url(url, work_dir=os.path.dirname(file_path), name=os.path.basename(file_path), cache_dir=False,
+                 **kwargs)
+
+
+def url_size(url, s3_key_path=None):
+    """
+    Determines the size of the file behind a URL without downloading it
+
+    :param str url: URL of the file. Local paths, file://, http(s):// and s3:// URLs are supported.
+    :param str s3_key_path: Path to the 32-byte master key for SSE-C encryption of S3 objects
+    :return: Size of the file in bytes, or None if it can't be determined
+    :rtype: int
+    """
+    parsed = urlparse(url)
+    if parsed.scheme in ('', 'file') and os.path.exists(parsed.path):
+        return os.path.getsize(parsed.path)
+    if parsed.scheme == 's3':
+        try:
+            return s3.object_info(url, s3_key_path=s3_key_path)[0]
+        except ImportError:
+            _log.warn('Could not determine the size of %s without boto.', url)
+            return None
+    headers = _head(url)
+    size = headers.getheader('Content-Length') if headers else None
+    return int(size) if size else None
+
+
+def _url_version(url, s3_key_path=None):
+    """
+    Identifies the version of the file behind a URL without downloading it
+
+    :param str url: URL of the file
+    :param str s3_key_path: Path to the 32-byte master key for SSE-C encryption of S3 objects
+    :return: The ETag or modification time and size of the file, or None if they can't be determined
+    :rtype: str
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == 'file':
+        st = os.stat(parsed.path)
+        return '{}:{}'.format(st.st_mtime, st.st_size)
+    if parsed.scheme == 's3':
+        try:
+            return s3.object_info(url, s3_key_path=s3_key_path)[1]
+        except ImportError:
+            _log.warn('Could not determine the version of %s without boto.', url)
+            return None
+    headers = _head(url)
+    if not headers:
+        return None
+    return headers.getheader('ETag') or '{}:{}'.format(headers.getheader('Last-Modified'),
+                                                       headers.getheader('Content-Length'))
+
+
+def _head(url):
+    """
+    :return: Headers of an HTTP(S) HEAD request of url, or None if the request failed or url isn't an HTTP(S) URL
+    :rtype: mimetools.Message
+    """
+    parsed = urlparse(url)
+    if parsed.scheme not in ('', 'http', 'https'):
+        return None
+    request = urllib2.Request(url if parsed.scheme else 'http://' + url)
+    request.get_method = lambda: 'HEAD'
+    try:
+        response = urllib2.urlopen(request)
+    except _RETRYABLE_ERRORS:
+        _log.warn('HEAD request of %s failed.', url, exc_info=True)
+        return None
+    try:
+        return response.info()
+    finally:
+        response.close()
+
+
+def _http_download(url, file_path, num_connections=4, part_size=_PART_SIZE, retries=5):
+    """
+    Downloads an HTTP(S) or FTP URL. If the server supports byte ranges, the file is fetched as parts of part_size
+    over several connections. Each part is retried with exponential backoff, and the parts that completed are
+    recorded at a node-wide path keyed by the URL, see _partial_path, so that a later call, e.g. from a retried job
+    with a new work directory, resumes where a failed one stopped. Otherwise, as for FTP, the file is read over a
+    single connection that starts over if it fails. URLs without a scheme are fetched over HTTP, like curl does.
+
+    :param str url: URL to download from
+    :param str file_path: Path of the downloaded file
+    :param int num_connections: Maximum number of concurrent connections
+    :param int part_size: Size of each byte range in bytes
+    :param int retries: Number of attempts for each request
+    :return: MD5 hex digest of the file, computed while it is written
+    :rtype: str
+    """
+    if not urlparse(url).scheme:
+        url = 'http://' + url
+    if not os.path.isdir(os.path.dirname(os.path.abspath(file_path))):
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)))
+    start = time.time()
+    # A single byte probe reveals both the size and range support, and otherwise its body is the whole file
+    try:
+        response = _urlopen_with_retry(urllib2.Request(url, headers={'Range': 'bytes=0-0'}), retries)
+    except urllib2.HTTPError as e:
+        # An empty file has no byte to satisfy the probe with
+        if e.code != 416:
+            raise
+        response = None
+    content_range = response.info().getheader('Content-Range') if response else ''
+    if not response:
+        open(file_path, 'wb').close()
+        digest = hashlib.md5().hexdigest()
+    elif response.getcode() == 206 and content_range.split('/')[-1].isdigit():
+        size = int(content_range.split('/')[-1])
+        etag = response.info().getheader('ETag')
+        response.close()
+        # Use the URL that redirects led to, so parts don't follow them again
+        fetch_part = partial(_fetch_part, response.geturl(), retries=retries)
+        digest = _ranged_download(url, file_path, size, etag, num_connections, part_size, fetch_part)
+    else:
+        _log.warn('%s does not support byte ranges, downloading it over a single connection that cannot be resumed.',
+                  url)
+        digest = _stream_download(url, file_path, response, retries)
+    elapsed = max(time.time() - start, 1e-6)
+    size = os.path.getsize(file_path)
+    _log.info('Downloaded %s (%d bytes) in %.1f seconds (%.1f MB/s), MD5 %s.',
+              url, size, elapsed, size / elapsed / 1024 / 1024, digest)
+    return digest
+
+
+def _urlopen_with_retry(request, retries):
+    for attempt in xrange(retries):
+        try:
+            return urllib2.urlopen(request)
+        except _RETRYABLE_ERRORS as e:
+            if attempt == retries - 1 or _is_client_error(e):
+                raise
+        time.sleep(_RETRY_DELAY * 2 ** attempt)
+
+
+def _is_client_error(e):
+    """
+    :return: Whether an exception is an HTTP client error, such as 403 or 404, which won't go away by retrying
+    :rtype: bool
+    """
+    return isinstance(e, urllib2.HTTPError) and e.code < 500
+
+
+def _stream_download(url, file_path, response, retries):
+    """
+    Downloads a URL over a single connection, starting over if the connection drops
+
+    :param str url: URL to download from
+    :param str file_path: Path of the downloaded file
+    :param response: Open response for the URL, used for the first attempt
+    :param int retries: Number of attempts
+    :return: MD5 hex digest of the file
+    :rtype: str
+    """
+    for attempt in xrange(retries):
+        try:
+            response = response or urllib2.urlopen(url)
+            md5 = hashlib.md5()
+            with open(file_path, 'wb') as f:
+                for chunk in iter(partial(response.read, _CHUNK_SIZE), ''):
+                    md5.update(chunk)
+                    f.write(chunk)
+            return md5.hexdigest()
+        except _RETRYABLE_ERRORS as e:
+            if attempt == retries - 1 or _is_client_error(e):
+                raise
+            time.sleep(_RETRY_DELAY * 2 ** attempt)
+        finally:
+            if response:
+                response.close()
+            response = None
+
+
+def _ranged_download(url, file_path, size, etag, num_connections, part_size, fetch_part):
+    """
+    Downloads a URL as concurrent byte ranges. The file is assembled at _partial_path(url) and moved to file_path once
+    it is complete, so a download that failed is resumed by the next one of the same URL on this node, whatever its
+    file_path. If another download of the URL is already in progress on the node, the file is assembled in place.
+
+    :param function fetch_part: Called with file_path and the first and last byte of a range, writes the range to the
+           same range of the file
+    :return: MD5 hex digest of the file
+    :rtype: str
+    """
+    partial_path = _partial_path(url)
+    with _flock(partial_path + '.lock', blocking=False) as locked:
+        if not locked:
+            _log.info('%s is already being downloaded on this node, this download will not be resumable.', url)
+            return _download_parts(url, file_path, size, etag, num_connections, part_size, fetch_part)
+        digest = _download_parts(url, partial_path, size, etag, num_connections, part_size, fetch_part)
+        shutil.move(partial_path, file_path)
+        return digest
+
+
+def _partial_path(url):
+    """
+    :return: Path at which a ranged download of a URL is assembled. It is inside the node cache if there is one, so
+             the finished file can be moved into it, and in the system's temporary directory otherwise.
+    :rtype: str
+    """
+    partial_dir = os.path.join(default_cache_dir() or tempfile.gettempdir(), _PARTIAL_DIR)
+    try:
+        os.makedirs(partial_dir)
+    except OSError:
+        if not os.path.isdir(partial_dir):
+            raise
+    return os.path.join(partial_dir, hashlib.sha1(url).hexdigest())
+
+
+def _download_parts(url, file_path, size, etag, num_connections, part_size, fetch_part):
+    """
+    Downloads a URL as concurrent byte ranges, resuming from a previous attempt if the progress file next to file_path
+    matches. See _ranged_download.
+    """
+    parts = [(start, min(start + part_size, size) - 1) for start in xrange(0, size, part_size)]
+    progress_path = file_path + '.parts'
+    progress = dict(size=size, etag=etag, part_size=part_size, done=[])
+    if os.path.exists(progress_path) and os.path.exists(file_path):
+        with open(progress_path) as f:
+            saved = json.load(f)
+        if all(saved.get(k) == progress[k] for k in ['size', 'etag', 'part_size']):
+            progress = saved
+            _log.info('Resuming download of %s with %d of %d parts done.', url, len(progress['done']), len(parts))
+    if not progress['done']:
+        with open(file_path, 'wb') as f:
+            f.truncate(size)
+    done = set(progress['done'])
+    hasher = _OrderedHasher(file_path, parts)
+    lock = threading.Lock()
+
+    def fetch(i):
+        if i not in done:
+            fetch_part(file_path, parts[i])
+        with lock:
+            done.add(i)
+            progress['done'] = sorted(done)
+            with open(progress_path + '.tmp', 'w') as f:
+                json.dump(progress, f)
+            os.rename(progress_path + '.tmp', progress_path)
+            hasher.complete(i)
+
+    run_concurrently([partial(fetch, i) for i in xrange(len(parts))], num_threads=num_connections)
+    os.remove(progress_path)
+    return hasher.hexdigest()
+
+
+def _fetch_part(url, file_path, part, retries):
+    """
+    Writes one byte range of a URL to the same range of a file, retrying with exponential backoff
+
+    :param str url: URL to download from
+    :param str file_path: Path of the downloaded file, which must already have its final size
+    :param tuple(int, int) part: First and last byte of the range
+    :param int retries: Number of attempts
+    """
+    start, end = part
+    for attempt in xrange(retries):
+        try:
+            response = urllib2.urlopen(urllib2.Request(url, headers={'Range': 'bytes={}-{}'.format(start, end)}))
+            try:
+                if response.getcode() != 206:
+                    raise IOError('Server ignored the byte range of {}'.format(url))
+                written = 0
+                with open(file_path, 'r+b') as f:
+                    f.seek(start)
+                    for chunk in iter(partial(response.read, _CHUNK_SIZE), ''):
+                        f.write(chunk)
+                        written += len(chunk)
+            finally:
+                response.close()
+            if written != end - start + 1:
+                raise IOError('Received {} of {} bytes of {}'.format(written, end - start + 1, url))
+            return
+        except _RETRYABLE_ERRORS as e:
+            if attempt == retries - 1 or _is_client_error(e):
+                raise
+            _log.warn('Retrying bytes %d-%d of %s.', start, end, url, exc_info=True)
+            time.sleep(_RETRY_DELAY * 2 ** attempt)
+
+
+class _OrderedHasher(object):
+    """
+    Hashes a file whose parts are completed out of order, as soon as the parts before them are complete. Parts are
+    read back right after they were written, so they are usually still in the page cache.
+    """
+
+    def __init__(self, file_path, parts):
+        self.file_path = file_path
+        self.parts = parts
+        self.completed = set()
+        self.next = 0
+        self.md5 = hashlib.md5()
+
+    def complete(self, i):
+        self.completed.add(i)
+        while self.next in self.completed:
+            start, end = self.parts[self.next]
+            with open(self.file_path, 'rb') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining:
+                    chunk = f.read(min(remaining, _CHUNK_SIZE))
+                    self.md5.update(chunk)
+                    remaining -= len(chunk)
+            self.next += 1
+
+    def hexdigest(self):
+        assert self.next == len(self.parts)
+        return self.md5.hexdigest()
+
+
+def _file_md5(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(partial(f.read, _CHUNK_SIZE), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
 
 
 def _download_with_genetorrent(url, file_path, cghub_key_path):
@@ -49,33 +620,54 @@ def _download_with_genetorrent(url, file_path, cghub_key_path):
     work_dir = os.path.dirname(file_path)
     folder_path = os.path.join(work_dir, os.path.basename(analysis_id))
     parameters = ['-vv', '-c', cghub_key_path, '-d', analysis_id]
-    docker_call(tool='quay.io/ucsc_cgl/genetorrent:3.8.7--9911761265b6f08bc3ef09f53af05f56848d805b',
-                work_dir=work_dir, parameters=parameters)
+    docker_call(tool=GENETORRENT, work_dir=work_dir, parameters=parameters)
     sample = glob.glob(os.path.join(folder_path, '*tar*'))
     assert len(sample) == 1, 'More than one sample tar in CGHub download: {}'.format(analysis_id)
 
 
-def s3am_upload(fpath, s3_dir, num_cores=1, s3_key_path=None):
+def s3am_upload(fpath, s3_dir, num_cores=1, s3_key_path=None, s3_engine=None):
     """
     Uploads a file to s3 via S3AM
-    S3AM binary must be on the PATH to use this function
+    S3AM binary must be on the PATH to use this function, unless the boto engine is used
     For SSE-C encryption: provide a path to a 32-byte file
 
     :param str fpath: Path to file to upload
     :param str s3_dir: Ouptut S3 path. Format: s3://bucket/[directory]
     :param int num_cores: Number of cores to use for up/download with S3AM
     :param str s3_key_path: (OPTIONAL) Path to 32-byte key to be used for SSE-C encryption
+    :param str s3_engine: 's3am' to upload with S3AM, or 'boto' to upload in-process with part-level retries and
+           resumption. Defaults to the TOIL_LIB_S3_ENGINE environment variable, or 's3am'.
     """
     require(s3_dir.startswith('s3://'), 'Format of s3_dir (s3://) is incorrect: {}'.format(s3_dir))
     s3_dir = os.path.join(s3_dir, os.path.basename(fpath))
-    _s3am_with_retry(num_cores, file_path=fpath, s3_url=s3_dir, mode='upload', s3_key_path=s3_key_path)
+    if s3.resolve_engine(s3_engine) == 'boto':
+        s3.upload_file(fpath, s3_dir, s3_key_path=s3_key_path, num_threads=num_cores)
+    else:
+        _s3am_with_retry(num_cores, file_path=fpath, s3_url=s3_dir, mode='upload', s3_key_path=s3_key_path)
 
 
-def s3am_upload_job(job, file_id, file_name, s3_dir, s3_key_path=None):
+def s3am_upload_job(job, file_id, file_name, s3_dir, s3_key_path=None, s3_engine=None):
     """Job version of s3am_upload"""
     work_dir = job.fileStore.getLocalTempDir()
     fpath = job.fileStore.readGlobalFile(file_id, os.path.join(work_dir, file_name))
-    s3am_upload(fpath=fpath, s3_dir=s3_dir, num_cores=job.cores, s3_key_path=s3_key_path)
+    s3am_upload(fpath=fpath, s3_dir=s3_dir, num_cores=job.cores, s3_key_path=s3_key_path, s3_engine=s3_engine)
+
+
+def s3_upload_stream_job(job, file_id, file_name, s3_dir, s3_key_path=None):
+    """
+    Streams a file from the FileStore to S3 with the boto engine, without a local copy. Parts are read from the
+    FileStore while earlier parts upload, so memory use is bounded and no disk space is needed.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param str file_id: FileStoreID of the file to upload
+    :param str file_name: Name of the uploaded file
+    :param str s3_dir: Ouptut S3 path. Format: s3://bucket/[directory]
+    :param str s3_key_path: (OPTIONAL) Path to 32-byte key to be used for SSE-C encryption
+    """
+    require(s3_dir.startswith('s3://'), 'Format of s3_dir (s3://) is incorrect: {}'.format(s3_dir))
+    with job.fileStore.readGlobalFileStream(file_id) as f:
+        s3.upload_stream(f, os.path.join(s3_dir, file_name), s3_key_path=s3_key_path, num_threads=job.cores,
+                         size=getattr(file_id, 'size', None))
 
 
 def _s3am_with_retry(num_cores, file_path, s3_url, mode='upload', s3_key_path=None):